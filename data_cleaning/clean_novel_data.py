@@ -14,7 +14,7 @@ import asyncio
 import hashlib
 import json
 import shutil
-from typing import List, Optional, Tuple, Dict
+from typing import List, Optional, Tuple, Dict, Callable
 from tqdm.asyncio import tqdm
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
@@ -117,6 +117,58 @@ def load_nicknames(char_name: str, source_novel: Optional[str] = None, map_file:
         logging.error(f"读取昵称映射文件失败: {e}")
         return []
 
+def collect_chapter_files(target_prefix: Optional[str] = None, start_idx: Optional[int] = None,
+                          end_idx: Optional[int] = None, logger: Optional[logging.Logger] = None) -> List[str]:
+    """扫描切分目录，返回符合卷前缀与章节范围的章节文件列表 (不依赖 API 配置)"""
+    logger = logger or logging.getLogger("cleaner")
+    target_prefix = target_prefix or "full"
+    vols = sorted([d for d in glob.glob(os.path.join(Config.BASE_INPUT_DIR, "[0-9][0-9]_*")) if os.path.isdir(d)])
+    if target_prefix != "full":
+        vols = [v for v in vols if os.path.basename(v).startswith(target_prefix)]
+    
+    if not vols:
+        logger.error(f"未找到前缀为 {target_prefix} 的目标文件夹")
+        return []
+
+    chapters = []
+    for vol in vols:
+        chapter_files = sorted(glob.glob(os.path.join(vol, "*.txt")))
+        
+        for cf in chapter_files:
+            file_name = os.path.basename(cf)
+            try:
+                current_file_idx = int(file_name.split('_')[0])
+            except:
+                current_file_idx = -1
+
+            if start_idx is not None and current_file_idx < start_idx: continue
+            if end_idx is not None and current_file_idx > end_idx: continue
+
+            chapters.append(cf)
+    return chapters
+
+def label_interaction_ids(generated_files: List[str], logger: Optional[logging.Logger] = None):
+    """为生成文件中的交互单元标记卷内序号 (如 012_001) 与全局序号"""
+    logger = logger or logging.getLogger("cleaner")
+    logger.info("开始标记序号...")
+    # 确保按文件名排序，保证全局ID的顺序正确
+    generated_files.sort(key=lambda p: os.path.basename(p))
+    
+    global_counter = 1
+    for file_path in generated_files:
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f: data = json.load(f)
+            if "interaction_units" in data and data["interaction_units"]:
+                prefix = os.path.basename(file_path).split('_')[0]
+                for i, unit in enumerate(data["interaction_units"], 1):
+                    unit["id"] = f"{prefix}_{i:03d}"
+                    unit["global_id"] = global_counter
+                    global_counter += 1
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"标记序号出错 {file_path}: {e}")
+
 # ==========================================
 # 4. 统计管理模块
 # ==========================================
@@ -149,6 +201,17 @@ class StatsManager:
         return (self.prompt_tokens / 1000 * Config.PRICE_PROMPT) + \
                (self.completion_tokens / 1000 * Config.PRICE_COMPLETION)
 
+    def summary(self) -> Dict:
+        """导出统计快照，用于写入费用报告"""
+        return {
+            "success": self.success,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_cny": round(self.get_cost(), 4),
+        }
+
 # ==========================================
 # 4. 核心清洗引擎
 # ==========================================
@@ -158,16 +221,26 @@ class NovelCleaner:
                  nickname_list: Optional[List[str]] = None, source_novel: Optional[str] = None,
                  prompt_instruction_file: str = None, 
                  output_schema_file: str = None,
-                 force_refresh: bool = False):
+                 force_refresh: bool = False,
+                 variant: Optional[str] = None,
+                 client: Optional[AsyncOpenAI] = None,
+                 semaphore: Optional[asyncio.Semaphore] = None,
+                 output_root: Optional[str] = None,
+                 on_result: Optional[Callable[[str, Dict], None]] = None,
+                 clear_cache: Optional[bool] = None):
         if prompt_instruction_file is None:
             prompt_instruction_file = os.path.join(CURRENT_DIR, "prompts", "prompt_instruction.txt")
         if output_schema_file is None:
             output_schema_file = os.path.join(CURRENT_DIR, "prompts", "output_schema.txt")
             
         Config.validate()
-        self.client = AsyncOpenAI(api_key=Config.API_KEY, base_url=Config.BASE_URL)
+        # client / semaphore 允许外部注入，多个变体共享同一个限流器
+        self.client = client or AsyncOpenAI(api_key=Config.API_KEY, base_url=Config.BASE_URL)
         self.stats = StatsManager()
-        self.semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_TASKS)
+        self.semaphore = semaphore or asyncio.Semaphore(Config.MAX_CONCURRENT_TASKS)
+        self.variant = variant
+        # 每个章节结果写盘后的回调 (输出路径, 结果数据)，供流式编排直接消费内存中的结果
+        self.on_result = on_result
         self.target_prefix = target_prefix or "full"
         self.char_name = char_name
         self.nickname_list = nickname_list or []
@@ -175,20 +248,24 @@ class NovelCleaner:
         self.system_prompt = PromptManager.load_composed_prompt(prompt_instruction_file, output_schema_file)
         self.force_refresh = force_refresh
         
-        # 自动生成带时间戳的任务输出目录，包含角色名作为索引
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.output_root = os.path.join(Config.LORA_DATASET_DIR, f"cleaned_{self.char_name}_{self.target_prefix}_{timestamp}")
+        # 自动生成带时间戳的任务输出目录，包含角色名作为索引 (分布式 Worker 复用协调端指定的目录)
+        if output_root is None:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            variant_tag = f"{self.variant}_" if self.variant else ""
+            output_root = os.path.join(Config.LORA_DATASET_DIR, f"cleaned_{self.char_name}_{variant_tag}{self.target_prefix}_{timestamp}")
+        self.output_root = output_root
         os.makedirs(self.output_root, exist_ok=True)
         
-        # 如果强制刷新，先清空缓存目录
-        if self.force_refresh:
+        # 如果强制刷新，先清空缓存目录 (多变体共享缓存目录时由 MultiVariantRunner 统一清空一次)
+        if self.force_refresh if clear_cache is None else clear_cache:
             self._clear_cache()
             
         os.makedirs(Config.CACHE_DIR, exist_ok=True)
         
         self._setup_logging()
 
-    def _clear_cache(self):
+    @staticmethod
+    def _clear_cache():
         """清空缓存目录"""
         if os.path.exists(Config.CACHE_DIR):
             try:
@@ -199,14 +276,19 @@ class NovelCleaner:
 
     def _setup_logging(self):
         """初始化日志系统"""
-        # 使用 logger 实例而不是全局配置
-        self.logger = logging.getLogger("cleaner")
+        # 使用 logger 实例而不是全局配置；每个变体独立的 logger，processing.log 只记录本变体的消息
+        self.logger = logging.getLogger(f"cleaner.{self.variant}" if self.variant else "cleaner")
         self.logger.setLevel(logging.INFO)
+        # 同一进程中重复创建同名清洗器时，替换旧的文件 Handler 而不是叠加
+        for handler in [h for h in self.logger.handlers if isinstance(h, logging.FileHandler)]:
+            self.logger.removeHandler(handler)
+            handler.close()
         
         # 添加本地文件 Handler
         log_file = os.path.join(self.output_root, "processing.log")
         fh = logging.FileHandler(log_file, encoding='utf-8')
-        fh.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+        variant_tag = f"[{self.variant}] " if self.variant else ""
+        fh.setFormatter(logging.Formatter(f'%(asctime)s [%(levelname)s] {variant_tag}%(message)s'))
         self.logger.addHandler(fh)
 
     def _get_hash(self, content: str) -> str:
@@ -229,29 +311,51 @@ class NovelCleaner:
             response_format={"type": "json_object"}, temperature=0.3
         )
 
+    def _matches_target(self, content: str, char_name: str) -> bool:
+        """本地语义过滤：判断章节是否包含主角名称关键部分"""
+        short_name = char_name[1:] if len(char_name) > 1 else char_name
+        
+        # 构建关键词集合：全名 + 短名 + 自定义昵称
+        keywords = {char_name, short_name}
+        if self.nickname_list:
+            keywords.update(self.nickname_list)
+        
+        # 只要包含任意一个关键词，即视为命中
+        return any(k in content for k in keywords if k)
+
+    async def write_skipped(self, file_name: str, output_path: str) -> str:
+        """记录本地过滤跳过的章节，并生成空文件"""
+        await self.stats.update_status("skipped")
+        self.logger.info(f"章节 {file_name} 本地过滤跳过 (未发现角色关键词)")
+        # 即使跳过也生成空文件
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        empty = {"meta_info": {"global_scene_type": "Other"}, "interaction_units": []}
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(empty, f, ensure_ascii=False, indent=2)
+        self._emit(output_path, empty)
+        return output_path
+
+    def _emit(self, output_path: str, data: Dict):
+        """通知结果回调 (若已注册)"""
+        if self.on_result:
+            self.on_result(output_path, data)
+
     async def process_chapter(self, file_path: str, output_path: str, char_name: str) -> Optional[str]:
         """处理单个章节的协程"""
         file_name = os.path.basename(file_path)
         try:
             content = self._read_file(file_path)
-            
-            # 本地语义过滤：跳过不含主角名称关键部分的章节
-            short_name = char_name[1:] if len(char_name) > 1 else char_name
-            
-            # 构建关键词集合：全名 + 短名 + 自定义昵称
-            keywords = {char_name, short_name}
-            if self.nickname_list:
-                keywords.update(self.nickname_list)
-            
-            # 只要包含任意一个关键词，即视为命中
-            if not any(k in content for k in keywords if k):
-                await self.stats.update_status("skipped")
-                self.logger.info(f"章节 {file_name} 本地过滤跳过 (未发现角色关键词)")
-                # 即使跳过也生成空文件
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    json.dump({"meta_info": {"global_scene_type": "Other"}, "interaction_units": []}, f, ensure_ascii=False, indent=2)
-                return output_path
+            if not self._matches_target(content, char_name):
+                return await self.write_skipped(file_name, output_path)
+        except Exception as e:
+            self.logger.error(f"处理 {file_name} 时发生错误: {e}")
+            await self.stats.update_status("failed")
+            return None
+        return await self.process_content(file_name, content, output_path, char_name)
 
+    async def process_content(self, file_name: str, content: str, output_path: str, char_name: str) -> Optional[str]:
+        """对已读取并通过过滤的章节内容执行缓存校验与 API 调用"""
+        try:
             # 创建输出目录（如果不存在）
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
@@ -271,6 +375,7 @@ class NovelCleaner:
                     else:
                         await self.stats.update_status("success")
                         self.logger.info(f"章节 {file_name} 缓存命中: 提取成功")
+                    self._emit(output_path, res_data)
                     return output_path
                 except:
                     pass
@@ -304,6 +409,7 @@ class NovelCleaner:
                     else:
                         await self.stats.update_status("success")
                         self.logger.info(f"章节 {file_name} 处理完毕: 提取成功")
+                    self._emit(output_path, res_data)
                     return output_path
                 except json.JSONDecodeError:
                     self.logger.error(f"解析 {file_name} 的 AI 响应失败: 格式非 JSON")
@@ -314,33 +420,33 @@ class NovelCleaner:
             await self.stats.update_status("failed")
             return None
 
+    def collect_chapters(self, start_idx: Optional[int] = None, end_idx: Optional[int] = None) -> List[str]:
+        """扫描切分目录，返回符合卷前缀与章节范围的章节文件列表"""
+        return collect_chapter_files(self.target_prefix, start_idx, end_idx, logger=self.logger)
+
+    def output_path_for(self, chapter_file: str) -> str:
+        """章节文件在本次任务输出目录中的对应路径 (卷名/文件名)"""
+        vol_out = os.path.join(self.output_root, os.path.basename(os.path.dirname(chapter_file)))
+        os.makedirs(vol_out, exist_ok=True)
+        return os.path.join(vol_out, os.path.basename(chapter_file))
+
+    def log_progress(self, total: int):
+        """每 10 个章节输出一次进度与成本"""
+        done = self.stats.success + self.stats.failed + self.stats.skipped
+        if done % 10 == 0 or done == total:
+            self.logger.info(f"进度: {done}/{total} | 成功:{self.stats.success} 失败:{self.stats.failed} 跳过/空:{self.stats.skipped} | 成本: {self.stats.get_cost():.2f} CNY")
+
+    def label_ids(self, generated_files: List[str]):
+        """为生成文件中的交互单元标记卷内序号与全局序号"""
+        label_interaction_ids(generated_files, logger=self.logger)
+        self.logger.info(f"清洗完毕。输出至: {self.output_root}")
+
     async def run(self, start_idx: Optional[int] = None, end_idx: Optional[int] = None) -> List[str]:
         """启动清洗任务主循环"""
-        vols = sorted([d for d in glob.glob(os.path.join(Config.BASE_INPUT_DIR, "[0-9][0-9]_*")) if os.path.isdir(d)])
-        if self.target_prefix != "full":
-            vols = [v for v in vols if os.path.basename(v).startswith(self.target_prefix)]
-        
-        if not vols:
-            self.logger.error(f"未找到前缀为 {self.target_prefix} 的目标文件夹")
-            return []
-
-        tasks_list = []
-        for vol in vols:
-            vol_out = os.path.join(self.output_root, os.path.basename(vol))
-            os.makedirs(vol_out, exist_ok=True)
-            chapter_files = sorted(glob.glob(os.path.join(vol, "*.txt")))
-            
-            for cf in chapter_files:
-                file_name = os.path.basename(cf)
-                try:
-                    current_file_idx = int(file_name.split('_')[0])
-                except:
-                    current_file_idx = -1
-
-                if start_idx is not None and current_file_idx < start_idx: continue
-                if end_idx is not None and current_file_idx > end_idx: continue
-
-                tasks_list.append(self.process_chapter(cf, os.path.join(vol_out, file_name), self.char_name))
+        tasks_list = [
+            self.process_chapter(cf, self.output_path_for(cf), self.char_name)
+            for cf in self.collect_chapters(start_idx, end_idx)
+        ]
 
         if not tasks_list:
             self.logger.warning(f"未找到可处理的任务")
@@ -352,33 +458,124 @@ class NovelCleaner:
         for f in tqdm.as_completed(tasks_list, total=len(tasks_list), desc=f"Cleaning {self.target_prefix}"):
             res = await f
             if res: generated_files.append(res)
-            
-            done = self.stats.success + self.stats.failed + self.stats.skipped
-            if done % 10 == 0 or done == len(tasks_list):
-                self.logger.info(f"进度: {done}/{len(tasks_list)} | 成功:{self.stats.success} 失败:{self.stats.failed} 跳过/空:{self.stats.skipped} | 成本: {self.stats.get_cost():.2f} CNY")
+            self.log_progress(len(tasks_list))
 
-        self.logger.info("开始标记序号...")
-        # 确保按文件名排序，保证全局ID的顺序正确
-        generated_files.sort(key=lambda p: os.path.basename(p))
-        
-        global_counter = 1
-        for file_path in generated_files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f: data = json.load(f)
-                if "interaction_units" in data and data["interaction_units"]:
-                    prefix = os.path.basename(file_path).split('_')[0]
-                    for i, unit in enumerate(data["interaction_units"], 1):
-                        unit["id"] = f"{prefix}_{i:03d}"
-                        unit["global_id"] = global_counter
-                        global_counter += 1
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2)
-            except Exception as e:
-                self.logger.error(f"标记序号出错 {file_path}: {e}")
-        
-        self.logger.info(f"清洗完毕。输出至: {self.output_root}")
+        self.label_ids(generated_files)
         return generated_files
 
+# ==========================================
+# 5. 多 Prompt 变体共享读取调度
+# ==========================================
+class MultiVariantRunner:
+    """
+    一次运行处理多组 (指令, Schema) 变体，如 base / hentai / identity。
+    每个章节只读取与过滤一次，然后分发给所有变体；所有变体共享同一个 API 客户端、
+    并发信号量与缓存目录，各自输出到独立的 cleaned_* 目录，最后汇总费用报告。
+    """
+    def __init__(self, variants: List[Tuple[str, str, str]], target_prefix: Optional[str] = None,
+                 char_name: str = "顾家明", nickname_list: Optional[List[str]] = None,
+                 source_novel: Optional[str] = None, force_refresh: bool = False):
+        """
+        :param variants: [(变体名, 指令文件路径, Schema 文件路径), ...]
+        """
+        if not variants:
+            raise ValueError("至少需要一个 Prompt 变体")
+        names = [name for name, _, _ in variants]
+        if len(set(names)) != len(names):
+            raise ValueError(f"变体名称重复: {names}")
+
+        Config.validate()
+        client = AsyncOpenAI(api_key=Config.API_KEY, base_url=Config.BASE_URL)
+        semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_TASKS)
+        self.char_name = char_name
+        self.target_prefix = target_prefix or "full"
+        self.cleaners: Dict[str, NovelCleaner] = {}
+        # 各变体共享缓存目录：只清空一次，不能让后创建的变体各自再清一遍
+        if force_refresh:
+            NovelCleaner._clear_cache()
+        for name, ins_file, sch_file in variants:
+            self.cleaners[name] = NovelCleaner(
+                target_prefix=target_prefix,
+                char_name=char_name,
+                nickname_list=nickname_list,
+                source_novel=source_novel,
+                prompt_instruction_file=ins_file,
+                output_schema_file=sch_file,
+                force_refresh=force_refresh,
+                clear_cache=False,
+                variant=name,
+                client=client,
+                semaphore=semaphore,
+            )
+        self.logger = logging.getLogger("cleaner")
+
+    async def _fan_out(self, chapter_file: str) -> Dict[str, Optional[str]]:
+        """读取并过滤一次章节，然后并发分发给所有变体"""
+        primary = next(iter(self.cleaners.values()))
+        file_name = os.path.basename(chapter_file)
+        names = list(self.cleaners.keys())
+        try:
+            content = primary._read_file(chapter_file)
+        except Exception as e:
+            self.logger.error(f"读取 {file_name} 时发生错误: {e}")
+            for cleaner in self.cleaners.values():
+                await cleaner.stats.update_status("failed")
+            return {name: None for name in names}
+
+        if not primary._matches_target(content, self.char_name):
+            coros = [c.write_skipped(file_name, c.output_path_for(chapter_file)) for c in self.cleaners.values()]
+        else:
+            coros = [c.process_content(file_name, content, c.output_path_for(chapter_file), self.char_name)
+                     for c in self.cleaners.values()]
+        results = await asyncio.gather(*coros)
+        return dict(zip(names, results))
+
+    def write_cost_report(self) -> str:
+        """汇总各变体的统计与费用，写入 JSON 报告并返回路径"""
+        report = {"character": self.char_name, "target_prefix": self.target_prefix, "variants": {}}
+        total = {"success": 0, "failed": 0, "skipped": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_cny": 0.0}
+        for name, cleaner in self.cleaners.items():
+            summary = cleaner.stats.summary()
+            summary["output_root"] = cleaner.output_root
+            report["variants"][name] = summary
+            for k in total:
+                total[k] += summary[k]
+        total["cost_cny"] = round(total["cost_cny"], 4)
+        report["total"] = total
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        report_path = os.path.join(Config.LORA_DATASET_DIR, f"cost_report_{self.char_name}_{self.target_prefix}_{timestamp}.json")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+        for name, summary in report["variants"].items():
+            self.cleaners[name].logger.info(f"[{name}] 成功:{summary['success']} 失败:{summary['failed']} 跳过/空:{summary['skipped']} | 成本: {summary['cost_cny']:.2f} CNY")
+        self.logger.info(f"[合计] Prompt Tokens:{total['prompt_tokens']} Completion Tokens:{total['completion_tokens']} | 成本: {total['cost_cny']:.2f} CNY")
+        self.logger.info(f"费用报告已写入: {report_path}")
+        return report_path
+
+    async def run(self, start_idx: Optional[int] = None, end_idx: Optional[int] = None) -> Dict[str, List[str]]:
+        """启动多变体清洗，返回 {变体名: 生成文件列表}"""
+        primary = next(iter(self.cleaners.values()))
+        chapters = primary.collect_chapters(start_idx, end_idx)
+        generated: Dict[str, List[str]] = {name: [] for name in self.cleaners}
+        if not chapters:
+            self.logger.warning(f"未找到可处理的任务")
+            return generated
+
+        self.logger.info(f"多变体清洗任务启动: {len(chapters)} 章节 x {len(self.cleaners)} 变体 ({', '.join(self.cleaners)})")
+        tasks_list = [self._fan_out(cf) for cf in chapters]
+        for f in tqdm.as_completed(tasks_list, total=len(tasks_list), desc=f"Cleaning {self.target_prefix} x{len(self.cleaners)}"):
+            results = await f
+            for name, res in results.items():
+                if res: generated[name].append(res)
+                self.cleaners[name].log_progress(len(chapters))
+
+        for name, cleaner in self.cleaners.items():
+            cleaner.label_ids(generated[name])
+        self.write_cost_report()
+        return generated
+
 if __name__ == "__main__":
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+增量转换清单 (Conversion Manifest)
+功能：记录 convert_to_lora.py 每个源文件的内容哈希及其在输出 JSONL 中对应的行/字节区间。
+再次转换同一输出时，只重新解析新增或变化的源文件，未变化部分直接从旧输出按字节区间拷贝。
+"""
+
+import os
+import json
+import hashlib
+from typing import Dict, Optional, Any
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path_for(output_path: str) -> str:
+    return os.path.splitext(output_path)[0] + ".manifest.json"
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(output_path: str) -> Optional[Dict[str, Any]]:
+    """读取清单；清单缺失、版本不符或输出文件已被改动时返回 None"""
+    path = manifest_path_for(output_path)
+    if not os.path.exists(path) or not os.path.exists(output_path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("output_size") != os.path.getsize(output_path):
+        return None
+    return manifest
+
+
+def save_manifest(output_path: str, files: Dict[str, Dict[str, Any]]):
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "output": os.path.basename(output_path),
+        "output_size": os.path.getsize(output_path),
+        "files": files,
+    }
+    path = manifest_path_for(output_path)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+class SourceTracker:
+    """
+    判断源文件是否需要重新解析。
+    先比较 (大小, 修改时间)；不一致时再计算 SHA1，内容未变 (例如仅被 touch) 的文件仍可复用。
+    hash_contents=False (非增量运行) 时记录中不计算 SHA1，下次增量运行只按 (大小, 修改时间) 判断。
+    """
+
+    def __init__(self, manifest: Optional[Dict[str, Any]] = None, hash_contents: bool = True):
+        self.previous: Dict[str, Dict[str, Any]] = (manifest or {}).get("files", {})
+        self.current: Dict[str, Dict[str, Any]] = {}
+        self.hash_contents = hash_contents
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.abspath(path)
+
+    def reusable(self, path: str, character: str) -> Optional[Dict[str, Any]]:
+        """返回可复用的旧记录 (含字节区间)，需要重新解析时返回 None"""
+        old = self.previous.get(self._key(path))
+        if not old or old.get("character") != character:
+            return None
+        stat = os.stat(path)
+        if old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+            return old
+        if old["size"] == stat.st_size and old.get("sha1") and old["sha1"] == file_digest(path):
+            return dict(old, mtime_ns=stat.st_mtime_ns)
+        return None
+
+    def record(self, path: str, character: str, rows: int, byte_start: int, byte_end: int,
+               sha1: Optional[str] = None):
+        stat = os.stat(path)
+        self.current[self._key(path)] = {
+            "character": character,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": sha1 or (file_digest(path) if self.hash_contents else None),
+            "rows": rows,
+            "byte_start": byte_start,
+            "byte_end": byte_end,
+        }
@@ -7,10 +7,19 @@
 import os
 import json
 import glob
+import time
 import datetime
 import argparse
 import re
-from typing import List, Dict, Any, Optional
+import functools
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple, Callable
+from dedup import MinHasher, NearDuplicateFilter, entry_text
+from dataset_shards import ShardedWriter, mix_copies, parse_mix
+from conversion_manifest import SourceTracker, load_manifest, save_manifest, manifest_path_for
+from dataset_catalog import DatasetCatalog
 
 # 获取当前脚本所在目录 (data_cleaning)
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -107,101 +116,77 @@ def construct_output(unit: Dict) -> Optional[str]:
     
     return " ".join(parts)
 
-def process_file(file_path: str, target_character: str) -> List[Dict]:
-    """处理单个文件，返回有效的样本列表"""
+def process_data(data: Dict, target_character: str, units: Optional[set] = None) -> List[Dict]:
+    """将已加载的中间态 JSON 对象转换为样本列表；units 为需要保留的交互单元下标 (None 表示全部)"""
     results = []
+    meta_info = data.get("meta_info", {})
+    interaction_units = data.get("interaction_units", [])
+    
+    for i, unit in enumerate(interaction_units):
+        if units is not None and i not in units:
+            continue
+        # 0. Check for New Direct Schema (Base/Hentai/Identity)
+        if "input" in unit and "output" in unit:
+            # Direct mapping: Input (Director Instruction) -> Instruction, Output -> Output
+            # The 'input' field in Alpaca JSONL is left empty as context is embedded in instruction
+            entry = {
+                "id": unit.get("global_id") or unit.get("id"),
+                "instruction": unit["input"],
+                "input": "",
+                "output": unit["output"]
+            }
+            results.append(entry)
+            continue
+
+        # 1. Construct Input (Legacy Schema)
+        inp = construct_input(unit)
+        if not inp:
+            continue
+            
+        # 2. Construct Output (includes validation for inner_monologue)
+        out = construct_output(unit)
+        if not out:
+            continue
+            
+        # 3. Construct Instruction
+        instr = construct_instruction(meta_info, unit, target_character)
+        
+        # 4. Get Global ID
+        global_id = unit.get("global_id")
+        
+        entry = {
+            "id": global_id,
+            "instruction": instr,
+            "input": inp,
+            "output": out
+        }
+        results.append(entry)
+        
+    return results
+
+def process_file(file_path: str, target_character: str, units: Optional[set] = None) -> List[Dict]:
+    """处理单个文件，返回有效的样本列表"""
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read().strip()
             if not content:
                 return []
             data = json.loads(content)
-            
-        meta_info = data.get("meta_info", {})
-        interaction_units = data.get("interaction_units", [])
-        
-        for unit in interaction_units:
-            # 0. Check for New Direct Schema (Base/Hentai/Identity)
-            if "input" in unit and "output" in unit:
-                # Direct mapping: Input (Director Instruction) -> Instruction, Output -> Output
-                # The 'input' field in Alpaca JSONL is left empty as context is embedded in instruction
-                entry = {
-                    "id": unit.get("global_id") or unit.get("id"),
-                    "instruction": unit["input"],
-                    "input": "",
-                    "output": unit["output"]
-                }
-                results.append(entry)
-                continue
-
-            # 1. Construct Input (Legacy Schema)
-            inp = construct_input(unit)
-            if not inp:
-                continue
-                
-            # 2. Construct Output (includes validation for inner_monologue)
-            out = construct_output(unit)
-            if not out:
-                continue
-                
-            # 3. Construct Instruction
-            instr = construct_instruction(meta_info, unit, target_character)
-            
-            # 4. Get Global ID
-            global_id = unit.get("global_id")
-            
-            entry = {
-                "id": global_id,
-                "instruction": instr,
-                "input": inp,
-                "output": out
-            }
-            results.append(entry)
-            
+        return process_data(data, target_character, units)
     except json.JSONDecodeError:
         pass # Ignore JSON errors
     except Exception as e:
         pass
         
-    return results
+    return []
 
 # ==========================================
-# 3. 主程序
+# 3. 流式并行处理
 # ==========================================
 
-def main():
-    parser = argparse.ArgumentParser(description="Convert intermediate novel data to LoRA JSONL format.")
-    parser.add_argument("--input", "-i", type=str, nargs='+', required=True, help="Input file or directory paths (can be multiple)")
-    parser.add_argument("--name", "-n", type=str, help="Target character name (overrides auto-detection)")
-    parser.add_argument("--output", "-o", type=str, help="Custom output filename (under lora_train_dataset/)")
-    args = parser.parse_args()
-    
-    input_paths = args.input
-    target_character = args.name
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # Setup Output Dir
-    output_dir = os.path.join(PROJECT_ROOT, "novel_data", "lora_train_dataset")
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Setup Logging
-    log_dir = os.path.join(PROJECT_ROOT, "logs")
-    os.makedirs(log_dir, exist_ok=True)
-    log_file = os.path.join(log_dir, f"conversion_{timestamp}.log")
-    
-    def log(msg):
-        print(msg)
-        try:
-            with open(log_file, 'a', encoding='utf-8') as f:
-                f.write(msg + "\n")
-        except:
-            pass
-            
-    # 2. Collect Files from all input paths
-    all_entries = []
-    total_file_count = 0
-    total_sample_count = 0
-    
+def collect_jobs(input_paths: List[str], target_character: Optional[str], log: Callable[[str], None]) -> List[Tuple[str, str]]:
+    """解析所有输入路径，返回 [(文件路径, 角色名)]，顺序即输出顺序"""
+    jobs = []
     for input_path in input_paths:
         # Check for existence, fallback to default directory if needed
         if not os.path.exists(input_path):
@@ -216,15 +201,14 @@ def main():
         if os.path.isfile(input_path):
             files_to_process.append(input_path)
         elif os.path.isdir(input_path):
-            files_to_process.extend(glob.glob(os.path.join(input_path, "**/*.txt"), recursive=True))
-            files_to_process.extend(glob.glob(os.path.join(input_path, "**/*.json"), recursive=True))
+            files_to_process.extend(sorted(glob.glob(os.path.join(input_path, "**/*.txt"), recursive=True)))
+            files_to_process.extend(sorted(glob.glob(os.path.join(input_path, "**/*.json"), recursive=True)))
         else:
             log(f"[Error] Input path not found: {input_path}")
             continue
 
         log(f"[Info] Found {len(files_to_process)} files in this path.")
 
-        # 3. Process Data for current path
         current_character = target_character
         if not current_character:
             # Try to infer from current path
@@ -238,40 +222,360 @@ def main():
                 current_character = config.get("target_character") or "Unknown"
                 log(f"[Info] Using fallback character for this path: {current_character}")
 
-        for fp in files_to_process:
-            entries = process_file(fp, current_character)
-            if entries:
-                all_entries.extend(entries)
-                total_file_count += 1
-                total_sample_count += len(entries)
+        jobs.extend((fp, current_character) for fp in files_to_process)
+    return jobs
+
+def interleave_jobs(groups: List[List[Tuple[str, str]]]) -> List[Tuple[str, str]]:
+    """
+    按各来源内的相对位置交错合并多个来源的任务列表，
+    使混合输出的每个分片都包含各来源的样本，而不是按来源首尾拼接。
+    """
+    keyed = []
+    for order, group in enumerate(groups):
+        n = len(group)
+        keyed.extend(((i + 0.5) / n, order, job) for i, job in enumerate(group))
+    keyed.sort(key=lambda k: (k[0], k[1]))
+    return [job for _, _, job in keyed]
+
+def _process_job(job: Tuple, hasher: Optional[MinHasher] = None) -> List[Dict]:
+    """
+    进程池工作函数；job 为 (文件路径, 角色名[, 交互单元下标])。
+    启用去重时顺带在子进程中计算 MinHash 签名 (_minhash)。
+    """
+    file_path, character = job[:2]
+    units = set(job[2]) if len(job) > 2 else None
+    entries = process_file(file_path, character, units)
+    if hasher is not None:
+        for entry in entries:
+            entry["_minhash"] = hasher.signature(entry_text(entry))
+    return entries
+
+def iter_processed(jobs: Iterable[Tuple[str, str]], workers: int = 1, window: Optional[int] = None,
+                   hasher: Optional[MinHasher] = None) -> Iterator[Tuple[str, List[Dict]]]:
+    """
+    按输入顺序产出 (文件路径, 样本列表)。
+    workers > 1 时使用进程池并行解析，最多同时挂起 window 个任务，
+    内存占用取决于进程池规模而非数据集大小。
+    """
+    task = functools.partial(_process_job, hasher=hasher)
+    if workers <= 1:
+        for job in jobs:
+            yield job[0], task(job)
+        return
+
+    window = window or workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append((job[0], pool.submit(task, job)))
+            if len(pending) >= window:
+                path, fut = pending.popleft()
+                yield path, fut.result()
+        while pending:
+            path, fut = pending.popleft()
+            yield path, fut.result()
+
+class JsonlWriter:
+    """逐条写入 JSONL，写入时连续分配 ID；先写临时文件，完成后原子替换"""
+
+    # 写出的每行均以 ID 开头 (见 process_data)，拷贝旧输出时只需替换该前缀
+    ID_PREFIX = re.compile(rb'^\{"id": -?\d+')
+
+    def __init__(self, output_path: str, start_id: int = 1):
+        self.output_path = output_path
+        self.tmp_path = output_path + ".tmp"
+        self.next_id = start_id
+        self.count = 0
+        self.bytes = 0
+        # 写出内容的 SHA1，供数据集目录登记
+        self.sha1 = hashlib.sha1()
+        self._f = open(self.tmp_path, 'wb')
+
+    def _write_line(self, line: bytes):
+        self._f.write(line)
+        self.sha1.update(line)
+        self.bytes += len(line)
+        self.count += 1
+
+    def write(self, entry: Dict):
+        # Re-index IDs to ensure uniqueness across merged datasets
+        entry["id"] = self.next_id
+        self.next_id += 1
+        self._write_line((json.dumps(entry, ensure_ascii=False) + "\n").encode('utf-8'))
+
+    def copy_rows(self, src, byte_start: int, byte_end: int):
+        """从旧输出的 [byte_start, byte_end) 区间拷贝已转换的行，并按当前位置重新编号"""
+        src.seek(byte_start)
+        pos = byte_start
+        while pos < byte_end:
+            line = src.readline()
+            if not line:
+                break
+            pos += len(line)
+            new_prefix = b'{"id": %d' % self.next_id
+            line, replaced = self.ID_PREFIX.subn(new_prefix, line, count=1)
+            if not replaced:
+                entry = json.loads(line)
+                entry["id"] = self.next_id
+                line = (json.dumps(entry, ensure_ascii=False) + "\n").encode('utf-8')
+            self.next_id += 1
+            self._write_line(line)
+
+    def close(self) -> bool:
+        """关闭文件；无任何样本时删除临时文件并返回 False"""
+        self._f.close()
+        if not self.count:
+            os.remove(self.tmp_path)
+            return False
+        os.replace(self.tmp_path, self.output_path)
+        return True
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+# ==========================================
+# 4. 主程序
+# ==========================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert intermediate novel data to LoRA JSONL format.")
+    parser.add_argument("--input", "-i", type=str, nargs='+', default=[], help="Input file or directory paths (can be multiple)")
+    parser.add_argument("--name", "-n", type=str, help="Target character name (overrides auto-detection)")
+    parser.add_argument("--output", "-o", type=str, help="Custom output filename (under lora_train_dataset/)")
+    parser.add_argument("--workers", "-w", type=int, default=os.cpu_count() or 1, help="Parallel parser processes (1 = serial)")
+    parser.add_argument("--dedup-threshold", type=float, help="Enable MinHash/LSH near-duplicate removal at this Jaccard threshold (e.g. 0.8)")
+    parser.add_argument("--dedup-perm", type=int, default=64, help="Number of MinHash permutations")
+    parser.add_argument("--dedup-shingle", type=int, default=5, help="Character shingle size for near-duplicate detection")
+    parser.add_argument("--mix", type=str, action="append", default=[], metavar="PATH=WEIGHT",
+                        help="Mix an input path with a sampling weight (e.g. cleaned_A=1 cleaned_B=0.5); implies sharded output")
+    parser.add_argument("--shard-size", type=int, default=0, help="Write a sharded output directory with at most N rows per shard")
+    parser.add_argument("--val-ratio", type=float, default=0.0, help="Deterministic hash-based validation split ratio (implies sharded output)")
+    parser.add_argument("--split-seed", type=str, default="", help="Salt for the hash-based split / mixing (change to reshuffle)")
+    parser.add_argument("--pretokenize", nargs="?", const="", metavar="TOKENIZER",
+                        help="Also export a pre-tokenized Arrow dataset for LLaMA-Factory tokenized_path "
+                             "(tokenizer defaults to model_name_or_path in lora_sft.yaml)")
+    parser.add_argument("--where", type=str,
+                        help="Only convert interaction units matching a unit_table filter, e.g. \"scene_type == 'Romance' and mood_state == '羞涩'\"")
+    parser.add_argument("--table", type=str,
+                        help="Unit table directory for --where; must cover the inputs and be up to date "
+                             "(without --table the default table is rebuilt when missing, incomplete or stale)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-parse new/changed source files and splice them into the existing --output (uses <output>.manifest.json)")
+    args = parser.parse_args()
+    if not args.input and not args.mix:
+        parser.error("at least one of --input or --mix is required")
+    try:
+        mix_sources = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    sharded = bool(args.shard_size or args.val_ratio or mix_sources)
+    if args.incremental and (sharded or args.dedup_threshold is not None or args.where or not args.output):
+        parser.error("--incremental requires --output and cannot be combined with sharded output, --dedup-threshold or --where")
+    
+    input_paths = args.input
+    target_character = args.name
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    # Setup Output Dir
+    output_dir = os.path.join(PROJECT_ROOT, "novel_data", "lora_train_dataset")
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Setup Logging
+    log_dir = os.path.join(PROJECT_ROOT, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f"conversion_{timestamp}.log")
     
-    # Re-index IDs to ensure uniqueness across merged datasets
-    log(f"[Info] Re-indexing {len(all_entries)} entries to ensure unique IDs...")
-    for idx, entry in enumerate(all_entries, 1):
-        entry["id"] = idx
+    def log(msg):
+        print(msg)
+        try:
+            with open(log_file, 'a', encoding='utf-8') as f:
+                f.write(msg + "\n")
+        except:
+            pass
             
-    # 4. Write Output
-    if not all_entries:
-        log("[Warning] No valid data extracted.")
-        return
+    # 2. Collect Files from all input paths (each --mix source keeps its own weight)
+    sources = [(p, 1.0) for p in input_paths] + mix_sources
+    groups = []
+    weights: Dict[str, Tuple[str, float]] = {}
+    for source, weight in sources:
+        group = collect_jobs([source], target_character, log)
+        groups.append(group)
+        weights.update((fp, (source, weight)) for fp, _ in group)
+    weights_by_source = dict(sources)
+    jobs = interleave_jobs(groups) if mix_sources else [job for group in groups for job in group]
+
+    # Optional subset selection through the columnar unit table
+    if args.where:
+        from unit_table import UnitTable, FilterError, build_table, DEFAULT_TABLE_DIR
+        table_dir = args.table or DEFAULT_TABLE_DIR
+        table, reason = None, "not found"
+        if os.path.exists(os.path.join(table_dir, "columns.json")):
+            try:
+                table = UnitTable.load(table_dir)
+            except (OSError, ValueError, KeyError) as e:
+                reason = f"unreadable ({e})"
+        if table is not None:
+            # The table must cover every input file and match its current contents, otherwise unit_index is unreliable
+            missing = table.missing_files(fp for fp, _ in jobs)
+            stale = table.stale_files()
+            if missing or stale:
+                reason = f"{len(missing)} input files not in the table, {len(stale)} changed since it was built"
+                table = None
+        if table is None:
+            if args.table:
+                log(f"[Error] Unit table {table_dir} is {reason}; rebuild it with unit_table.py build")
+                return
+            log(f"[Info] Unit table {reason}, rebuilding from the inputs: {table_dir}")
+            table = build_table([p for p, _ in sources], args.workers, log)
+            table.save(table_dir)
+        try:
+            t0 = time.perf_counter()
+            selected = table.selected_units(table.select(args.where))
+        except FilterError as e:
+            log(f"[Error] {e}")
+            return
+        jobs = [(fp, ch, tuple(selected[os.path.abspath(fp)])) for fp, ch in jobs if os.path.abspath(fp) in selected]
+        log(f"[Where] {sum(len(job[2]) for job in jobs)} units in {len(jobs)} files matched in {(time.perf_counter() - t0) * 1000:.1f} ms")
 
     if args.output:
         output_filename = args.output
     else:
         # Use first character name if multiple might exist
         display_name = target_character or "merged"
-        output_filename = f"lora_dataset_{display_name}_{timestamp}.jsonl"
+        output_filename = f"lora_dataset_{display_name}_{timestamp}" + ("" if sharded else ".jsonl")
         
     output_path = os.path.join(output_dir, output_filename)
-    
+
+    # Optional near-duplicate filter (signatures are computed inside the worker processes)
+    dedup = None
+    if args.dedup_threshold is not None:
+        dedup = NearDuplicateFilter(threshold=args.dedup_threshold, num_perm=args.dedup_perm, shingle_size=args.dedup_shingle)
+        log(f"[Info] Near-duplicate removal enabled: threshold={dedup.threshold}, bands={dedup.bands} x rows={dedup.rows}")
+
+    # Single-file output keeps a per-source manifest so later runs can be incremental
+    tracker = None
+    reuse: Dict[str, Dict] = {}
+    parse_jobs = jobs
+    if not sharded and not dedup and not args.where:
+        previous = load_manifest(output_path) if args.incremental else None
+        if args.incremental and previous is None:
+            log(f"[Info] No usable manifest for {output_filename}, running a full conversion.")
+        # 非增量运行只记录 (大小, 修改时间)，不在主进程中逐个计算 SHA1
+        tracker = SourceTracker(previous, hash_contents=args.incremental)
+        if previous:
+            for fp, character in jobs:
+                record = tracker.reusable(fp, character)
+                if record:
+                    reuse[fp] = record
+            parse_jobs = [job for job in jobs if job[0] not in reuse]
+            removed = len(set(tracker.previous) - {os.path.abspath(fp) for fp, _ in jobs})
+            log(f"[Incremental] Reusing {len(reuse)} unchanged files, parsing {len(parse_jobs)} new/changed files, dropping {removed} removed files.")
+
+    # 3. Stream: parse in a process pool, write in input order, assign IDs on the fly
+    total_file_count = 0
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for entry in all_entries:
-                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-        log(f"[Success] Total processed {total_file_count} files, generated {total_sample_count} samples.")
-        log(f"[Output] Saved to: {output_path}")
+        if sharded:
+            writer = ShardedWriter(output_path, shard_size=args.shard_size, val_ratio=args.val_ratio, seed=args.split_seed)
+        else:
+            writer = JsonlWriter(output_path)
     except Exception as e:
         log(f"[Error] Failed to write output file: {e}")
+        return
+    old_output = open(output_path, 'rb') if reuse else None
+    parsed = iter_processed(parse_jobs, workers=args.workers, hasher=dedup.hasher if dedup else None)
+    try:
+        for path, character, *_ in jobs:
+            if path in reuse:
+                # Unchanged source: copy its rows from the previous output without re-parsing
+                record = reuse[path]
+                start = writer.bytes
+                writer.copy_rows(old_output, record["byte_start"], record["byte_end"])
+                tracker.record(path, character, record["rows"], start, writer.bytes, sha1=record["sha1"])
+                if record["rows"]:
+                    total_file_count += 1
+                continue
+
+            _, entries = next(parsed)
+            if entries:
+                total_file_count += 1
+            start, rows_before = (writer.bytes, writer.count) if tracker else (0, 0)
+            source, weight = weights[path]
+            for entry in entries:
+                if dedup and not dedup.add(entry):
+                    continue
+                if sharded:
+                    writer.write(entry, copies=mix_copies(entry, weight, args.split_seed), source=source)
+                else:
+                    writer.write(entry)
+            if tracker:
+                tracker.record(path, character, writer.count - rows_before, start, writer.bytes)
+    except Exception as e:
+        writer.abort()
+        log(f"[Error] Failed to write output file: {e}")
+        return
+    finally:
+        parsed.close()
+        if old_output:
+            old_output.close()
+
+    # 4. Finalize Output
+    if not writer.close():
+        log("[Warning] No valid data extracted.")
+        return
+    log(f"[Success] Total processed {total_file_count} files, generated {writer.count} samples.")
+    log(f"[Output] Saved to: {output_path}")
+    if tracker:
+        save_manifest(output_path, tracker.current)
+        log(f"[Manifest] Saved to: {manifest_path_for(output_path)}")
+
+    # Register the new dataset in the catalog (rows / hash / lineage) for DataInterface lookups
+    lineage = {
+        "inputs": [{"path": os.path.abspath(p), "weight": w} for p, w in sources],
+        "character": target_character,
+        "where": args.where,
+        "dedup_threshold": args.dedup_threshold,
+        "shard_size": args.shard_size or None,
+        "val_ratio": args.val_ratio or None,
+        "split_seed": args.split_seed or None,
+    }
+    try:
+        extra = {"splits": writer.counts} if sharded else {"bytes": writer.bytes}
+        DatasetCatalog(output_dir).record(output_path, writer.count, writer.sha1.hexdigest(),
+                                          kind="sharded" if sharded else "jsonl",
+                                          lineage={k: v for k, v in lineage.items() if v is not None}, **extra)
+    except OSError as e:
+        log(f"[Warning] Failed to update dataset catalog: {e}")
+    if sharded:
+        manifest = writer.manifest()
+        shard_counts = {split: len(files) for split, files in manifest["shards"].items()}
+        log(f"[Shards] Rows: {manifest['rows']} | Shards: {shard_counts}")
+        for source, stat in manifest["sources"].items():
+            log(f"[Mix]   {source}: weight={weights_by_source[source]} input={stat['input']} -> train={stat['train']} val={stat['val']}")
+
+    if args.pretokenize is not None:
+        from pretokenize import export_pretokenized, default_output_for
+        from token_index import read_sft_setting
+        tokenizer_path = args.pretokenize or read_sft_setting("model_name_or_path")
+        cutoff_len = int(read_sft_setting("cutoff_len") or 2048)
+        try:
+            meta = export_pretokenized(output_path, tokenizer_path, cutoff_len=cutoff_len, workers=args.workers,
+                                       template=read_sft_setting("template"))
+            log(f"[Pretokenize] {meta['rows']} rows, {meta['tokens']} tokens -> {default_output_for(output_path)}")
+        except Exception as e:
+            log(f"[Error] Pre-tokenization failed: {e}")
+
+    if dedup:
+        report = dedup.report()
+        log(f"[Dedup] Kept {report['kept']}, removed {report['dropped']} near-duplicates. Cluster sizes: {report['cluster_size_histogram']}")
+        for cluster in report["largest_clusters"]:
+            log(f"[Dedup]   size={cluster['size']} | {cluster['sample']}")
+        report_path = (os.path.join(output_path, "dedup.json") if sharded
+                       else os.path.splitext(output_path)[0] + ".dedup.json")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        log(f"[Dedup] Report saved to: {report_path}")
 
 if __name__ == "__main__":
     main()
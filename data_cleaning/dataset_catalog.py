@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+数据集目录 (Dataset Catalog)
+功能：在 lora_train_dataset/catalog.json 中记录每个生成的训练集 (JSONL 或分片目录) 的行数、内容哈希、
+Token 统计与来源 (输入目录、转换参数)，由写出端在生成时登记。
+DataInterface 通过目录直接取得最新数据集及其元信息，无需扫描目录；所有读改写操作均在文件锁内完成并原子替换。
+"""
+
+import os
+import json
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# 获取当前脚本所在目录 (data_cleaning)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 获取项目根目录 (即 data_cleaning 的上一级)
+PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
+DEFAULT_DATASET_DIR = os.path.join(PROJECT_ROOT, "novel_data", "lora_train_dataset")
+
+CATALOG_NAME = "catalog.json"
+CATALOG_VERSION = 1
+
+
+@contextmanager
+def file_lock(path: str):
+    """以 <path>.lock 为锁文件的进程间排他锁 (阻塞等待)"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_json_atomic(path: str, data: Any):
+    """先写临时文件再替换，读者永远看不到写了一半的 JSON"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _fingerprint(path: str) -> Optional[List[int]]:
+    """文件取 (大小, 修改时间)；分片目录取 manifest.json 的 (大小, 修改时间)"""
+    target = os.path.join(path, "manifest.json") if os.path.isdir(path) else path
+    try:
+        stat = os.stat(target)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class DatasetCatalog:
+    """
+    数据集目录。
+    - 写出端调用 `record` 登记新数据集，并成为 `latest`；
+    - 其他阶段 (Token 统计、注册) 调用 `update` 补充字段；
+    - `get` / `latest` 读取时校验文件指纹，文件被改动或删除的条目视为失效。
+    """
+
+    def __init__(self, dataset_dir: str = DEFAULT_DATASET_DIR):
+        self.dataset_dir = dataset_dir
+        self.path = os.path.join(dataset_dir, CATALOG_NAME)
+
+    def key_for(self, dataset_path: str) -> str:
+        """目录内的数据集以相对路径为键，其余使用绝对路径"""
+        path = os.path.abspath(dataset_path.rstrip("/\\"))
+        rel = os.path.relpath(path, os.path.abspath(self.dataset_dir))
+        return path if rel.startswith("..") or os.path.isabs(rel) else rel
+
+    def path_for(self, key: str) -> str:
+        return key if os.path.isabs(key) else os.path.join(self.dataset_dir, key)
+
+    def load(self) -> Dict[str, Any]:
+        """读取快照 (无需加锁：写入端总是原子替换)；目录损坏或版本不符时返回空目录"""
+        try:
+            return self._read()
+        except (OSError, ValueError):
+            return self._empty()
+
+    @staticmethod
+    def _empty() -> Dict[str, Any]:
+        return {"version": CATALOG_VERSION, "latest": None, "datasets": {}}
+
+    def _read(self) -> Dict[str, Any]:
+        """严格读取：文件不存在时返回空目录，损坏或版本不符时抛出 ValueError"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return self._empty()
+        if not isinstance(data, dict) or not isinstance(data.get("datasets"), dict):
+            raise ValueError("目录结构损坏")
+        if data.get("version") != CATALOG_VERSION:
+            raise ValueError(f"目录版本不兼容: {data.get('version')} (当前 {CATALOG_VERSION})")
+        return data
+
+    @contextmanager
+    def transaction(self):
+        """
+        加锁读改写：在 with 块内修改返回的字典，退出时原子写回。
+        现有目录损坏或版本不符时先改名备份为 catalog.json.corrupt-<时间戳>，不会被空目录直接覆盖。
+        """
+        with file_lock(self.path):
+            try:
+                data = self._read()
+            except ValueError as e:
+                backup = base = f"{self.path}.corrupt-{time.strftime('%Y%m%d_%H%M%S')}"
+                n = 1
+                while os.path.exists(backup):
+                    backup, n = f"{base}_{n}", n + 1
+                os.replace(self.path, backup)
+                print(f"[Warning] 数据集目录无法读取 ({e})，已备份为 {backup} 并重新创建")
+                data = self._empty()
+            yield data
+            write_json_atomic(self.path, data)
+
+    def record(self, dataset_path: str, rows: int, sha1: str, kind: str = "jsonl",
+               lineage: Optional[Dict[str, Any]] = None, **fields) -> Dict[str, Any]:
+        """登记新生成的数据集并设为最新"""
+        key = self.key_for(dataset_path)
+        entry = {
+            "path": os.path.abspath(dataset_path),
+            "kind": kind,
+            "rows": rows,
+            "sha1": sha1,
+            "fingerprint": _fingerprint(dataset_path),
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "lineage": lineage or {},
+        }
+        entry.update(fields)
+        with self.transaction() as data:
+            data["datasets"][key] = entry
+            data["latest"] = key
+        return entry
+
+    def update(self, dataset_path: str, **fields) -> bool:
+        """为已登记的数据集补充字段；未登记时返回 False"""
+        key = self.key_for(dataset_path)
+        with self.transaction() as data:
+            entry = data["datasets"].get(key)
+            if entry is None:
+                return False
+            entry.update(fields)
+        return True
+
+    def _valid(self, entry: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if entry and entry.get("fingerprint") == _fingerprint(entry["path"]):
+            return entry
+        return None
+
+    def get(self, dataset_path: str) -> Optional[Dict[str, Any]]:
+        """按路径 (或目录内的相对名称) 查询，条目失效时返回 None"""
+        datasets = self.load()["datasets"]
+        entry = datasets.get(dataset_path) or datasets.get(self.key_for(dataset_path))
+        return self._valid(entry)
+
+    def latest(self) -> Optional[Dict[str, Any]]:
+        """最近登记且仍然有效的数据集"""
+        data = self.load()
+        return self._valid(data["datasets"].get(data.get("latest") or ""))
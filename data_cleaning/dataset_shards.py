@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+分片输出 (Sharded Dataset Writer)
+功能：将转换后的样本写为若干个大小受限的 JSONL 分片，并按内容哈希确定性地划分训练集/验证集；
+支持按权重混合多个角色/变体来源 (权重 > 1 重复采样，< 1 按哈希确定性抽样)。
+输出目录结构：
+    <输出目录>/train/part-00000.jsonl ...
+    <输出目录>/val/part-00000.jsonl ...
+    <输出目录>/manifest.json
+train/ 与 val/ 可分别作为 LLaMA-Factory 的 dataset / eval_dataset (file_name 指向目录)。
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from typing import Dict, List, Optional
+
+SPLIT_TRAIN = "train"
+SPLIT_VAL = "val"
+MANIFEST_NAME = "manifest.json"
+
+
+def content_hash(entry: Dict, salt: str = "") -> float:
+    """样本内容 (instruction/input/output) 的哈希，映射到 [0, 1)；与 ID、文件顺序无关"""
+    h = hashlib.sha1(salt.encode('utf-8'))
+    for field in ("instruction", "input", "output"):
+        h.update(entry.get(field, "").encode('utf-8'))
+        h.update(b"\x00")
+    return int.from_bytes(h.digest()[:8], "big") / 2 ** 64
+
+
+def assign_split(entry: Dict, val_ratio: float, seed: str = "") -> str:
+    """按内容哈希划分，同一内容在多次运行中始终落在同一侧"""
+    if val_ratio <= 0:
+        return SPLIT_TRAIN
+    return SPLIT_VAL if content_hash(entry, "split:" + seed) < val_ratio else SPLIT_TRAIN
+
+
+def mix_copies(entry: Dict, weight: float, seed: str = "") -> int:
+    """
+    权重对应的采样次数：整数部分直接重复，小数部分按内容哈希决定是否再多取一份。
+    例如 weight=2.5 时一半样本出现 3 次、另一半出现 2 次；weight=0.3 时约 30% 的样本被保留。
+    """
+    if weight <= 0:
+        return 0
+    whole = int(weight)
+    frac = weight - whole
+    return whole + (1 if frac and content_hash(entry, "mix:" + seed) < frac else 0)
+
+
+def parse_mix(specs: List[str]) -> List[tuple]:
+    """解析 --mix 参数 ("路径=权重")，返回 [(路径, 权重)]"""
+    result = []
+    for spec in specs:
+        path, sep, weight = spec.rpartition("=")
+        if not sep or not path:
+            raise ValueError(f"混合参数格式应为 路径=权重: {spec}")
+        try:
+            result.append((path, float(weight)))
+        except ValueError:
+            raise ValueError(f"混合权重不是数字: {spec}")
+    return result
+
+
+class ShardedWriter:
+    """
+    与 convert_to_lora.JsonlWriter 接口一致的分片写出器 (write / close / abort / count)。
+    先写入 <输出目录>.tmp，完成后整体替换，中途失败不会留下半成品目录。
+    """
+
+    def __init__(self, output_dir: str, shard_size: int = 0, val_ratio: float = 0.0,
+                 seed: str = "", start_id: int = 1):
+        self.output_dir = output_dir.rstrip("/\\")
+        self.tmp_dir = self.output_dir + ".tmp"
+        self.shard_size = shard_size
+        self.val_ratio = val_ratio
+        self.seed = seed
+        self.next_id = start_id
+        self.count = 0
+        self.counts = {SPLIT_TRAIN: 0, SPLIT_VAL: 0}
+        # 按写入顺序累计的内容 SHA1，供数据集目录登记
+        self.sha1 = hashlib.sha1()
+        self._files: Dict[str, List[Dict]] = {SPLIT_TRAIN: [], SPLIT_VAL: []}
+        self._handles: Dict[str, Optional[object]] = {SPLIT_TRAIN: None, SPLIT_VAL: None}
+        self.sources: Dict[str, Dict] = {}
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+
+    def _handle(self, split: str):
+        """返回当前分片文件，达到 shard_size 时滚动到下一个分片"""
+        files = self._files[split]
+        f = self._handles[split]
+        if f is not None and self.shard_size and files[-1]["rows"] >= self.shard_size:
+            f.close()
+            f = None
+        if f is None:
+            name = f"part-{len(files):05d}.jsonl"
+            os.makedirs(os.path.join(self.tmp_dir, split), exist_ok=True)
+            f = open(os.path.join(self.tmp_dir, split, name), 'w', encoding='utf-8')
+            files.append({"file": f"{split}/{name}", "rows": 0})
+            self._handles[split] = f
+        return f
+
+    def write(self, entry: Dict, copies: int = 1, source: Optional[str] = None):
+        """写入样本；copies 为混合采样次数 (验证集不重复，最多写 1 份)"""
+        split = assign_split(entry, self.val_ratio, self.seed)
+        if split == SPLIT_VAL:
+            copies = min(copies, 1)
+        if source is not None:
+            stat = self.sources.setdefault(source, {"input": 0, SPLIT_TRAIN: 0, SPLIT_VAL: 0})
+            stat["input"] += 1
+            stat[split] += copies
+        for _ in range(copies):
+            f = self._handle(split)
+            row = dict(entry, id=self.next_id)
+            self.next_id += 1
+            line = json.dumps(row, ensure_ascii=False) + "\n"
+            f.write(line)
+            self.sha1.update(line.encode('utf-8'))
+            self._files[split][-1]["rows"] += 1
+            self.counts[split] += 1
+            self.count += 1
+
+    def manifest(self) -> Dict:
+        return {
+            "val_ratio": self.val_ratio,
+            "shard_size": self.shard_size,
+            "seed": self.seed,
+            "rows": dict(self.counts),
+            "shards": {split: files for split, files in self._files.items() if files},
+            "sources": self.sources,
+        }
+
+    def _close_handles(self):
+        for split, f in self._handles.items():
+            if f is not None:
+                f.close()
+                self._handles[split] = None
+
+    def close(self) -> bool:
+        """关闭所有分片并写入 manifest.json；无任何样本时删除临时目录并返回 False"""
+        self._close_handles()
+        if not self.count:
+            shutil.rmtree(self.tmp_dir)
+            return False
+        with open(os.path.join(self.tmp_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(self.manifest(), f, ensure_ascii=False, indent=2)
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.replace(self.tmp_dir, self.output_dir)
+        return True
+
+    def abort(self):
+        self._close_handles()
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+近重复样本检测 (Near-Duplicate Detection)
+功能：基于 MinHash + LSH 分桶检测 instruction/output 高度相似的样本，用于合并多个 cleaned_* 目录时去重。
+复杂度：每条样本的签名计算与分桶查询均为常数开销，整体随样本数线性增长。
+说明：安装 numpy 时签名计算走向量化路径，否则回退纯 Python 实现，两者结果一致。
+"""
+
+import zlib
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MASK64 = (1 << 64) - 1
+
+
+def entry_text(entry: Dict) -> str:
+    """参与去重比较的文本：instruction + input + output"""
+    return "\n".join((entry.get("instruction", ""), entry.get("input", ""), entry.get("output", "")))
+
+
+def choose_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """选择 (bands, rows)，使 LSH 的 S 曲线拐点 (1/b)^(1/r) 最接近目标阈值"""
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        knee = (1.0 / bands) ** (1.0 / rows)
+        if best is None or abs(knee - threshold) < best[0]:
+            best = (abs(knee - threshold), bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """字符 k-gram 的 MinHash 签名，使用 multiply-shift 哈希族模拟 num_perm 个随机置换"""
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # 确定性参数，保证多次运行 / 多进程之间签名一致
+        rng_state = seed
+        params = []
+        for _ in range(num_perm * 2):
+            rng_state = (rng_state * 6364136223846793005 + 1442695040888963407) & MASK64
+            params.append(rng_state)
+        self._a = [p | 1 for p in params[:num_perm]]  # 乘数需为奇数
+        self._b = params[num_perm:]
+        if np is not None:
+            self._np_a = np.array(self._a, dtype=np.uint64)[:, None]
+            self._np_b = np.array(self._b, dtype=np.uint64)[:, None]
+
+    def _shingle_hashes(self, text: str) -> List[int]:
+        text = "".join(text.split())  # 忽略空白差异
+        k = self.shingle_size
+        if len(text) <= k:
+            grams = {text}
+        else:
+            grams = {text[i:i + k] for i in range(len(text) - k + 1)}
+        return [zlib.crc32(g.encode('utf-8')) for g in grams]
+
+    def signature(self, text: str) -> array:
+        """返回长度为 num_perm 的 uint32 签名"""
+        hashes = self._shingle_hashes(text)
+        if np is not None:
+            h = np.array(hashes, dtype=np.uint64)[None, :]
+            with np.errstate(over='ignore'):
+                mins = ((self._np_a * h + self._np_b) >> np.uint64(32)).min(axis=1)
+            return array('I', mins.astype(np.uint32).tobytes())
+        return array('I', (
+            min(((a * x + b) & MASK64) >> 32 for x in hashes)
+            for a, b in zip(self._a, self._b)
+        ))
+
+
+class NearDuplicateFilter:
+    """
+    流式近重复过滤器：依次喂入样本签名，保留每个相似簇中首次出现的样本。
+    LSH 命中后再用签名估计 Jaccard 相似度复核，避免分桶碰撞造成误删。
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, shingle_size: int = 5, verify: bool = True):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.verify = verify
+        self.hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        # (band 序号, band 哈希) -> 代表样本序号
+        self._buckets: Dict[int, int] = {}
+        # 代表样本 (被保留样本) 的签名，连续存放以节省内存
+        self._signatures = array('I')
+        self._labels: List[str] = []
+        self.cluster_sizes = Counter()
+        self.kept = 0
+        self.dropped = 0
+
+    def _similarity(self, sig: array, rep: int) -> float:
+        start = rep * self.num_perm
+        stored = self._signatures[start:start + self.num_perm]
+        return sum(1 for x, y in zip(sig, stored) if x == y) / self.num_perm
+
+    def check(self, sig: array, label: str = "") -> bool:
+        """返回 True 表示保留 (新簇)，False 表示与已保留样本近重复"""
+        keys = []
+        candidates = []
+        for band in range(self.bands):
+            chunk = tuple(sig[band * self.rows:(band + 1) * self.rows])
+            key = hash((band, chunk))
+            keys.append(key)
+            rep = self._buckets.get(key)
+            if rep is not None and rep not in candidates:
+                candidates.append(rep)
+
+        for rep in candidates:
+            if not self.verify or self._similarity(sig, rep) >= self.threshold:
+                self.cluster_sizes[rep] += 1
+                self.dropped += 1
+                return False
+
+        rep = self.kept
+        self._signatures.extend(sig)
+        self._labels.append(label)
+        self.cluster_sizes[rep] = 1
+        for key in keys:
+            self._buckets.setdefault(key, rep)
+        self.kept += 1
+        return True
+
+    def add(self, entry: Dict) -> bool:
+        """对样本执行去重判断；若 entry 中已携带预计算签名 (_minhash) 则直接使用并移除该字段"""
+        sig = entry.pop("_minhash", None)
+        if sig is None:
+            sig = self.hasher.signature(entry_text(entry))
+        return self.check(sig, label=entry.get("instruction", "")[:40])
+
+    def report(self, top: int = 10) -> Dict:
+        """簇大小分布与最大的若干簇"""
+        histogram = Counter(self.cluster_sizes.values())
+        largest = [
+            {"size": size, "sample": self._labels[rep]}
+            for rep, size in self.cluster_sizes.most_common(top) if size > 1
+        ]
+        return {
+            "threshold": self.threshold,
+            "num_perm": self.num_perm,
+            "bands": self.bands,
+            "rows": self.rows,
+            "kept": self.kept,
+            "dropped": self.dropped,
+            "cluster_size_histogram": {str(k): v for k, v in sorted(histogram.items())},
+            "largest_clusters": largest,
+        }
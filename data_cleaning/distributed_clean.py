@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+分布式清洗脚本 (Coordinator / Worker)
+功能：协调端将章节写入共享 SQLite 任务队列；多台机器上的 Worker 以租约方式认领章节、调用 API 清洗并提交结果。
+租约过期的章节会被重新认领；各 Worker 的 Token 与费用统计汇总到队列中。
+
+用法示例:
+    # 协调端 (写入任务并等待完成，可顺带在本机启动 N 个 Worker 进程用于测试)
+    python data_cleaning/distributed_clean.py coordinator --db /mnt/shared/queue.db --prefix 03 --local-workers 3
+    # 其他机器上的 Worker (需挂载相同的 novel_data 与队列数据库)
+    python data_cleaning/distributed_clean.py worker --db /mnt/shared/queue.db
+    # 查看进度与汇总统计
+    python data_cleaning/distributed_clean.py status --db /mnt/shared/queue.db
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import uuid
+import asyncio
+import logging
+import argparse
+import datetime
+import subprocess
+from clean_novel_data import NovelCleaner, Config, load_nicknames, collect_chapter_files, label_interaction_ids
+from validate_data import validate_one
+from work_queue import WorkQueue
+
+# 获取当前脚本所在目录 (data_cleaning)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 获取项目根目录 (即 data_cleaning 的上一级)
+PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
+DEFAULT_DB = os.path.join(PROJECT_ROOT, "novel_data", ".queue", "clean_queue.db")
+
+logger = logging.getLogger("distributed")
+
+
+def setup_logging(role: str):
+    """初始化日志 (控制台 + logs/distributed_{role}_{时间戳}.log)"""
+    log_dir = os.path.join(PROJECT_ROOT, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    log_filename = os.path.join(log_dir, f"distributed_{role}_{timestamp}_{os.getpid()}.log")
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+        handlers=[
+            logging.FileHandler(log_filename, encoding='utf-8'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+
+def load_config(config_file=None):
+    """加载外部 JSON 配置文件"""
+    if config_file is None:
+        config_file = os.path.join(CURRENT_DIR, "config.json")
+
+    if os.path.exists(config_file):
+        try:
+            with open(config_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"无法读取配置文件 {config_file}: {e}")
+    return {}
+
+# ==========================================
+# 1. 协调端
+# ==========================================
+
+def spawn_local_workers(args) -> list:
+    """在本机启动若干 Worker 子进程 (用于单机测试分布式流程)"""
+    procs = []
+    for i in range(args.local_workers):
+        cmd = [sys.executable, os.path.abspath(__file__), "worker",
+               "--db", args.db,
+               "--worker-id", f"{socket.gethostname()}-local{i}",
+               "--lease", str(args.lease),
+               "--concurrency", str(args.concurrency),
+               "--max-attempts", str(args.max_attempts)]
+        procs.append(subprocess.Popen(cmd))
+    logger.info(f"已在本机启动 {len(procs)} 个 Worker 进程")
+    return procs
+
+
+def finalize(queue: WorkQueue, meta: dict):
+    """全部章节处理完成后：统一标记全局序号、校验并写入汇总报告"""
+    results = [os.path.join(Config.LORA_DATASET_DIR, p) for p in queue.results()]
+    label_interaction_ids(results, logger=logger)
+
+    schema_file = os.path.join(CURRENT_DIR, "prompts", meta["schema"])
+    passed = sum(1 for p in results if validate_one(p, schema_file=schema_file))
+
+    progress = queue.progress()
+    stats = queue.aggregate_stats()
+    report = {"output_root": meta["output_dir"], "progress": progress, **stats}
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    report_path = os.path.join(Config.LORA_DATASET_DIR, f"cost_report_{meta['character']}_{meta['target_prefix']}_{timestamp}.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    total = stats["total"]
+    logger.info("=== 分布式清洗汇总 ===")
+    for w in stats["workers"]:
+        logger.info(f"[{w['worker']}] 成功:{w['success']} 失败:{w['failed']} 跳过/空:{w['skipped']} | 成本: {w['cost_cny']:.2f} CNY")
+    logger.info(f"[合计] 完成:{progress['done']} 放弃:{progress['failed']} | 校验通过: {passed}/{len(results)} | 成本: {total['cost_cny']:.2f} CNY")
+    logger.info(f"输出目录: {os.path.join(Config.LORA_DATASET_DIR, meta['output_dir'])}")
+    logger.info(f"汇总报告: {report_path}")
+
+
+def run_coordinator(args):
+    config = load_config()
+    target_prefix = args.prefix if args.prefix else config.get("target_prefix")
+    start = args.start if args.start is not None else config.get("start_chapter")
+    end = args.end if args.end is not None else config.get("end_chapter")
+    character = args.character or config.get("target_character") or "叶灵静"
+    novel = args.novel or config.get("source_novel") or "隐杀"
+    force_refresh = False if args.no_refresh else config.get("force_refresh", True)
+
+    chapters = collect_chapter_files(target_prefix, start, end, logger=logger)
+    if not chapters:
+        logger.warning("未找到可处理的章节。")
+        return
+
+    # 共享缓存只在协调端清空一次，Worker 启动时不会再清空
+    if force_refresh and os.path.exists(Config.CACHE_DIR):
+        shutil.rmtree(Config.CACHE_DIR, ignore_errors=True)
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    meta = {
+        "character": character,
+        "source_novel": novel,
+        "target_prefix": target_prefix or "full",
+        "instruction": args.instruction or "prompt_instruction.txt",
+        "schema": args.schema or "output_schema.txt",
+        "force_refresh": force_refresh,
+        "output_dir": f"cleaned_{character}_{target_prefix or 'full'}_{timestamp}",
+    }
+    queue = WorkQueue(args.db)
+    # 每次协调端启动都是新的运行：旧运行中已完成的章节会重新处理，汇总也只包含本次运行
+    run_id = queue.start_run(meta)
+    # 队列中保存相对切分目录的路径，不同机器的挂载点可以不同
+    added = queue.enqueue([os.path.relpath(c, Config.BASE_INPUT_DIR) for c in chapters])
+    logger.info(f"已写入 {added} 个章节任务 (队列: {args.db} | 运行: {run_id})")
+
+    procs = spawn_local_workers(args) if args.local_workers else []
+
+    while not queue.is_drained():
+        p = queue.progress()
+        logger.info(f"进度: 完成 {p['done']}/{p['total']} | 处理中 {p['leased']} | 待认领 {p['pending']} | 放弃 {p['failed']}")
+        if procs and all(proc.poll() is not None for proc in procs):
+            logger.error("本机 Worker 已全部退出，但队列仍有未完成任务")
+            break
+        time.sleep(args.poll)
+
+    for proc in procs:
+        proc.wait()
+    finalize(queue, queue.get_meta())
+
+# ==========================================
+# 2. Worker
+# ==========================================
+
+async def run_worker(args):
+    queue = WorkQueue(args.db)
+    meta = queue.get_meta()
+    if not meta:
+        logger.error(f"队列未初始化，请先运行 coordinator: {args.db}")
+        return
+
+    worker_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    host = socket.gethostname()
+    session = uuid.uuid4().hex[:8]
+    character = meta["character"]
+    cleaner = NovelCleaner(
+        target_prefix=meta["target_prefix"],
+        char_name=character,
+        nickname_list=load_nicknames(character, meta["source_novel"]),
+        source_novel=meta["source_novel"],
+        prompt_instruction_file=os.path.join(CURRENT_DIR, "prompts", meta["instruction"]),
+        output_schema_file=os.path.join(CURRENT_DIR, "prompts", meta["schema"]),
+        force_refresh=False,
+        output_root=os.path.join(Config.LORA_DATASET_DIR, meta["output_dir"]),
+        semaphore=asyncio.Semaphore(args.concurrency),
+    )
+    # 缓存已由协调端统一清空，这里只决定是否读取缓存
+    cleaner.force_refresh = meta["force_refresh"]
+    logger.info(f"Worker {worker_id} 启动 | 运行: {queue.run_id} | 并发: {args.concurrency} | 租约: {args.lease}s")
+
+    in_flight = {}
+
+    async def process(chapter: str):
+        chapter_file = os.path.join(Config.BASE_INPUT_DIR, chapter)
+        res = await cleaner.process_chapter(chapter_file, cleaner.output_path_for(chapter_file), character)
+        if res:
+            rel = os.path.relpath(res, Config.LORA_DATASET_DIR)
+            if not await asyncio.to_thread(queue.complete, chapter, worker_id, rel):
+                logger.warning(f"章节 {chapter} 的租约已被其他 Worker 接管，本次结果作废")
+        else:
+            await asyncio.to_thread(queue.fail, chapter, worker_id, "process_chapter failed", args.max_attempts)
+        await asyncio.to_thread(queue.report_stats, worker_id, host, cleaner.stats.summary(), session)
+
+    async def renew_leases():
+        while True:
+            await asyncio.sleep(args.lease / 3)
+            if in_flight:
+                await asyncio.to_thread(queue.renew, list(in_flight.values()), worker_id, args.lease)
+
+    renewer = asyncio.create_task(renew_leases())
+    try:
+        while True:
+            free = args.concurrency - len(in_flight)
+            claimed = await asyncio.to_thread(queue.claim, worker_id, args.lease, free, args.max_attempts) if free > 0 else []
+            for chapter in claimed:
+                in_flight[asyncio.create_task(process(chapter))] = chapter
+
+            if not in_flight:
+                if await asyncio.to_thread(queue.is_drained):
+                    break
+                # 其他 Worker 仍持有租约，等待其完成或过期
+                await asyncio.sleep(args.poll)
+                continue
+
+            done, _ = await asyncio.wait(in_flight.keys(), timeout=args.poll, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                in_flight.pop(task)
+                if task.exception():
+                    logger.error(f"Worker 任务异常: {task.exception()}")
+    finally:
+        renewer.cancel()
+
+    s = cleaner.stats.summary()
+    logger.info(f"Worker {worker_id} 退出 | 成功:{s['success']} 失败:{s['failed']} 跳过/空:{s['skipped']} | 成本: {s['cost_cny']:.2f} CNY")
+
+# ==========================================
+# 3. 入口
+# ==========================================
+
+def print_status(args):
+    queue = WorkQueue(args.db)
+    print(json.dumps({"meta": queue.get_meta(), "progress": queue.progress(), **queue.aggregate_stats()},
+                     ensure_ascii=False, indent=2))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="分布式小说数据清洗 (Coordinator / Worker)")
+    sub = parser.add_subparsers(dest="role", required=True)
+
+    co = sub.add_parser("coordinator", help="写入章节任务并等待全部完成")
+    co.add_argument("--db", type=str, default=DEFAULT_DB, help="任务队列 SQLite 路径 (可位于共享卷)")
+    co.add_argument("--character", type=str, help="目标角色名称")
+    co.add_argument("--novel", type=str, help="来源小说名称")
+    co.add_argument("--prefix", type=str, help="卷前缀 (如 '03')")
+    co.add_argument("--start", type=int, help="起始章节编号")
+    co.add_argument("--end", type=int, help="结束章节编号")
+    co.add_argument("--instruction", "-ins", type=str, help="Prompt 指令文件名 (在 prompts 目录下)")
+    co.add_argument("--schema", "-sch", type=str, help="Output Schema 文件名 (在 prompts 目录下)")
+    co.add_argument("--no-refresh", action="store_true", help="不强制刷新缓存 (默认强制刷新)")
+    co.add_argument("--local-workers", type=int, default=0, help="在本机额外启动的 Worker 进程数")
+    co.add_argument("--lease", type=float, default=300, help="本机 Worker 的租约时长 (秒)")
+    co.add_argument("--concurrency", type=int, default=Config.MAX_CONCURRENT_TASKS, help="本机每个 Worker 同时处理的章节数")
+    co.add_argument("--max-attempts", type=int, default=3, help="本机 Worker 的单个章节最大尝试次数")
+    co.add_argument("--poll", type=float, default=5, help="进度轮询间隔 (秒)")
+
+    wk = sub.add_parser("worker", help="认领并处理章节任务")
+    wk.add_argument("--db", type=str, default=DEFAULT_DB, help="任务队列 SQLite 路径")
+    wk.add_argument("--worker-id", type=str, help="Worker 标识 (默认 主机名-PID)")
+    wk.add_argument("--concurrency", type=int, default=Config.MAX_CONCURRENT_TASKS, help="本 Worker 同时处理的章节数")
+    wk.add_argument("--lease", type=float, default=300, help="租约时长 (秒)，超时未续约的任务会被重新认领")
+    wk.add_argument("--max-attempts", type=int, default=3, help="单个章节最大尝试次数")
+    wk.add_argument("--poll", type=float, default=2, help="空闲轮询间隔 (秒)")
+
+    st = sub.add_parser("status", help="查看队列进度与汇总统计")
+    st.add_argument("--db", type=str, default=DEFAULT_DB, help="任务队列 SQLite 路径")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    args = parse_args()
+    if args.role == "status":
+        print_status(args)
+    else:
+        setup_logging(args.role)
+        if args.role == "coordinator":
+            run_coordinator(args)
+        else:
+            asyncio.run(run_worker(args))
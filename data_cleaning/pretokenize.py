@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+预分词导出 (Pre-tokenized Export)
+功能：将 Alpaca JSONL 训练集按 LLaMA-Factory 的对话模板预先分词，导出为 HuggingFace datasets 的 Arrow 格式
+(input_ids / attention_mask / labels，prompt 部分的 labels 为 -100)。
+Arrow 文件以内存映射方式读取，LLaMA-Factory 通过 `tokenized_path` 直接加载，训练启动时跳过分词。
+编码使用训练配置中的 template (get_template_and_fix_tokenizer + encode_oneturn)，与训练时逐条分词的结果一致；
+无法加载 LLaMA-Factory 模板时拒绝导出，不写出与训练不一致的数据。
+依赖：transformers、datasets、LLaMA-Factory (与训练环境一致)。
+"""
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+import token_index
+from token_index import dataset_files, read_sft_setting
+from validate_jsonl import compute_shards
+
+IGNORE_INDEX = -100
+# 导出目录中的元信息文件 (datasets 的 load_from_disk 会忽略它)
+META_NAME = "pretokenized.json"
+# DatasetDict 的标记文件，用于识别预分词目录
+DATASET_DICT_MARKER = "dataset_dict.json"
+# 分片目录的 val/ 对应 LLaMA-Factory 读取的 validation split
+SPLIT_NAMES = {"train": "train", "val": "validation"}
+
+
+def is_pretokenized(path: str) -> bool:
+    """判断目录是否为本脚本导出的预分词数据集"""
+    return os.path.isfile(os.path.join(path, DATASET_DICT_MARKER)) and os.path.isfile(os.path.join(path, META_NAME))
+
+
+def default_output_for(dataset_path: str) -> str:
+    """单文件导出到 <文件名>.tokenized/，分片目录导出到 <目录>/tokenized/"""
+    dataset_path = os.path.normpath(dataset_path)
+    if os.path.isdir(dataset_path):
+        return os.path.join(dataset_path, "tokenized")
+    return os.path.splitext(dataset_path)[0] + ".tokenized"
+
+
+def infer_seqlen(source_len: int, target_len: int, cutoff_len: int) -> Tuple[int, int]:
+    """与 LLaMA-Factory 相同的截断策略：较短的一侧完整保留，否则按长度比例分配"""
+    if target_len * 2 < cutoff_len:
+        max_target_len = cutoff_len
+    elif source_len * 2 < cutoff_len:
+        max_target_len = cutoff_len - source_len
+    else:
+        max_target_len = int(cutoff_len * (target_len / (source_len + target_len)))
+    new_target_len = min(max_target_len, target_len)
+    new_source_len = min(max(cutoff_len - new_target_len, 0), source_len)
+    return new_source_len, new_target_len
+
+
+def encode_entry(entry: Dict, cutoff_len: int) -> Dict[str, List[int]]:
+    """
+    与 LLaMA-Factory SupervisedDatasetProcessor 相同的单轮编码：labels 中 prompt 部分置为 IGNORE_INDEX，
+    按 infer_seqlen 截断；efficient_eos 模板在末尾单独追加 eos。
+    """
+    template = token_index._TEMPLATE
+    eos = [token_index._TOKENIZER.eos_token_id] if template.efficient_eos else []
+    prompt_ids, response_ids = token_index.encode_pair(entry)
+    source_len, target_len = infer_seqlen(len(prompt_ids), len(response_ids), cutoff_len - len(eos))
+    prompt_ids = prompt_ids[:source_len]
+    response_ids = response_ids[:target_len]
+
+    input_ids = prompt_ids + response_ids + eos
+    return {
+        "input_ids": input_ids,
+        "attention_mask": [1] * len(input_ids),
+        "labels": [IGNORE_INDEX] * len(prompt_ids) + response_ids + eos,
+    }
+
+
+def _encode_shard(args: Tuple[str, int, int, int]) -> List[Dict[str, List[int]]]:
+    """进程池工作函数：编码 [start, end) 字节区间内的样本"""
+    path, start, end, cutoff_len = args
+    rows = []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            if raw.strip():
+                row = encode_entry(json.loads(raw), cutoff_len)
+                if any(label != IGNORE_INDEX for label in row["labels"]):
+                    rows.append(row)
+    return rows
+
+
+def _generate(files: List[str], tokenizer_path: str, template: str, cutoff_len: int, workers: int):
+    """
+    datasets.Dataset.from_generator 的生成器：按文件顺序产出编码结果。
+    每个 Worker 分得多个较小的分片，主进程同一时刻只持有少量分片的结果，随后由 datasets 流式写入 Arrow。
+    """
+    tasks = [(fp, s, e, cutoff_len) for fp in files for s, e in compute_shards(fp, workers * 4)]
+    if workers <= 1:
+        token_index._init_worker(tokenizer_path, template)
+        for task in tasks:
+            yield from _encode_shard(task)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=token_index._init_worker,
+                             initargs=(tokenizer_path, template)) as pool:
+        for rows in pool.map(_encode_shard, tasks):
+            yield from rows
+
+
+def export_pretokenized(dataset_path: str, tokenizer_path: str, output_dir: Optional[str] = None,
+                        cutoff_len: int = 2048, workers: Optional[int] = None,
+                        template: Optional[str] = None) -> Dict[str, Any]:
+    """将 JSONL 文件或分片输出目录导出为预分词 DatasetDict，返回元信息"""
+    from datasets import Dataset, DatasetDict, Features, Sequence, Value
+
+    if not template:
+        raise ValueError("预分词需要指定 LLaMA-Factory 模板 (lora_sft.yaml 的 template 或 --template)")
+    try:
+        from llamafactory.data.template import TEMPLATES
+    except ImportError as e:
+        raise RuntimeError(f"预分词需要 LLaMA-Factory 的对话模板，拒绝导出与训练不一致的数据: {e}")
+    if template not in TEMPLATES:
+        raise ValueError(f"LLaMA-Factory 中不存在模板: {template}")
+
+    workers = workers or os.cpu_count() or 1
+    output_dir = output_dir or default_output_for(dataset_path)
+    files = dataset_files(dataset_path)
+    if not files:
+        raise FileNotFoundError(f"未找到数据文件: {dataset_path}")
+
+    # 按分片目录 (train/、val/) 归类；单文件或普通目录全部作为 train
+    groups: Dict[str, List[str]] = {}
+    for fp in files:
+        folder = os.path.basename(os.path.dirname(os.path.abspath(fp)))
+        split = SPLIT_NAMES.get(folder, "train") if os.path.isdir(dataset_path) else "train"
+        groups.setdefault(split, []).append(fp)
+
+    features = Features({
+        "input_ids": Sequence(Value("int32")),
+        "attention_mask": Sequence(Value("int8")),
+        "labels": Sequence(Value("int32")),
+    })
+    splits = {}
+    for split, split_files in groups.items():
+        splits[split] = Dataset.from_generator(
+            _generate, features=features,
+            gen_kwargs={"files": split_files, "tokenizer_path": tokenizer_path,
+                        "template": template, "cutoff_len": cutoff_len, "workers": workers},
+        )
+    DatasetDict(splits).save_to_disk(output_dir)
+
+    meta = {
+        "source": os.path.abspath(dataset_path),
+        "tokenizer": tokenizer_path,
+        "template": template,
+        "cutoff_len": cutoff_len,
+        "rows": {split: len(ds) for split, ds in splits.items()},
+        "tokens": {split: sum(len(ids) for batch in ds.iter(batch_size=1000) for ids in batch["input_ids"])
+                   for split, ds in splits.items()},
+    }
+    with open(os.path.join(output_dir, META_NAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将 Alpaca JSONL 训练集导出为预分词的 Arrow 数据集 (LLaMA-Factory tokenized_path)")
+    parser.add_argument("path", help="JSONL 文件或 convert_to_lora.py 的分片输出目录")
+    parser.add_argument("--tokenizer", "-t", type=str, help="Tokenizer 路径 (默认读取 lora_sft.yaml 的 model_name_or_path)")
+    parser.add_argument("--output", "-o", type=str, help="输出目录 (默认 <文件名>.tokenized 或 <目录>/tokenized)")
+    parser.add_argument("--cutoff-len", type=int, help="最大长度 (默认读取 lora_sft.yaml)")
+    parser.add_argument("--workers", "-w", type=int, help="并行进程数 (默认 CPU 核数)")
+    parser.add_argument("--template", type=str, help="LLaMA-Factory 对话模板 (默认读取 lora_sft.yaml 的 template)")
+    args = parser.parse_args()
+
+    tokenizer_path = args.tokenizer or read_sft_setting("model_name_or_path")
+    if not tokenizer_path:
+        print("[Error] 请通过 --tokenizer 指定 Tokenizer 路径")
+        sys.exit(1)
+    cutoff_len = args.cutoff_len or int(read_sft_setting("cutoff_len") or 2048)
+
+    try:
+        meta = export_pretokenized(args.path, tokenizer_path, args.output, cutoff_len, args.workers,
+                                   template=args.template or read_sft_setting("template"))
+    except (ValueError, RuntimeError) as e:
+        print(f"[Error] {e}")
+        sys.exit(1)
+    output_dir = args.output or default_output_for(args.path)
+    print(f"[Success] 预分词完成: {meta['rows']} 条, {meta['tokens']} tokens -> {output_dir}")
+    print(f"[Info] 训练配置中设置 tokenized_path: {os.path.abspath(output_dir)} 即可跳过分词 (需去掉 overwrite_cache)")
+
+if __name__ == "__main__":
+    main()
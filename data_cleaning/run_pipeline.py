@@ -10,8 +10,8 @@ import json
 import argparse
 import datetime
 import logging
-from clean_novel_data import NovelCleaner, load_nicknames
-from validate_data import validate_one
+from clean_novel_data import NovelCleaner, MultiVariantRunner, load_nicknames
+from validate_data import validate_one, validate_data_dynamic
 
 # 获取当前脚本所在目录 (data_cleaning)
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -57,10 +57,78 @@ def parse_args():
     parser.add_argument("--instruction", "-ins", type=str, help="自定义 Prompt 指令文件名 (在 prompts 目录下)")
     parser.add_argument("--schema", "-sch", type=str, help="自定义 Output Schema 文件名 (在 prompts 目录下)")
     parser.add_argument("--no-refresh", action="store_true", help="不强制刷新缓存 (默认强制刷新)")
+    parser.add_argument("--variant", "-var", action="append", metavar="名称:指令文件:Schema文件",
+                        help="Prompt 变体 (可重复指定，如 base:prompt_instruction_base.txt:output_schema_base.txt)，"
+                             "多个变体共享章节读取、限流与缓存")
     # 这里的 parse_known_args 允许有未定义的参数传入而不报错，增强兼容性
     args, _ = parser.parse_known_args()
     return args
 
+def parse_variants(specs):
+    """解析 --variant 参数为 [(名称, 指令文件路径, Schema 文件路径)]"""
+    variants = []
+    for spec in specs or []:
+        parts = spec.split(":")
+        if len(parts) != 3 or not all(parts):
+            raise ValueError(f"变体格式错误 (应为 名称:指令文件:Schema文件): {spec}")
+        name, ins_file, sch_file = parts
+        variants.append((
+            name,
+            os.path.join(CURRENT_DIR, "prompts", ins_file),
+            os.path.join(CURRENT_DIR, "prompts", sch_file),
+        ))
+    return variants
+
+def validate_generated(generated_files, schema_file, results=None):
+    """
+    使用指定 Schema 校验生成文件，返回 (通过数, 失败数)。
+    results 为清洗过程中捕获的内存结果 (输出路径 -> 数据)，命中时直接校验内存对象，不再回读文件。
+    """
+    results = results or {}
+    passed_count = 0
+    failed_count = 0
+    
+    for fpath in generated_files:
+        # 使用当前配置的 Schema 文件进行动态校验 (Schema 只编译一次)
+        if fpath in results and schema_file and os.path.exists(schema_file):
+            is_valid = validate_data_dynamic(results[fpath], schema_file, name=os.path.basename(fpath))
+        else:
+            is_valid = validate_one(fpath, schema_file=schema_file)
+        if is_valid:
+            passed_count += 1
+        else:
+            failed_count += 1
+    return passed_count, failed_count
+
+async def run_variants(variants, target_prefix, char_name, nickname_list, source_novel, force_refresh, start, end):
+    """多变体模式：一次读取章节，分发给所有 Prompt 变体"""
+    logger.info(f"1. 正在生成数据 (多变体: {', '.join(v[0] for v in variants)}): 角色[{char_name}] | 卷前缀[{target_prefix}]...")
+    runner = MultiVariantRunner(
+        variants,
+        target_prefix=target_prefix,
+        char_name=char_name,
+        nickname_list=nickname_list,
+        source_novel=source_novel,
+        force_refresh=force_refresh
+    )
+    captured = {}
+    for cleaner in runner.cleaners.values():
+        cleaner.on_result = captured.__setitem__
+    generated = await runner.run(start_idx=start, end_idx=end)
+
+    logger.info("2. 正在按变体校验生成文件...")
+    total_failed = 0
+    for name, ins_file, sch_file in variants:
+        files = generated.get(name, [])
+        passed_count, failed_count = validate_generated(files, sch_file, captured)
+        total_failed += failed_count
+        logger.info(f"[{name}] 生成: {len(files)} | 通过: {passed_count} | 失败: {failed_count} | 输出: {runner.cleaners[name].output_root}")
+
+    if total_failed > 0:
+        logger.error("请查看上方日志以获取校验错误详情。")
+    else:
+        logger.info("所有变体的生成文件均通过校验。")
+
 async def run_pipeline():
     # 加载外部配置 (优先级: CLI > Config > 默认值)
     config = load_config()
@@ -103,6 +171,14 @@ async def run_pipeline():
     
     logger.info(f"=== 开始执行流程 ===")
     logger.info(f"配置生效: 角色=[{TARGET_CHARACTER}] 来源=[{SOURCE_NOVEL}] 卷=[{TARGET_PREFIX}] 范围=[{START_CHAPTER}-{END_CHAPTER}] 强刷=[{FORCE_REFRESH}]")
+
+    # 6. 多变体模式 (指定了 --variant 时忽略 --instruction / --schema)
+    VARIANTS = parse_variants(args.variant)
+    if VARIANTS:
+        await run_variants(VARIANTS, TARGET_PREFIX, TARGET_CHARACTER, NICKNAME_LIST, SOURCE_NOVEL,
+                           FORCE_REFRESH, START_CHAPTER, END_CHAPTER)
+        return
+
     logger.info(f"1. 正在生成数据: 角色[{TARGET_CHARACTER}] | 卷前缀[{TARGET_PREFIX}]...")
     
     cleaner = NovelCleaner(
@@ -114,6 +190,9 @@ async def run_pipeline():
         output_schema_file=OUTPUT_SCHEMA_FILE, 
         force_refresh=FORCE_REFRESH
     )
+    # 捕获内存中的章节结果，校验阶段无需回读刚写入的文件
+    captured = {}
+    cleaner.on_result = captured.__setitem__
     
     generated_files = await cleaner.run(start_idx=START_CHAPTER, end_idx=END_CHAPTER)
     
@@ -123,16 +202,7 @@ async def run_pipeline():
 
     logger.info(f"2. 正在校验 {len(generated_files)} 个生成文件...")
     
-    passed_count = 0
-    failed_count = 0
-    
-    for fpath in generated_files:
-        # 使用当前配置的 Schema 文件进行动态校验
-        is_valid = validate_one(fpath, schema_file=OUTPUT_SCHEMA_FILE)
-        if is_valid:
-            passed_count += 1
-        else:
-            failed_count += 1
+    passed_count, failed_count = validate_generated(generated_files, OUTPUT_SCHEMA_FILE, captured)
             
     logger.info("=== 流程汇总 ===")
     logger.info(f"总生成文件数: {len(generated_files)}")
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+流式流程编排脚本 (Streaming Pipeline)
+功能：将 切分 -> 清洗 -> 校验 -> 转换 -> 注册 串联为流水线。
+每个章节的 API 结果一返回就立即在内存中校验并转换为 Alpaca 样本，按章节顺序追加到训练 JSONL；
+最后一个章节返回后数据集即可就绪，无需再依次运行校验、convert_to_lora.py 与 data_interface.py。
+"""
+import asyncio
+import sys
+import os
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import logging
+from typing import Dict, Optional, Tuple
+from tqdm.asyncio import tqdm
+from clean_novel_data import NovelCleaner, Config, load_nicknames
+from validate_data import validate_data_dynamic
+from convert_to_lora import process_data
+from split_novel import split_novel
+from dataset_catalog import DatasetCatalog
+
+# 获取当前脚本所在目录 (data_cleaning)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 获取项目根目录 (即 data_cleaning 的上一级)
+PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
+TRAIN_DATASET_DIR = os.path.join(PROJECT_ROOT, "novel_data", "lora_train_dataset")
+
+# 配置日志
+LOG_DIR = os.path.join(PROJECT_ROOT, "logs")
+os.makedirs(LOG_DIR, exist_ok=True)
+log_filename = os.path.join(LOG_DIR, f"stream_pipeline_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+    handlers=[
+        logging.FileHandler(log_filename, encoding='utf-8'),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger("stream_pipeline")
+
+
+def load_config(config_file=None):
+    """加载外部 JSON 配置文件"""
+    if config_file is None:
+        config_file = os.path.join(CURRENT_DIR, "config.json")
+
+    if os.path.exists(config_file):
+        try:
+            with open(config_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"无法读取配置文件 {config_file}: {e}")
+    return {}
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="流式数据生产流水线 (切分 -> 清洗 -> 校验 -> 转换 -> 注册)")
+    parser.add_argument("--character", type=str, help="目标角色名称")
+    parser.add_argument("--novel", type=str, help="来源小说名称")
+    parser.add_argument("--prefix", type=str, help="卷前缀 (如 '03')")
+    parser.add_argument("--start", type=int, help="起始章节编号")
+    parser.add_argument("--end", type=int, help="结束章节编号")
+    parser.add_argument("--instruction", "-ins", type=str, help="自定义 Prompt 指令文件名 (在 prompts 目录下)")
+    parser.add_argument("--schema", "-sch", type=str, help="自定义 Output Schema 文件名 (在 prompts 目录下)")
+    parser.add_argument("--no-refresh", action="store_true", help="不强制刷新缓存 (默认强制刷新)")
+    parser.add_argument("--split", action="store_true", help="先重新切分 novel_data/original_data 下的小说 (切分目录为空时自动执行)")
+    parser.add_argument("--output", "-o", type=str, help="训练 JSONL 文件名 (位于 lora_train_dataset/ 下)")
+    parser.add_argument("--register", nargs="?", const="hentai_lora", metavar="数据集名称",
+                        help="完成后注册到 LLaMA-Factory (默认名称 hentai_lora)")
+    args, _ = parser.parse_known_args()
+    return args
+
+# ==========================================
+# 流水线各阶段
+# ==========================================
+
+def stage_split(force: bool):
+    """阶段 0: 切分。切分是纯本地操作，仅在显式要求或切分目录为空时执行"""
+    has_split = os.path.isdir(Config.BASE_INPUT_DIR) and any(
+        os.path.isdir(os.path.join(Config.BASE_INPUT_DIR, d)) for d in os.listdir(Config.BASE_INPUT_DIR)
+    )
+    if has_split and not force:
+        return
+
+    source_dir = os.path.join(PROJECT_ROOT, "novel_data", "original_data")
+    sources = sorted(f for f in os.listdir(source_dir) if f.endswith('.txt')) if os.path.isdir(source_dir) else []
+    if not sources:
+        logger.warning(f"未在 {source_dir} 找到原始小说 TXT，跳过切分")
+        return
+    logger.info(f"0. 正在切分: {sources[0]}")
+    split_novel(os.path.join(source_dir, sources[0]), Config.BASE_INPUT_DIR)
+
+
+class StreamingPipeline:
+    """清洗协程作为生产者，校验/转换/写入协程作为消费者，通过 asyncio.Queue 衔接"""
+
+    def __init__(self, cleaner: NovelCleaner, schema_file: str, output_path: str):
+        self.cleaner = cleaner
+        self.schema_file = schema_file
+        self.output_path = output_path
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # on_result 回调捕获的内存结果 (输出路径 -> 数据)
+        self._captured: Dict[str, Dict] = {}
+        cleaner.on_result = self._capture
+        self.valid = 0
+        self.invalid = 0
+        self.samples = 0
+        self.sha1 = hashlib.sha1()
+        self.last_response_at: Optional[float] = None
+
+    def _capture(self, output_path: str, data: Dict):
+        self._captured[output_path] = data
+
+    async def _clean_one(self, idx: int, chapter_file: str):
+        """阶段 1: 清洗单个章节，结果 (含失败) 按章节序号投递给下游"""
+        out = self.cleaner.output_path_for(chapter_file)
+        await self.cleaner.process_chapter(chapter_file, out, self.cleaner.char_name)
+        self.last_response_at = time.monotonic()
+        await self.queue.put((idx, out, self._captured.pop(out, None)))
+
+    async def _consume(self, total: int):
+        """阶段 2-4: 内存校验 -> 转换 -> 按章节顺序追加写入 JSONL"""
+        pending: Dict[int, Tuple[str, Optional[Dict]]] = {}
+        next_idx = 0
+        next_id = 1
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            while next_idx < total:
+                idx, out, data = await self.queue.get()
+                pending[idx] = (out, data)
+                # 重排缓冲: 保证输出顺序与章节顺序一致，不受 API 返回先后影响
+                while next_idx in pending:
+                    out, data = pending.pop(next_idx)
+                    next_idx += 1
+                    if data is None:
+                        continue
+                    # 校验结果只用于统计与日志 (与原先逐文件 validate_one 的行为一致)，不决定章节是否转换
+                    if validate_data_dynamic(data, self.schema_file, name=os.path.basename(out)):
+                        self.valid += 1
+                    else:
+                        self.invalid += 1
+                    for entry in process_data(data, self.cleaner.char_name):
+                        entry["id"] = next_id
+                        next_id += 1
+                        line = json.dumps(entry, ensure_ascii=False) + "\n"
+                        f.write(line)
+                        self.sha1.update(line.encode('utf-8'))
+                        self.samples += 1
+                    f.flush()
+
+    async def run(self, chapters) -> int:
+        consumer = asyncio.create_task(self._consume(len(chapters)))
+        producers = [self._clean_one(i, cf) for i, cf in enumerate(chapters)]
+        for f in tqdm.as_completed(producers, total=len(producers), desc=f"Streaming {self.cleaner.target_prefix}"):
+            await f
+            self.cleaner.log_progress(len(chapters))
+        await consumer
+        return self.samples
+
+
+def stage_register(output_path: str, dataset_name: str) -> bool:
+    """阶段 5: 注册到 LLaMA-Factory (复用 lora_deploy/data_interface.py)"""
+    sys.path.insert(0, os.path.join(PROJECT_ROOT, "lora_deploy"))
+    from data_interface import DataInterface
+    return DataInterface().register_dataset(output_path, dataset_name)
+
+
+async def run_stream_pipeline():
+    # 加载外部配置 (优先级: CLI > Config > 默认值)
+    config = load_config()
+    args = parse_args()
+
+    target_prefix = args.prefix if args.prefix else config.get("target_prefix")
+    start = args.start if args.start is not None else config.get("start_chapter")
+    end = args.end if args.end is not None else config.get("end_chapter")
+    character = args.character or config.get("target_character") or "叶灵静"
+    novel = args.novel or config.get("source_novel") or "隐杀"
+    force_refresh = False if args.no_refresh else config.get("force_refresh", True)
+    schema_file = os.path.join(CURRENT_DIR, "prompts", args.schema or "output_schema.txt")
+    instruction_file = os.path.join(CURRENT_DIR, "prompts", args.instruction or "prompt_instruction.txt")
+
+    logger.info(f"=== 开始执行流式流程 ===")
+    logger.info(f"配置生效: 角色=[{character}] 来源=[{novel}] 卷=[{target_prefix}] 范围=[{start}-{end}] 强刷=[{force_refresh}]")
+
+    stage_split(args.split)
+
+    cleaner = NovelCleaner(
+        target_prefix=target_prefix,
+        char_name=character,
+        nickname_list=load_nicknames(character, novel),
+        source_novel=novel,
+        prompt_instruction_file=instruction_file,
+        output_schema_file=schema_file,
+        force_refresh=force_refresh
+    )
+    chapters = cleaner.collect_chapters(start, end)
+    if not chapters:
+        logger.warning("未找到可处理的章节。")
+        return
+
+    os.makedirs(TRAIN_DATASET_DIR, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_path = os.path.join(TRAIN_DATASET_DIR, args.output or f"lora_dataset_{character}_{timestamp}.jsonl")
+
+    pipeline = StreamingPipeline(cleaner, schema_file, output_path)
+    samples = await pipeline.run(chapters)
+    lag = time.monotonic() - pipeline.last_response_at if pipeline.last_response_at else 0.0
+
+    # 中间态 JSON 仍按原流程补充卷内序号与全局序号，便于后续 convert_to_lora 复用
+    cleaner.label_ids([cleaner.output_path_for(cf) for cf in chapters if os.path.exists(cleaner.output_path_for(cf))])
+
+    logger.info("=== 流程汇总 ===")
+    logger.info(f"章节数: {len(chapters)} | 校验通过: {pipeline.valid} | 校验失败: {pipeline.invalid}")
+    logger.info(f"训练样本: {samples} -> {output_path}")
+    logger.info(f"最后一个 API 响应后 {lag:.2f}s 数据集就绪 | 成本: {cleaner.stats.get_cost():.2f} CNY")
+
+    if samples:
+        DatasetCatalog(TRAIN_DATASET_DIR).record(output_path, samples, pipeline.sha1.hexdigest(), lineage={
+            "inputs": [os.path.abspath(cleaner.output_root)],
+            "character": character,
+            "source_novel": novel,
+            "prefix": target_prefix,
+            "chapters": [start, end],
+            "schema": os.path.basename(schema_file),
+        })
+
+    if args.register and samples:
+        if not stage_register(output_path, args.register):
+            logger.error("数据集注册失败，请检查 LLaMA-Factory 部署状态。")
+
+if __name__ == "__main__":
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    asyncio.run(run_stream_pipeline())
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""
+Token 长度索引 (Token Length Index)
+功能：使用目标模型的 Tokenizer 统计训练集每条样本的 Token 长度，写出长度索引 (sidecar)，
+并据此给出覆盖指定百分位的 cutoff_len 建议、估算 padding 浪费，可选输出按长度分桶 / 装箱的样本顺序。
+实现：按字节区间切分 JSONL (与 validate_jsonl.py 相同)，多进程并行。
+对话模板使用 LLaMA-Factory 的 template (默认读取 lora_sft.yaml)，与训练时的编码完全一致；
+Tokenizer 自带的 chat_template 可能与训练不同 (如 DeepSeek-R1-Distill 的模板会删去 </think> 之前的内容)，不使用。
+依赖：transformers；套用模板时需要 LLaMA-Factory (--no-chat-template 统计原始文本时不需要)。
+"""
+import os
+import re
+import sys
+import json
+import glob
+import random
+import bisect
+import argparse
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from validate_jsonl import compute_shards
+from dataset_catalog import DatasetCatalog
+
+# 获取当前脚本所在目录 (data_cleaning)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 获取项目根目录 (即 data_cleaning 的上一级)
+PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
+DEFAULT_DATASET_DIR = os.path.join(PROJECT_ROOT, "novel_data", "lora_train_dataset")
+DEFAULT_SFT_CONFIG = os.path.join(PROJECT_ROOT, "simple_lora_test", "configs", "lora_sft.yaml")
+
+INDEX_DIR_NAME = "token_index"
+MANIFEST_NAME = "manifest.json"
+
+# ==========================================
+# 1. 路径与配置
+# ==========================================
+
+def read_sft_setting(key: str, config_path: str = DEFAULT_SFT_CONFIG) -> Optional[str]:
+    """从 lora_sft.yaml 读取单个顶层配置 (只做简单的 key: value 解析，避免依赖 yaml)"""
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            m = re.match(rf"^{re.escape(key)}\s*:\s*(.+?)\s*$", line)
+            if m:
+                return m.group(1).strip("'\"")
+    return None
+
+
+def dataset_files(path: str) -> List[str]:
+    """
+    展开数据集路径：单个 JSONL 文件、普通目录 (*.jsonl)，
+    或 convert_to_lora.py 的分片输出目录 (train/、val/ 下的分片)。
+    """
+    if os.path.isfile(path):
+        return [path]
+    if os.path.isfile(os.path.join(path, MANIFEST_NAME)):
+        return sorted(glob.glob(os.path.join(path, "*", "part-*.jsonl")))
+    return sorted(glob.glob(os.path.join(path, "*.jsonl")))
+
+
+def index_path_for(jsonl_path: str) -> str:
+    """
+    长度索引的存放位置。
+    分片目录中的索引放在 <数据集>/token_index/ 下：LLaMA-Factory 会加载 train/ 目录中的所有文件，不能混入索引。
+    """
+    parent = os.path.dirname(os.path.abspath(jsonl_path))
+    root = os.path.dirname(parent)
+    name = os.path.splitext(os.path.basename(jsonl_path))[0]
+    if os.path.isfile(os.path.join(root, MANIFEST_NAME)):
+        return os.path.join(root, INDEX_DIR_NAME, f"{os.path.basename(parent)}.{name}.json")
+    return os.path.join(parent, f"{name}.tokens.json")
+
+# ==========================================
+# 2. 并行分词
+# ==========================================
+
+_TOKENIZER = None
+# LLaMA-Factory 模板对象；None 表示不套用模板，直接统计原始文本
+_TEMPLATE = None
+
+
+def load_template(tokenizer, name: str):
+    """加载 LLaMA-Factory 的对话模板 (与训练时 get_template_and_fix_tokenizer 的处理相同，包括补充特殊 Token)"""
+    from llamafactory.data import get_template_and_fix_tokenizer
+    from llamafactory.hparams import DataArguments
+    return get_template_and_fix_tokenizer(tokenizer, DataArguments(template=name))
+
+
+def _init_worker(tokenizer_path: str, template: Optional[str] = None):
+    """进程池初始化：每个进程只加载一次 Tokenizer 与模板"""
+    global _TOKENIZER, _TEMPLATE
+    # 进程级并行已占满 CPU，关闭 tokenizers 内部线程避免过度订阅
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    from transformers import AutoTokenizer
+    _TOKENIZER = AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
+    _TEMPLATE = load_template(_TOKENIZER, template) if template else None
+
+
+def render(entry: Dict) -> Tuple[str, str]:
+    """按 Alpaca 规则拼接 prompt (instruction + input，与 LLaMA-Factory 相同以换行连接)，返回 (prompt, response)"""
+    prompt = entry.get("instruction", "")
+    if entry.get("input"):
+        prompt = f"{prompt}\n{entry['input']}"
+    return prompt, entry.get("output", "")
+
+
+def encode_pair(entry: Dict) -> Tuple[List[int], List[int]]:
+    """按 LLaMA-Factory 模板编码单轮样本，返回 (prompt_ids, response_ids)；需在 _init_worker 指定模板后调用"""
+    prompt, response = render(entry)
+    messages = [{"role": "user", "content": prompt}, {"role": "assistant", "content": response}]
+    return _TEMPLATE.encode_oneturn(_TOKENIZER, messages, entry.get("system") or None)
+
+
+def _encode_lengths(texts: List[str]) -> List[int]:
+    if not texts:
+        return []
+    return [len(ids) for ids in _TOKENIZER(texts, add_special_tokens=False)["input_ids"]]
+
+
+def _tokenize_shard(args: Tuple[str, int, int, int]) -> Dict[str, Any]:
+    """进程池工作函数：分批统计 [start, end) 字节区间内每行的 (起始偏移, 总长度, prompt 长度)"""
+    path, start, end, batch_size = args
+    offsets, lengths, prompt_lengths = array('Q'), array('I'), array('I')
+    prompts, fulls = [], []
+
+    def flush():
+        prompt_lengths.extend(_encode_lengths(prompts))
+        lengths.extend(_encode_lengths(fulls))
+        prompts.clear()
+        fulls.clear()
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            line_start = pos
+            pos += len(raw)
+            if not raw.strip():
+                continue
+            entry = json.loads(raw)
+            offsets.append(line_start)
+            if _TEMPLATE is not None:
+                prompt_ids, response_ids = encode_pair(entry)
+                prompt_lengths.append(len(prompt_ids))
+                lengths.append(len(prompt_ids) + len(response_ids))
+                continue
+            prompt, response = render(entry)
+            prompts.append(prompt)
+            fulls.append(prompt + response)
+            if len(fulls) >= batch_size:
+                flush()
+    flush()
+    return {"offsets": offsets, "lengths": lengths, "prompt_lengths": prompt_lengths}
+
+
+def build_index(path: str, tokenizer_path: str, workers: int = None, batch_size: int = 256,
+                template: Optional[str] = None) -> Dict[str, Any]:
+    """为单个 JSONL 文件建立长度索引并写出 sidecar (template 为 None 时统计原始文本)"""
+    workers = workers or os.cpu_count() or 1
+    tasks = [(path, s, e, batch_size) for s, e in compute_shards(path, workers)]
+    if len(tasks) <= 1:
+        _init_worker(tokenizer_path, template)
+        results = [_tokenize_shard(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(tokenizer_path, template)) as pool:
+            results = list(pool.map(_tokenize_shard, tasks))
+
+    stat = os.stat(path)
+    index = {
+        "source": os.path.basename(path),
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "tokenizer": tokenizer_path,
+        "template": template,
+        "offsets": [o for r in results for o in r["offsets"]],
+        "lengths": [n for r in results for n in r["lengths"]],
+        "prompt_lengths": [n for r in results for n in r["prompt_lengths"]],
+    }
+    out = index_path_for(path)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(out + ".tmp", out)
+    return index
+
+
+def load_index(path: str, tokenizer_path: Optional[str] = None, template: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """读取 sidecar；源文件已变化或 Tokenizer / 模板不一致时返回 None"""
+    out = index_path_for(path)
+    if not os.path.exists(out):
+        return None
+    try:
+        with open(out, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    stat = os.stat(path)
+    if index.get("source_size") != stat.st_size or index.get("source_mtime_ns") != stat.st_mtime_ns:
+        return None
+    if tokenizer_path and (index.get("tokenizer") != tokenizer_path or index.get("template") != template):
+        return None
+    return index
+
+# ==========================================
+# 3. 统计与排序
+# ==========================================
+
+def percentile(sorted_values: List[int], pct: float) -> int:
+    """最近秩法百分位 (sorted_values 需已升序)"""
+    if not sorted_values:
+        return 0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[min(int(rank), len(sorted_values)) - 1]
+
+
+def suggest_cutoff(lengths: List[int], pct: float, multiple: int = 64) -> int:
+    """覆盖 pct% 样本的最小 cutoff_len，向上取整到 multiple 的倍数"""
+    value = percentile(sorted(lengths), pct)
+    return -(-value // multiple) * multiple if value else 0
+
+
+def padding_waste(lengths: List[int], batches: List[List[int]], cutoff: int) -> float:
+    """按批内最长样本补齐时，padding token 占总 token 的比例"""
+    padded = used = 0
+    for batch in batches:
+        sizes = [min(lengths[i], cutoff) for i in batch]
+        padded += max(sizes) * len(sizes)
+        used += sum(sizes)
+    return 1 - used / padded if padded else 0.0
+
+
+def random_batches(n: int, batch_size: int, seed: int) -> List[List[int]]:
+    order = list(range(n))
+    random.Random(seed).shuffle(order)
+    return [order[i:i + batch_size] for i in range(0, n, batch_size)]
+
+
+def bucketed_batches(lengths: List[int], batch_size: int, seed: int, window: int = 50) -> List[List[int]]:
+    """
+    长度分桶：先随机打乱，再在 batch_size * window 大小的窗口内按长度排序切批，最后打乱批次顺序。
+    批内长度接近以减少 padding，窗口与批次级的随机性保留了训练顺序的多样性。
+    """
+    rng = random.Random(seed)
+    order = list(range(len(lengths)))
+    rng.shuffle(order)
+    span = batch_size * window
+    batches = []
+    for i in range(0, len(order), span):
+        chunk = sorted(order[i:i + span], key=lambda idx: lengths[idx])
+        batches.extend(chunk[j:j + batch_size] for j in range(0, len(chunk), batch_size))
+    rng.shuffle(batches)
+    return batches
+
+
+def packed_groups(lengths: List[int], pack_len: int, seed: int) -> List[List[int]]:
+    """
+    装箱：按长度降序做 Best-Fit，使每组样本总长不超过 pack_len (超长样本单独成组)，
+    适用于按顺序拼接相邻样本的 packing 训练方式。
+    """
+    groups: List[List[int]] = []
+    free: List[Tuple[int, int]] = []  # (剩余容量, 组序号)，按剩余容量升序
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        size = min(lengths[idx], pack_len)
+        pos = bisect.bisect_left(free, (size, -1))
+        if pos < len(free):
+            remaining, gid = free.pop(pos)
+        else:
+            remaining, gid = pack_len, len(groups)
+            groups.append([])
+        groups[gid].append(idx)
+        remaining -= size
+        if remaining > 0:
+            bisect.insort(free, (remaining, gid))
+    random.Random(seed).shuffle(groups)
+    return groups
+
+
+def write_order(items: List[Tuple[str, int]], order: List[int], output_path: str) -> int:
+    """按 order 从各源文件的字节偏移处读取样本并写出，返回写出的行数"""
+    handles = {}
+    count = 0
+    try:
+        with open(output_path + ".tmp", 'wb') as out:
+            for idx in order:
+                path, offset = items[idx]
+                f = handles.get(path)
+                if f is None:
+                    f = handles[path] = open(path, 'rb')
+                f.seek(offset)
+                line = f.readline()
+                out.write(line if line.endswith(b"\n") else line + b"\n")
+                count += 1
+        os.replace(output_path + ".tmp", output_path)
+    finally:
+        for f in handles.values():
+            f.close()
+    return count
+
+# ==========================================
+# 4. 主程序
+# ==========================================
+
+def main():
+    parser = argparse.ArgumentParser(description="统计训练集 Token 长度，给出 cutoff_len 建议并生成分桶/装箱顺序")
+    parser.add_argument("path", nargs="?", help="JSONL 文件或数据集目录 (默认 lora_train_dataset 下最新的 JSONL)")
+    parser.add_argument("--tokenizer", "-t", type=str, help="Tokenizer 路径 (默认读取 lora_sft.yaml 的 model_name_or_path)")
+    parser.add_argument("--workers", "-w", type=int, help="并行进程数 (默认 CPU 核数)")
+    parser.add_argument("--batch-size", type=int, default=256, help="每次调用 Tokenizer 的样本数")
+    parser.add_argument("--template", type=str, help="LLaMA-Factory 对话模板 (默认读取 lora_sft.yaml 的 template)")
+    parser.add_argument("--no-chat-template", action="store_true", help="不套用对话模板，直接统计原始文本 (不需要 LLaMA-Factory)")
+    parser.add_argument("--rebuild", action="store_true", help="忽略已有索引，重新分词")
+    parser.add_argument("--percentile", "-p", type=float, default=99.0, help="cutoff_len 需覆盖的样本百分位")
+    parser.add_argument("--cutoff-len", type=int, help="当前 cutoff_len (默认读取 lora_sft.yaml)")
+    parser.add_argument("--train-batch", type=int, default=4, help="估算 padding 时的有效 batch 大小")
+    parser.add_argument("--order", choices=["bucketed", "packed"], help="输出按长度分桶或装箱后的训练顺序")
+    parser.add_argument("--pack-len", type=int, help="装箱长度 (默认使用建议的 cutoff_len)")
+    parser.add_argument("--seed", type=int, default=42, help="排序用随机种子")
+    parser.add_argument("--output", "-o", type=str, help="排序结果输出路径")
+    args = parser.parse_args()
+
+    path = args.path
+    if not path:
+        candidates = glob.glob(os.path.join(DEFAULT_DATASET_DIR, "*.jsonl"))
+        if not candidates:
+            print(f"[Error] 未在 {DEFAULT_DATASET_DIR} 找到 JSONL 文件")
+            sys.exit(1)
+        path = max(candidates, key=os.path.getmtime)
+    files = dataset_files(path)
+    if not files:
+        print(f"[Error] 未找到数据文件: {path}")
+        sys.exit(1)
+
+    tokenizer_path = args.tokenizer or read_sft_setting("model_name_or_path")
+    if not tokenizer_path:
+        print("[Error] 请通过 --tokenizer 指定 Tokenizer 路径")
+        sys.exit(1)
+    template = None if args.no_chat_template else (args.template or read_sft_setting("template"))
+    if not args.no_chat_template and not template:
+        print("[Error] 请通过 --template 指定 LLaMA-Factory 模板，或使用 --no-chat-template 统计原始文本")
+        sys.exit(1)
+
+    # 1. 建立/复用各文件的长度索引
+    train_items: List[Tuple[str, int]] = []
+    train_lengths: List[int] = []
+    all_lengths: List[int] = []
+    for fp in files:
+        index = None if args.rebuild else load_index(fp, tokenizer_path, template)
+        if index is None:
+            print(f"[Info] 分词: {fp}")
+            index = build_index(fp, tokenizer_path, args.workers, args.batch_size, template)
+        else:
+            print(f"[Info] 复用索引: {index_path_for(fp)}")
+        all_lengths.extend(index["lengths"])
+        # 分片目录中只有 train/ 参与排序
+        if os.path.basename(os.path.dirname(os.path.abspath(fp))) != "val" or len(files) == 1:
+            train_items.extend((fp, off) for off in index["offsets"])
+            train_lengths.extend(index["lengths"])
+
+    if not all_lengths:
+        print("[Warning] 数据集为空")
+        sys.exit(1)
+
+    # 2. 长度分布与 cutoff_len 建议
+    sorted_lengths = sorted(all_lengths)
+    cutoff = args.cutoff_len or int(read_sft_setting("cutoff_len") or 2048)
+    suggested = suggest_cutoff(all_lengths, args.percentile)
+    truncated = len(sorted_lengths) - bisect.bisect_right(sorted_lengths, cutoff)
+    print(f"\n=== Token 长度分布 ({len(all_lengths)} 条, Tokenizer: {tokenizer_path}) ===")
+    print("  " + " | ".join(f"P{p}: {percentile(sorted_lengths, p)}" for p in (50, 90, 95, 99)) + f" | Max: {sorted_lengths[-1]}")
+    print(f"  当前 cutoff_len={cutoff}: 截断 {truncated} 条 ({truncated / len(all_lengths):.2%})")
+    print(f"  覆盖 P{args.percentile:g} 的建议 cutoff_len: {suggested}")
+    DatasetCatalog().update(path, tokens={
+        "tokenizer": tokenizer_path,
+        "template": template,
+        "total": sum(all_lengths),
+        "p50": percentile(sorted_lengths, 50),
+        "p95": percentile(sorted_lengths, 95),
+        "p99": percentile(sorted_lengths, 99),
+        "max": sorted_lengths[-1],
+        "suggested_cutoff_len": suggested,
+    })
+
+    # 3. padding 浪费估算
+    effective = min(cutoff, suggested) if suggested else cutoff
+    random_waste = padding_waste(train_lengths, random_batches(len(train_lengths), args.train_batch, args.seed), effective)
+    bucket_waste = padding_waste(train_lengths, bucketed_batches(train_lengths, args.train_batch, args.seed), effective)
+    print(f"  padding 占比 (batch={args.train_batch}, cutoff_len={effective}): 随机顺序 {random_waste:.1%} -> 分桶顺序 {bucket_waste:.1%}")
+
+    # 4. 可选：输出排序后的训练顺序
+    if args.order:
+        stem = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+        output_path = args.output or os.path.join(os.path.dirname(os.path.abspath(os.path.normpath(path))), f"{stem}.{args.order}.jsonl")
+        if args.order == "bucketed":
+            order = [i for batch in bucketed_batches(train_lengths, args.train_batch, args.seed) for i in batch]
+            hint = f"训练配置需设置 disable_shuffling: true，且有效 batch 为 {args.train_batch}"
+        else:
+            pack_len = args.pack_len or effective
+            groups = packed_groups(train_lengths, pack_len, args.seed)
+            order = [i for group in groups for i in group]
+            fill = sum(min(n, pack_len) for n in train_lengths) / (len(groups) * pack_len)
+            hint = f"{len(groups)} 组, 装箱长度 {pack_len}, 填充率 {fill:.1%}"
+        written = write_order(train_items, order, output_path)
+        print(f"\n[Output] {args.order} 顺序 ({written} 条) -> {output_path}")
+        print(f"  {hint}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+交互单元列式表 (Interaction Unit Table)
+功能：将 lora_dataset 下各 cleaned_* 目录中的 meta_info 与 interaction_units 展平为列式表，
+支持用过滤表达式快速切片 (例如 "scene_type == 'Romance' and interlocutor == '顾家明' and mood_state == '羞涩'")，
+convert_to_lora.py 可据此只转换命中的交互单元。
+存储：目录内每列一个 int32 二进制文件 (字符串列按字典编码存储编码值) + columns.json；
+安装 numpy 时按列向量化过滤，否则回退纯 Python 实现；安装 pyarrow 时可额外导出 Parquet。
+"""
+import os
+import re
+import ast
+import sys
+import json
+import argparse
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from convert_to_lora import collect_jobs, construct_output
+
+# 获取当前脚本所在目录 (data_cleaning)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 获取项目根目录 (即 data_cleaning 的上一级)
+PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
+# 表目录不能放在 lora_dataset 内，否则会被 convert_to_lora 当作源文件扫描
+DEFAULT_TABLE_DIR = os.path.join(PROJECT_ROOT, "novel_data", "unit_table")
+
+TABLE_VERSION = 1
+META_NAME = "columns.json"
+
+# 字符串列 (字典编码)
+STRING_COLUMNS = (
+    "source_file", "character", "chapter_id", "unit_id",
+    "scene_type", "interlocutor", "relationship_tag", "active_persona", "mood_state", "trigger_type",
+)
+# 整数列 (长度均为字符数；global_id 缺失时为 -1)
+INT_COLUMNS = (
+    "unit_index", "global_id",
+    "trigger_len", "monologue_len", "action_len", "speech_len", "output_len",
+)
+
+# ==========================================
+# 1. 展平
+# ==========================================
+
+def _text(value: Any) -> str:
+    return value.strip() if isinstance(value, str) else ""
+
+
+def extract_rows(job: Tuple[str, str]) -> List[Dict[str, Any]]:
+    """进程池工作函数：将单个源文件展平为行 (每个交互单元一行)"""
+    file_path, character = job
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+        data = json.loads(content) if content else {}
+    except (OSError, json.JSONDecodeError):
+        return []
+    if not isinstance(data, dict):
+        return []
+
+    meta_info = data.get("meta_info", {}) or {}
+    match = re.match(r"(\d+)_", os.path.basename(file_path))
+    file_chapter = match.group(1) if match else ""
+    rows = []
+    for i, unit in enumerate(data.get("interaction_units", []) or []):
+        if not isinstance(unit, dict):
+            continue
+        interlocutor = unit.get("interlocutor_info", {}) or {}
+        trigger = unit.get("trigger", {}) or {}
+        response = unit.get("character_response", {}) or {}
+        unit_id = str(unit.get("id") or "")
+        global_id = unit.get("global_id")
+        if "input" in unit and "output" in unit:
+            # 新版直出格式 (Base/Hentai/Identity)：只有 input/output 文本
+            trigger_len, output_len = len(_text(unit["input"])), len(_text(unit["output"]))
+        else:
+            trigger_len, output_len = len(_text(trigger.get("content"))), len(construct_output(unit) or "")
+        rows.append({
+            "source_file": os.path.abspath(file_path),
+            "character": character,
+            "chapter_id": unit_id.split("_")[0] if "_" in unit_id else file_chapter,
+            "unit_id": unit_id,
+            "scene_type": _text(meta_info.get("global_scene_type")),
+            "interlocutor": _text(interlocutor.get("name")),
+            "relationship_tag": _text(interlocutor.get("relationship_tag")),
+            "active_persona": _text(response.get("active_persona")),
+            "mood_state": _text(response.get("mood_state")),
+            "trigger_type": _text(trigger.get("type")),
+            "unit_index": i,
+            "global_id": global_id if isinstance(global_id, int) else -1,
+            "trigger_len": trigger_len,
+            "monologue_len": len(_text(response.get("inner_monologue"))),
+            "action_len": len(_text(response.get("external_action"))),
+            "speech_len": len(_text(response.get("speech_text"))),
+            "output_len": output_len,
+        })
+    return rows
+
+# ==========================================
+# 2. 过滤表达式
+# ==========================================
+
+_COMPARE_OPS = {
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+}
+
+
+class FilterError(ValueError):
+    """过滤表达式不合法"""
+
+
+class _Mask:
+    """布尔掩码的最小运算集：numpy 可用时为 bool 数组，否则为 Python 列表"""
+
+    @staticmethod
+    def from_codes(codes, wanted: set):
+        if np is not None:
+            return np.isin(codes, np.fromiter(wanted, dtype=np.int32, count=len(wanted)))
+        return [c in wanted for c in codes]
+
+    @staticmethod
+    def compare(values, op, const):
+        if np is not None:
+            return op(values, const)
+        return [op(v, const) for v in values]
+
+    @staticmethod
+    def both(a, b):
+        return a & b if np is not None else [x and y for x, y in zip(a, b)]
+
+    @staticmethod
+    def either(a, b):
+        return a | b if np is not None else [x or y for x, y in zip(a, b)]
+
+    @staticmethod
+    def invert(a):
+        return ~a if np is not None else [not x for x in a]
+
+    @staticmethod
+    def indices(mask) -> List[int]:
+        if np is not None:
+            return np.flatnonzero(mask).tolist()
+        return [i for i, x in enumerate(mask) if x]
+
+# ==========================================
+# 3. 列式表
+# ==========================================
+
+class UnitTable:
+    """
+    列式交互单元表。
+    - 字符串列存储字典编码 (categories[col][code] 为原值)，相等/包含判断在类别上完成后转为编码集合匹配；
+    - 过滤表达式使用 Python 语法的子集：比较 (== != < <= > >=)、in / not in、and / or / not、括号。
+      `'羞' in mood_state` 表示子串匹配，`mood_state in ('羞涩', '害羞')` 表示取值属于集合。
+    """
+
+    def __init__(self, columns: Dict[str, Any], categories: Dict[str, List[str]], files: Dict[str, List[int]]):
+        self.columns = columns
+        self.categories = categories
+        self.files = files
+        self.num_rows = len(columns["unit_index"]) if columns else 0
+
+    # ---------- 构建与读写 ----------
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, Any]], paths: Iterable[str] = ()) -> "UnitTable":
+        """paths: 参与建表的全部源文件 (没有交互单元的文件也记录在 files 中，用于判断表是否覆盖输入)"""
+        lookup: Dict[str, Dict[str, int]] = {c: {} for c in STRING_COLUMNS}
+        columns = {c: array('i') for c in STRING_COLUMNS + INT_COLUMNS}
+        for row in rows:
+            for c in STRING_COLUMNS:
+                codes = lookup[c]
+                columns[c].append(codes.setdefault(row[c], len(codes)))
+            for c in INT_COLUMNS:
+                columns[c].append(row[c])
+        categories = {c: list(codes) for c, codes in lookup.items()}
+        files = {}
+        for path in list(categories["source_file"]) + [os.path.abspath(p) for p in paths]:
+            stat = os.stat(path)
+            files[path] = [stat.st_size, stat.st_mtime_ns]
+        return cls(cls._vectorize(columns), categories, files)
+
+    @staticmethod
+    def _vectorize(columns: Dict[str, array]) -> Dict[str, Any]:
+        if np is None:
+            return columns
+        return {c: np.frombuffer(values.tobytes(), dtype=np.int32) if len(values) else np.zeros(0, dtype=np.int32)
+                for c, values in columns.items()}
+
+    def save(self, table_dir: str):
+        os.makedirs(table_dir, exist_ok=True)
+        for c, values in self.columns.items():
+            data = array('i', values) if np is None else np.asarray(values, dtype='<i4')
+            if np is None and sys.byteorder == "big":
+                data.byteswap()
+            with open(os.path.join(table_dir, f"{c}.i32"), 'wb') as f:
+                f.write(data.tobytes())
+        meta = {"version": TABLE_VERSION, "rows": self.num_rows, "categories": self.categories, "files": self.files}
+        with open(os.path.join(table_dir, META_NAME + ".tmp"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(os.path.join(table_dir, META_NAME + ".tmp"), os.path.join(table_dir, META_NAME))
+
+    @classmethod
+    def load(cls, table_dir: str) -> "UnitTable":
+        with open(os.path.join(table_dir, META_NAME), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get("version") != TABLE_VERSION:
+            raise ValueError(f"列式表版本不兼容: {table_dir}")
+        columns = {}
+        for c in STRING_COLUMNS + INT_COLUMNS:
+            path = os.path.join(table_dir, f"{c}.i32")
+            if np is not None:
+                columns[c] = np.fromfile(path, dtype='<i4').astype(np.int32, copy=False)
+            else:
+                values = array('i')
+                with open(path, 'rb') as f:
+                    values.frombytes(f.read())
+                if sys.byteorder == "big":
+                    values.byteswap()
+                columns[c] = values
+        return cls(columns, meta["categories"], meta["files"])
+
+    def stale_files(self) -> List[str]:
+        """自建表后被修改或删除的源文件"""
+        stale = []
+        for path, (size, mtime_ns) in self.files.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append(path)
+                continue
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                stale.append(path)
+        return stale
+
+    def missing_files(self, paths: Iterable[str]) -> List[str]:
+        """不在表中的源文件 (建表时未包含)"""
+        return [p for p in map(os.path.abspath, paths) if p not in self.files]
+
+    def to_parquet(self, path: str):
+        """导出为 Parquet (需要 pyarrow)，字符串列以 dictionary 类型写出"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = {}
+        for c in STRING_COLUMNS:
+            arrays[c] = pa.DictionaryArray.from_arrays(pa.array(list(self.columns[c]), type=pa.int32()),
+                                                       pa.array(self.categories[c], type=pa.string()))
+        for c in INT_COLUMNS:
+            arrays[c] = pa.array(list(self.columns[c]), type=pa.int32())
+        pq.write_table(pa.table(arrays), path)
+
+    # ---------- 查询 ----------
+    def value(self, column: str, row: int) -> Any:
+        v = int(self.columns[column][row])
+        return self.categories[column][v] if column in self.categories else v
+
+    def rows(self, indices: Iterable[int], columns: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        columns = columns or list(STRING_COLUMNS + INT_COLUMNS)
+        return [{c: self.value(c, i) for c in columns} for i in indices]
+
+    def count_by(self, column: str, indices: Optional[List[int]] = None) -> Counter:
+        values = self.columns[column]
+        codes = Counter(values[i] for i in indices) if indices is not None else Counter(values)
+        if column in self.categories:
+            return Counter({self.categories[column][int(k)]: n for k, n in codes.items()})
+        return Counter({int(k): n for k, n in codes.items()})
+
+    def mask(self, expression: str):
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            raise FilterError(f"表达式语法错误: {e}")
+        return self._eval(tree.body)
+
+    def select(self, expression: Optional[str] = None) -> List[int]:
+        """返回满足表达式的行号 (升序)；表达式为空时返回全部行"""
+        if not expression:
+            return list(range(self.num_rows))
+        return _Mask.indices(self.mask(expression))
+
+    def selected_units(self, indices: Iterable[int]) -> Dict[str, List[int]]:
+        """行号 -> {源文件: [交互单元下标]}，供 convert_to_lora 只转换命中的单元"""
+        result: Dict[str, List[int]] = {}
+        for i in indices:
+            result.setdefault(self.value("source_file", i), []).append(self.value("unit_index", i))
+        return result
+
+    # ---------- 表达式求值 ----------
+    def _column_name(self, node) -> Optional[str]:
+        if isinstance(node, ast.Name):
+            if node.id not in self.columns:
+                raise FilterError(f"未知列: {node.id} (可用列: {', '.join(STRING_COLUMNS + INT_COLUMNS)})")
+            return node.id
+        return None
+
+    @staticmethod
+    def _literal(node):
+        try:
+            return ast.literal_eval(node)
+        except ValueError:
+            raise FilterError(f"只能与常量比较: {ast.dump(node)}")
+
+    def _codes_where(self, column: str, predicate) -> set:
+        return {code for code, v in enumerate(self.categories[column]) if predicate(v)}
+
+    def _eval(self, node):
+        if isinstance(node, ast.BoolOp):
+            combine = _Mask.both if isinstance(node.op, ast.And) else _Mask.either
+            result = self._eval(node.values[0])
+            for value in node.values[1:]:
+                result = combine(result, self._eval(value))
+            return result
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return _Mask.invert(self._eval(node.operand))
+        if isinstance(node, ast.Compare):
+            result = None
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                part = self._compare(left, op, right)
+                result = part if result is None else _Mask.both(result, part)
+                left = right
+            return result
+        raise FilterError(f"不支持的表达式: {ast.dump(node)}")
+
+    def _compare(self, left, op, right):
+        column = self._column_name(left)
+        # '子串' in 列 / '子串' not in 列
+        if column is None and isinstance(op, (ast.In, ast.NotIn)):
+            column = self._column_name(right)
+            if column is None or column not in self.categories:
+                raise FilterError("子串匹配的右侧必须是字符串列")
+            needle = str(self._literal(left))
+            mask = _Mask.from_codes(self.columns[column], self._codes_where(column, lambda v: needle in v))
+            return _Mask.invert(mask) if isinstance(op, ast.NotIn) else mask
+        if column is None:
+            # 常量在左侧：交换为 列 op 常量
+            column = self._column_name(right)
+            if column is None:
+                raise FilterError("比较两侧至少有一侧必须是列名")
+            flipped = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+            op = flipped.get(type(op), type(op))()
+            left, right = right, left
+
+        const = self._literal(right)
+        values = self.columns[column]
+        if isinstance(op, (ast.In, ast.NotIn)):
+            options = set(const) if isinstance(const, (list, tuple, set)) else {const}
+            if column in self.categories:
+                mask = _Mask.from_codes(values, self._codes_where(column, lambda v: v in options))
+            else:
+                self._check_number(column, *options)
+                mask = _Mask.from_codes(values, {int(o) for o in options})
+            return _Mask.invert(mask) if isinstance(op, ast.NotIn) else mask
+
+        fn = _COMPARE_OPS.get(type(op))
+        if fn is None:
+            raise FilterError(f"不支持的比较运算: {type(op).__name__}")
+        if column in self.categories:
+            # 字符串列：在类别上求值，再按编码集合匹配
+            return _Mask.from_codes(values, self._codes_where(column, lambda v: fn(v, str(const))))
+        self._check_number(column, const)
+        return _Mask.compare(values, fn, const)
+
+    @staticmethod
+    def _check_number(column: str, *consts):
+        # 整数列只能与数字比较：numpy 与纯 Python 对 int/str 比较的行为不一致 (报错或恒为 False)
+        for const in consts:
+            if isinstance(const, bool) or not isinstance(const, (int, float)):
+                raise FilterError(f"整数列 {column} 只能与数字比较: {const!r}")
+
+
+def build_table(input_paths: List[str], workers: int = 1, log=print) -> UnitTable:
+    """并行展平所有输入路径下的源文件"""
+    jobs = collect_jobs(input_paths, None, log)
+    if workers <= 1:
+        results = map(extract_rows, jobs)
+        return UnitTable.from_rows((row for rows in results for row in rows), [fp for fp, _ in jobs])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(extract_rows, jobs, chunksize=16)
+        return UnitTable.from_rows((row for rows in results for row in rows), [fp for fp, _ in jobs])
+
+# ==========================================
+# 4. 主程序
+# ==========================================
+
+def main():
+    parser = argparse.ArgumentParser(description="交互单元列式表：构建与查询")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="从 cleaned_* 目录构建列式表")
+    p_build.add_argument("--input", "-i", nargs="+", required=True, help="输入目录或文件 (同 convert_to_lora.py)")
+    p_build.add_argument("--table", "-t", default=DEFAULT_TABLE_DIR, help="表目录")
+    p_build.add_argument("--workers", "-w", type=int, default=os.cpu_count() or 1, help="并行进程数")
+    p_build.add_argument("--parquet", type=str, help="额外导出 Parquet 文件 (需要 pyarrow)")
+
+    p_query = sub.add_parser("query", help="按表达式过滤并统计")
+    p_query.add_argument("expression", nargs="?", help="过滤表达式，如 \"scene_type == 'Romance' and mood_state == '羞涩'\"")
+    p_query.add_argument("--table", "-t", default=DEFAULT_TABLE_DIR, help="表目录")
+    p_query.add_argument("--group-by", "-g", action="append", default=[], help="按列统计数量 (可多次指定)")
+    p_query.add_argument("--head", type=int, default=5, help="显示前 N 行")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        table = build_table(args.input, args.workers)
+        table.save(args.table)
+        print(f"[Success] {table.num_rows} 个交互单元 ({len(table.files)} 个文件) -> {args.table}")
+        if args.parquet:
+            table.to_parquet(args.parquet)
+            print(f"[Output] Parquet: {args.parquet}")
+        return
+
+    table = UnitTable.load(args.table)
+    stale = table.stale_files()
+    if stale:
+        print(f"[Warning] 建表后有 {len(stale)} 个源文件已变化，建议重新执行 build")
+    try:
+        indices = table.select(args.expression)
+    except FilterError as e:
+        print(f"[Error] {e}")
+        sys.exit(1)
+    print(f"命中 {len(indices)} / {table.num_rows} 行")
+    for column in args.group_by:
+        print(f"\n按 {column} 统计:")
+        for value, n in table.count_by(column, indices).most_common():
+            print(f"  {value or '(空)'}: {n}")
+    if args.head:
+        show = ["chapter_id", "unit_id", "scene_type", "interlocutor", "mood_state", "active_persona", "output_len"]
+        print()
+        for row in table.rows(indices[:args.head], show):
+            print("  " + " | ".join(f"{k}={v}" for k, v in row.items()))
+
+if __name__ == "__main__":
+    main()
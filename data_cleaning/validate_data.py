@@ -9,8 +9,10 @@ import json
 import glob
 import sys
 import re
+import hashlib
 import logging
-from typing import List, Optional, Literal, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Literal, Dict, Any, Callable, Tuple
 from pydantic import BaseModel, ValidationError
 
 # 获取当前脚本所在目录 (data_cleaning)
@@ -84,82 +86,137 @@ def extract_json_structure(text: str) -> Optional[Dict]:
         logger.warning(f"Failed to parse JSON schema from text: {e}")
         return None
 
-def validate_structure(data: Any, template: Any, path: str = "") -> List[str]:
+# ==========================================
+# Compiled Validator
+# ==========================================
+
+# 编译后的检查函数: (data, path, errors) -> None
+Checker = Callable[[Any, str, List[str]], None]
+
+def _compile_template(template: Any) -> Optional[Checker]:
     """
-    Recursively check if `data` has the same keys/structure as `template`.
-    Returns a list of error messages.
+    将模板结构预编译为嵌套的检查闭包：模板中的每个键都必须存在，列表模板的第一个元素代表列表项结构。
+    叶子节点 (str/int 等) 只需检查键存在，编译为 None，运行时不再递归。
     """
-    errors = []
-    
     if isinstance(template, dict):
-        if not isinstance(data, dict):
-            errors.append(f"{path}: Expected dict, got {type(data).__name__}")
-            return errors
-        
-        for k, v in template.items():
-            if k not in data:
-                errors.append(f"{path}: Missing key '{k}'")
-            else:
-                errors.extend(validate_structure(data[k], v, path=f"{path}.{k}" if path else k))
-                
-    elif isinstance(template, list):
-        if not isinstance(data, list):
-            errors.append(f"{path}: Expected list, got {type(data).__name__}")
-            return errors
-        
-        if not template:
-            return [] # Empty list in template means "list of anything" or just list
-            
-        # We assume the list in template has 1 item representing the schema of items
-        item_template = template[0]
-        for i, item in enumerate(data):
-            errors.extend(validate_structure(item, item_template, path=f"{path}[{i}]"))
-            
-    # For other types (str, int, etc.), we don't validate specific values, just presence is enough via parent dict check.
-    # The template values like "Description..." are ignored, only keys matter.
-    
-    return errors
+        fields = [(k, _compile_template(v)) for k, v in template.items()]
 
-def validate_dynamic(file_path: str, schema_path: str) -> bool:
-    """Validate JSON file against a schema file."""
+        def check_dict(data: Any, path: str, errors: List[str]):
+            if not isinstance(data, dict):
+                errors.append(f"{path}: Expected dict, got {type(data).__name__}")
+                return
+            for k, child in fields:
+                if k not in data:
+                    errors.append(f"{path}: Missing key '{k}'")
+                elif child is not None:
+                    child(data[k], f"{path}.{k}" if path else k, errors)
+        return check_dict
+
+    if isinstance(template, list):
+        # 空列表表示任意列表；否则第一个元素代表列表项的结构
+        item = _compile_template(template[0]) if template else None
+
+        def check_list(data: Any, path: str, errors: List[str]):
+            if not isinstance(data, list):
+                errors.append(f"{path}: Expected list, got {type(data).__name__}")
+                return
+            if item is not None:
+                for i, value in enumerate(data):
+                    item(value, f"{path}[{i}]", errors)
+        return check_list
+
+    return None
+
+class SchemaValidator:
+    """由 Schema 文件编译得到的可复用校验器，同一 Schema 文件只解析一次"""
+    _cache: Dict[Tuple[str, int], Optional["SchemaValidator"]] = {}
+
+    def __init__(self, template: Any, fingerprint: str = ""):
+        self.template = template
+        # Schema 内容指纹，用于文件级校验结果缓存的失效判断
+        self.fingerprint = fingerprint
+        self._check = _compile_template(template)
+
+    @classmethod
+    def from_file(cls, schema_path: str) -> Optional["SchemaValidator"]:
+        """加载并编译 Schema 文件；按 (路径, 修改时间) 缓存，文件更新后自动重新编译"""
+        key = (os.path.abspath(schema_path), os.stat(schema_path).st_mtime_ns)
+        if key not in cls._cache:
+            with open(schema_path, 'r', encoding='utf-8') as f:
+                schema_text = f.read()
+            template = extract_json_structure(schema_text)
+            fingerprint = hashlib.sha1(schema_text.encode('utf-8')).hexdigest()
+            # 无法解析的 Schema 同样缓存为 None，避免每个文件重复解析与告警
+            cls._cache[key] = cls(template, fingerprint) if template else None
+        return cls._cache[key]
+
+    def validate(self, data: Any) -> List[str]:
+        """返回错误信息列表，空列表表示通过"""
+        errors: List[str] = []
+        if self._check is not None:
+            self._check(data, "", errors)
+        return errors
+
+def _log_errors(name: str, errors: List[str]):
+    logger.error(f"Schema 校验失败: {name}")
+    for err in errors[:10]: # Limit error output
+        logger.error(f"  - {err}")
+    if len(errors) > 10:
+        logger.error(f"  - ... (共 {len(errors)} 个错误)")
+
+def _legacy_errors(data: Any) -> List[str]:
+    """旧版硬编码的 Pydantic 校验 (AnalysisOutput)，返回错误信息列表"""
     try:
-        # Load Data
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read().strip()
-            if not content:
-                logger.warning(f"文件为空: {file_path}")
-                return False
-            data = json.loads(content)
-            
-        # Load Schema
-        with open(schema_path, 'r', encoding='utf-8') as f:
-            schema_text = f.read()
-            
-        template = extract_json_structure(schema_text)
-        if not template:
-            logger.error(f"无法从 {schema_path} 提取有效的 JSON 结构模板")
-            return False
-            
-        errors = validate_structure(data, template)
+        AnalysisOutput.model_validate(data)
+        return []
+    except ValidationError as e:
+        return [f"Schema 不匹配 (Legacy): {err['loc']} {err['msg']}" for err in e.errors()]
+
+def validate_data_dynamic(data: Any, schema_path: str, name: str = "<memory>") -> bool:
+    """
+    Validate an already-loaded JSON object against a schema file.
+    Schema 中提取不出 JSON 模板 (如默认的 TypeScript Interface 形式的 output_schema.txt) 时退回 AnalysisOutput 校验。
+    """
+    try:
+        validator = SchemaValidator.from_file(schema_path)
+        errors = validator.validate(data) if validator else _legacy_errors(data)
         
         if errors:
-            logger.error(f"Schema 校验失败: {os.path.basename(file_path)}")
-            for err in errors[:10]: # Limit error output
-                logger.error(f"  - {err}")
-            if len(errors) > 10:
-                logger.error(f"  - ... (共 {len(errors)} 个错误)")
+            _log_errors(name, errors)
             return False
             
-        logger.info(f"[PASS] {os.path.basename(file_path)}")
+        logger.info(f"[PASS] {name}")
         return True
 
-    except json.JSONDecodeError:
-        logger.error(f"JSON 格式错误: {file_path}")
+    except Exception as e:
+        logger.error(f"动态校验发生错误: {str(e)}")
         return False
+
+def _load_json_file(file_path: str) -> Tuple[Optional[Any], Optional[str]]:
+    """读取 JSON 文件，返回 (数据, 错误信息)"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    if not content:
+        return None, f"文件为空: {file_path}"
+    try:
+        return json.loads(content), None
+    except json.JSONDecodeError:
+        return None, f"JSON 格式错误: {file_path}"
+
+def validate_dynamic(file_path: str, schema_path: str) -> bool:
+    """Validate JSON file against a schema file."""
+    try:
+        # Load Data
+        data, error = _load_json_file(file_path)
+        if error:
+            logger.error(error)
+            return False
     except Exception as e:
         logger.error(f"动态校验发生错误: {str(e)}")
         return False
 
+    return validate_data_dynamic(data, schema_path, name=os.path.basename(file_path))
+
 # ==========================================
 # Main Validation Logic
 # ==========================================
@@ -193,12 +250,58 @@ def validate_one(file_path: str, schema_file: Optional[str] = None) -> bool:
         logger.error(f"处理 {file_path} 时发生未知错误: {str(e)}")
         return False
 
-def validate_path(path: str, schema_file: Optional[str] = None):
-    """入口函数：根据路径是文件还是目录分发处理逻辑。"""
+def _check_file(args: Tuple[str, Optional[str], str, Optional[Dict]]) -> Tuple[str, str, bool, List[str], bool]:
+    """
+    进程池工作函数：计算内容哈希，与缓存条目一致时直接复用结论，否则校验。
+    返回 (路径, 哈希, 是否通过, 错误信息, 是否命中缓存)；子进程中不输出日志，由主进程统一汇总打印。
+    """
+    file_path, schema_file, salt, cached = args
+    digest = ""
+    try:
+        digest = _file_digest(file_path, salt)
+        if cached and cached.get("hash") == digest:
+            return file_path, digest, cached["ok"], cached.get("errors", []), True
+        data, error = _load_json_file(file_path)
+        if error:
+            return file_path, digest, False, [error], False
+        if schema_file and os.path.exists(schema_file):
+            validator = SchemaValidator.from_file(schema_file)
+            errors = validator.validate(data) if validator else _legacy_errors(data)
+        else:
+            errors = _legacy_errors(data)
+        return file_path, digest, not errors, errors, False
+    except Exception as e:
+        return file_path, digest, False, [f"处理 {file_path} 时发生未知错误: {str(e)}"], False
+
+def _file_digest(file_path: str, salt: str) -> str:
+    """文件内容哈希 (加入 Schema 指纹，Schema 变化后缓存自动失效)"""
+    h = hashlib.sha1(salt.encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+CACHE_FILE_NAME = ".validation_cache.json"
+
+def _collect(checked, root: str, results: Dict[str, Tuple[bool, List[str]]], digests: Dict[str, str]) -> int:
+    """汇总 _check_file 的返回值，返回缓存命中数"""
+    hits = 0
+    for f, digest, ok, errors, hit in checked:
+        results[f] = (ok, errors)
+        digests[os.path.relpath(f, root)] = digest
+        hits += hit
+    return hits
+
+def validate_path(path: str, schema_file: Optional[str] = None, workers: Optional[int] = None,
+                  use_cache: bool = True) -> Tuple[int, int]:
+    """
+    入口函数：根据路径是文件还是目录分发处理逻辑，返回 (通过数, 失败数)。
+    目录模式下使用进程池并行校验，并按内容哈希缓存结果，未变化的文件直接复用上次结论。
+    """
     if os.path.isfile(path):
         logger.info(f"校验单文件: {path}")
-        validate_one(path, schema_file)
-        return
+        ok = validate_one(path, schema_file)
+        return (1, 0) if ok else (0, 1)
 
     # 目录逻辑
     json_files = glob.glob(os.path.join(path, "**", "*.json"), recursive=True)
@@ -206,20 +309,63 @@ def validate_path(path: str, schema_file: Optional[str] = None):
     
     if not target_files:
         logger.warning(f"在 {path} 中未找到 JSON 文件")
-        return
+        return 0, 0
 
     logger.info(f"在 {path} 中找到 {len(target_files)} 个 JSON 文件。开始校验...")
+
+    # 结果缓存: 相对路径 -> {hash, ok, errors}
+    cache_path = os.path.join(path, CACHE_FILE_NAME)
+    cache: Dict[str, Dict] = {}
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except Exception as e:
+            logger.warning(f"无法读取校验缓存 {cache_path}: {e}")
+
+    salt = "legacy"
+    if schema_file and os.path.exists(schema_file):
+        validator = SchemaValidator.from_file(schema_file)
+        salt = validator.fingerprint if validator else "invalid"
+
+    # 哈希与缓存比对也在工作进程中完成，主进程只分发任务与汇总结果
+    results: Dict[str, Tuple[bool, List[str]]] = {}
+    digests: Dict[str, str] = {}
+    tasks = [(f, schema_file, salt, cache.get(os.path.relpath(f, path))) for f in target_files]
+    if len(tasks) == 1 or workers == 1:
+        checked = map(_check_file, tasks)
+        hits = _collect(checked, path, results, digests)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(tasks) // ((workers or os.cpu_count() or 1) * 4))
+            hits = _collect(pool.map(_check_file, tasks, chunksize=chunksize), path, results, digests)
+    if hits:
+        logger.info(f"缓存命中 {hits} 个未变化文件，实际校验 {len(target_files) - hits} 个")
+
     passed = 0
     failed = 0
-    
+    new_cache = {}
     for f in target_files:
-        if validate_one(f, schema_file):
+        ok, errors = results[f]
+        rel = os.path.relpath(f, path)
+        new_cache[rel] = {"hash": digests[rel], "ok": ok, "errors": errors[:10]}
+        if ok:
             passed += 1
+            logger.info(f"[PASS] {os.path.basename(f)}")
         else:
             failed += 1
+            _log_errors(os.path.basename(f), errors)
+
+    if use_cache:
+        try:
+            with open(cache_path, 'w', encoding='utf-8') as fp:
+                json.dump(new_cache, fp, ensure_ascii=False)
+        except Exception as e:
+            logger.warning(f"无法写入校验缓存 {cache_path}: {e}")
             
     logger.info("-" * 30)
     logger.info(f"校验完成。总数: {len(target_files)}, 通过: {passed}, 失败: {failed}")
+    return passed, failed
 
 if __name__ == "__main__":
     target = os.path.join(PROJECT_ROOT, "novel_data", "lora_dataset")
@@ -229,6 +375,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path", nargs="?", default=target, help="Target file or directory")
     parser.add_argument("--schema", help="Path to schema definition file")
+    parser.add_argument("--workers", type=int, help="并行校验进程数 (默认 CPU 核数)")
+    parser.add_argument("--no-cache", action="store_true", help="忽略并且不写入按内容哈希缓存的校验结果")
     args = parser.parse_args()
-    
-    validate_path(args.path, args.schema)
+
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    validate_path(args.path, args.schema, workers=args.workers, use_cache=not args.no_cache)
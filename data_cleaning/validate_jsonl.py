@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+训练集校验脚本 (JSONL Validator)
+功能：校验 convert_to_lora.py 生成的 Alpaca 格式 JSONL 训练文件 (lora_dataset_*.jsonl)。
+检查项：JSON 合法性、必需字段、空输出、<think>/<mood:...> 等标签结构、重复 ID。
+实现：按字节区间切分为若干分片 (对齐到行边界)，多进程逐行流式读取，单个进程内存占用与文件大小无关。
+"""
+import os
+import re
+import sys
+import json
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Any
+
+# 获取当前脚本所在目录 (data_cleaning)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# 获取项目根目录 (即 data_cleaning 的上一级)
+PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
+DEFAULT_DATASET_DIR = os.path.join(PROJECT_ROOT, "novel_data", "lora_train_dataset")
+
+REQUIRED_FIELDS = ("instruction", "input", "output")
+MOOD_RE = re.compile(r"<mood:([^<>]*)>")
+# 成对出现的标签 (think 为旧版格式与 v1.2 共用；action/dialogue 为 v1.2 格式)
+PAIRED_TAGS = ("think", "action", "dialogue")
+
+# ==========================================
+# 1. 单行校验
+# ==========================================
+
+def check_output_tags(output: str, require_mood: bool = False) -> List[str]:
+    """检查 output 的标签结构，返回问题列表"""
+    problems = []
+    for tag in PAIRED_TAGS:
+        opens = output.count(f"<{tag}>")
+        closes = output.count(f"</{tag}>")
+        if opens != closes:
+            problems.append(f"<{tag}> 标签不成对 (开 {opens} / 闭 {closes})")
+        elif opens and output.find(f"</{tag}>") < output.find(f"<{tag}>"):
+            problems.append(f"</{tag}> 出现在 <{tag}> 之前")
+
+    if output.count("<think>") > 1:
+        problems.append("包含多个 <think> 段")
+    elif "<think>" in output:
+        start = output.find("<think>") + len("<think>")
+        end = output.find("</think>")
+        if end >= start and not output[start:end].strip():
+            problems.append("<think> 内容为空")
+
+    moods = list(MOOD_RE.finditer(output))
+    if len(moods) > 1:
+        problems.append("包含多个 <mood:...> 标签")
+    elif moods:
+        if not moods[0].group(1).strip():
+            problems.append("<mood:...> 标签为空")
+        if moods[0].end() != len(output.rstrip()):
+            problems.append("<mood:...> 标签不在末尾")
+        # 旧版格式: <think>...</think> *action* speech <mood:...>
+        if not output.lstrip().startswith("<think>"):
+            problems.append("旧版格式应以 <think> 开头")
+    elif require_mood:
+        problems.append("缺少 <mood:...> 标签")
+    return problems
+
+
+def check_entry(entry: Any, require_mood: bool = False) -> List[str]:
+    """检查一条样本，返回问题列表"""
+    if not isinstance(entry, dict):
+        return [f"应为 JSON 对象，实际为 {type(entry).__name__}"]
+    problems = []
+    for field in REQUIRED_FIELDS:
+        if field not in entry:
+            problems.append(f"缺少字段 '{field}'")
+        elif not isinstance(entry[field], str):
+            problems.append(f"字段 '{field}' 应为字符串")
+    if problems:
+        return problems
+    if not entry["instruction"].strip():
+        problems.append("instruction 为空")
+    if not entry["output"].strip():
+        problems.append("output 为空")
+    else:
+        problems.extend(check_output_tags(entry["output"], require_mood))
+    return problems
+
+# ==========================================
+# 2. 分片与并行
+# ==========================================
+
+def compute_shards(path: str, num_shards: int) -> List[Tuple[int, int]]:
+    """按字节将文件切成 num_shards 段，每段起点对齐到下一行开头"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    num_shards = max(1, min(num_shards, size))
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, num_shards):
+            f.seek(size * i // num_shards)
+            f.readline()  # 跳到下一行开头
+            pos = f.tell()
+            if pos > bounds[-1] and pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def validate_shard(args: Tuple[str, int, int, bool, int]) -> Dict[str, Any]:
+    """
+    进程池工作函数：逐行校验 [start, end) 字节区间。
+    行号为分片内的相对行号 (从 1 开始)，由主进程加上前序分片的行数偏移。
+    """
+    path, start, end, require_mood, max_errors = args
+    errors = []
+    error_count = 0
+    ids: Dict[Any, int] = {}
+    duplicates = []
+    lines = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            raw = f.readline()
+            if not raw:
+                break
+            pos += len(raw)
+            lines += 1
+            line = raw.strip()
+            if not line:
+                problems = ["空行"]
+                entry = None
+            else:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                    problems = check_entry(entry, require_mood)
+                except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                    entry = None
+                    problems = [f"JSON 解析失败: {e}"]
+
+            if isinstance(entry, dict) and "id" in entry:
+                key = entry["id"]
+                if not isinstance(key, (str, int, float, bool)) and key is not None:
+                    key = json.dumps(key, ensure_ascii=False, sort_keys=True)
+                if key in ids:
+                    duplicates.append((key, ids[key], lines))
+                else:
+                    ids[key] = lines
+
+            if problems:
+                error_count += 1
+                if len(errors) < max_errors:
+                    errors.append((lines, problems))
+    return {"lines": lines, "errors": errors, "error_count": error_count, "ids": ids, "duplicates": duplicates}
+
+
+def validate_jsonl(path: str, workers: int = None, require_mood: bool = False, max_errors: int = 50) -> Dict[str, Any]:
+    """并行校验单个 JSONL 文件，返回汇总报告 (行号为全局行号)"""
+    workers = workers or os.cpu_count() or 1
+    shards = compute_shards(path, workers)
+    tasks = [(path, s, e, require_mood, max_errors) for s, e in shards]
+    if len(tasks) <= 1:
+        results = [validate_shard(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(validate_shard, tasks))
+
+    report = {"path": path, "lines": 0, "error_count": 0, "errors": [], "duplicate_ids": []}
+    seen: Dict[Any, int] = {}
+    offset = 0
+    for res in results:
+        for line_no, problems in res["errors"]:
+            if len(report["errors"]) < max_errors:
+                report["errors"].append((offset + line_no, problems))
+        report["error_count"] += res["error_count"]
+        for key, first, dup in res["duplicates"]:
+            report["duplicate_ids"].append((key, offset + first, offset + dup))
+        # 跨分片的重复 ID
+        for key, line_no in res["ids"].items():
+            if key in seen:
+                report["duplicate_ids"].append((key, seen[key], offset + line_no))
+            else:
+                seen[key] = offset + line_no
+        offset += res["lines"]
+    report["lines"] = offset
+    report["duplicate_ids"].sort(key=lambda d: d[2])
+    return report
+
+
+def print_report(report: Dict[str, Any], max_errors: int = 50) -> bool:
+    """打印报告，返回是否通过"""
+    name = os.path.basename(report["path"])
+    dup_count = len(report["duplicate_ids"])
+    passed = report["error_count"] == 0 and dup_count == 0
+    mark = "[PASS]" if passed else "[FAIL]"
+    print(f"{mark} {name} | 行数: {report['lines']} | 问题行: {report['error_count']} | 重复 ID: {dup_count}")
+    for line_no, problems in report["errors"][:max_errors]:
+        print(f"  - 第 {line_no} 行: {'; '.join(problems)}")
+    if report["error_count"] > len(report["errors"][:max_errors]):
+        print(f"  - ... (共 {report['error_count']} 行存在问题)")
+    for key, first, dup in report["duplicate_ids"][:max_errors]:
+        print(f"  - 重复 ID {key!r}: 第 {first} 行与第 {dup} 行")
+    if dup_count > max_errors:
+        print(f"  - ... (共 {dup_count} 个重复 ID)")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="校验 Alpaca 格式 JSONL 训练文件")
+    parser.add_argument("paths", nargs="*", help="JSONL 文件或目录 (默认 novel_data/lora_train_dataset)")
+    parser.add_argument("--workers", "-w", type=int, help="并行进程数 / 分片数 (默认 CPU 核数)")
+    parser.add_argument("--require-mood", action="store_true", help="要求每条 output 以 <mood:...> 结尾 (旧版格式)")
+    parser.add_argument("--max-errors", type=int, default=50, help="每个文件最多输出的问题条数")
+    args = parser.parse_args()
+
+    files = []
+    for p in args.paths or [DEFAULT_DATASET_DIR]:
+        if os.path.isdir(p):
+            files.extend(sorted(glob.glob(os.path.join(p, "*.jsonl"))))
+        elif os.path.isfile(p):
+            files.append(p)
+        else:
+            print(f"[Error] 路径不存在: {p}")
+    if not files:
+        print("[Warning] 未找到 JSONL 文件")
+        sys.exit(1)
+
+    all_passed = True
+    for path in files:
+        report = validate_jsonl(path, workers=args.workers, require_mood=args.require_mood, max_errors=args.max_errors)
+        all_passed = print_report(report, args.max_errors) and all_passed
+    if not all_passed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+分布式任务队列 (Work Queue)
+功能：基于 SQLite 的章节任务队列，供多台机器上的清洗 Worker 以“租约 (Lease)”方式认领任务。
+说明：数据库文件可放在共享卷上；SQLite 自带文件锁，BEGIN IMMEDIATE 保证认领操作的原子性。
+任务与统计按运行 (run_id) 隔离：协调端每次启动开启新的运行，上一次运行残留的任务与统计不会混入。
+"""
+
+import os
+import time
+import json
+import uuid
+import sqlite3
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Any
+
+# 任务状态
+STATUS_PENDING = "pending"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS tasks (
+    run_id       TEXT NOT NULL,
+    chapter      TEXT NOT NULL,
+    status       TEXT NOT NULL DEFAULT 'pending',
+    worker       TEXT,
+    lease_until  REAL,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    result_path  TEXT,
+    error        TEXT,
+    updated_at   REAL,
+    PRIMARY KEY (run_id, chapter)
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (run_id, status, lease_until);
+CREATE TABLE IF NOT EXISTS worker_stats (
+    run_id             TEXT NOT NULL,
+    worker             TEXT NOT NULL,
+    session            TEXT NOT NULL,
+    host               TEXT,
+    success            INTEGER NOT NULL DEFAULT 0,
+    failed             INTEGER NOT NULL DEFAULT 0,
+    skipped            INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens      INTEGER NOT NULL DEFAULT 0,
+    completion_tokens  INTEGER NOT NULL DEFAULT 0,
+    cost_cny           REAL NOT NULL DEFAULT 0,
+    updated_at         REAL,
+    PRIMARY KEY (run_id, worker, session)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key    TEXT PRIMARY KEY,
+    value  TEXT
+);
+"""
+
+
+class WorkQueue:
+    """
+    章节任务队列。
+    - 协调端调用 `enqueue` 写入任务；
+    - Worker 调用 `claim` 认领任务并获得租约，处理期间调用 `renew` 续约；
+    - 租约过期 (Worker 崩溃/断网) 的任务会被其他 Worker 重新认领，过期重领同样计入尝试次数。
+    未指定 run_id 时使用协调端最近一次开启的运行；Worker 在启动时固定 run_id，旧运行的 Worker 不会改动新运行的任务。
+    """
+
+    def __init__(self, db_path: str, timeout: float = 30.0, run_id: Optional[str] = None):
+        self.db_path = db_path
+        self.timeout = timeout
+        parent = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(parent, exist_ok=True)
+        with self._connect() as conn:
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(tasks)").fetchall()]
+            if columns and "run_id" not in columns:
+                # 旧版队列 (不区分运行)：队列状态可以重建，直接丢弃
+                conn.executescript("DROP TABLE IF EXISTS tasks; DROP TABLE IF EXISTS worker_stats;")
+            conn.executescript(SCHEMA_SQL)
+        self.run_id = run_id or self.get_meta().get("run_id")
+
+    @contextmanager
+    def _connect(self):
+        # isolation_level=None: 由我们显式控制 BEGIN/COMMIT；退出时关闭连接 (sqlite3 的 with 只提交不关闭)
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    # ------------------------------------------
+    # 元信息 (角色、模板、输出目录等运行参数)
+    # ------------------------------------------
+    def set_meta(self, values: Dict[str, Any]):
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in values.items()]
+            )
+
+    def get_meta(self) -> Dict[str, Any]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, value FROM meta").fetchall()
+        return {row["key"]: json.loads(row["value"]) for row in rows}
+
+    def start_run(self, meta: Dict[str, Any]) -> str:
+        """开启新的运行：写入元信息并清除旧运行的任务与统计，返回 run_id"""
+        self.run_id = uuid.uuid4().hex
+        self.set_meta(dict(meta, run_id=self.run_id))
+        with self._connect() as conn:
+            conn.execute("DELETE FROM tasks WHERE run_id != ?", (self.run_id,))
+            conn.execute("DELETE FROM worker_stats WHERE run_id != ?", (self.run_id,))
+        return self.run_id
+
+    # ------------------------------------------
+    # 任务生命周期
+    # ------------------------------------------
+    def enqueue(self, chapters: List[str]) -> int:
+        """向当前运行写入任务 (本次运行中已存在的章节保持原状态)，返回新增数量"""
+        now = time.time()
+        with self._connect() as conn:
+            before = conn.execute("SELECT COUNT(*) FROM tasks WHERE run_id = ?", (self.run_id,)).fetchone()[0]
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (run_id, chapter, status, updated_at) VALUES (?, ?, ?, ?)",
+                [(self.run_id, c, STATUS_PENDING, now) for c in chapters]
+            )
+            after = conn.execute("SELECT COUNT(*) FROM tasks WHERE run_id = ?", (self.run_id,)).fetchone()[0]
+        return after - before
+
+    def claim(self, worker: str, lease_seconds: float, limit: int = 1, max_attempts: int = 3) -> List[str]:
+        """
+        认领最多 limit 个待处理或租约已过期的任务。
+        租约过期且已达到最大尝试次数的任务 (如每次都让 Worker 崩溃的章节) 标记为失败，不再重领。
+        """
+        now = time.time()
+        with self._connect() as conn:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    "UPDATE tasks SET status = ?, lease_until = NULL, error = ?, updated_at = ? "
+                    "WHERE run_id = ? AND status = ? AND lease_until < ? AND attempts >= ?",
+                    (STATUS_FAILED, "lease expired", now, self.run_id, STATUS_LEASED, now, max_attempts)
+                )
+                rows = conn.execute(
+                    "SELECT chapter FROM tasks "
+                    "WHERE run_id = ? AND (status = ? OR (status = ? AND lease_until < ?)) "
+                    "ORDER BY chapter LIMIT ?",
+                    (self.run_id, STATUS_PENDING, STATUS_LEASED, now, limit)
+                ).fetchall()
+                chapters = [row["chapter"] for row in rows]
+                conn.executemany(
+                    "UPDATE tasks SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                    "WHERE run_id = ? AND chapter = ?",
+                    [(STATUS_LEASED, worker, now + lease_seconds, now, self.run_id, c) for c in chapters]
+                )
+                conn.execute("COMMIT")
+                return chapters
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def renew(self, chapters: List[str], worker: str, lease_seconds: float) -> List[str]:
+        """为仍由本 Worker 持有的任务续约，返回续约成功的章节"""
+        now = time.time()
+        renewed = []
+        with self._connect() as conn:
+            for c in chapters:
+                cur = conn.execute(
+                    "UPDATE tasks SET lease_until = ?, updated_at = ? "
+                    "WHERE run_id = ? AND chapter = ? AND worker = ? AND status = ?",
+                    (now + lease_seconds, now, self.run_id, c, worker, STATUS_LEASED)
+                )
+                if cur.rowcount:
+                    renewed.append(c)
+        return renewed
+
+    def complete(self, chapter: str, worker: str, result_path: str) -> bool:
+        """提交结果。若租约已被他人接管则返回 False (结果作废)"""
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE tasks SET status = ?, result_path = ?, lease_until = NULL, error = NULL, updated_at = ? "
+                "WHERE run_id = ? AND chapter = ? AND worker = ? AND status = ?",
+                (STATUS_DONE, result_path, time.time(), self.run_id, chapter, worker, STATUS_LEASED)
+            )
+            return cur.rowcount > 0
+
+    def fail(self, chapter: str, worker: str, error: str, max_attempts: int = 3):
+        """记录失败；未达到最大尝试次数时放回队列"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "lease_until = NULL, error = ?, updated_at = ? "
+                "WHERE run_id = ? AND chapter = ? AND worker = ? AND status = ?",
+                (max_attempts, STATUS_FAILED, STATUS_PENDING, error, time.time(), self.run_id, chapter, worker, STATUS_LEASED)
+            )
+
+    # ------------------------------------------
+    # 统计汇总
+    # ------------------------------------------
+    def report_stats(self, worker: str, host: str, summary: Dict[str, Any], session: str = ""):
+        """
+        Worker 上报自身累计统计 (覆盖写入本进程的记录)。
+        session 区分同一 worker 标识的不同进程 (如重启的本机 Worker)，汇总时按 worker 相加，互不覆盖。
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO worker_stats "
+                "(run_id, worker, session, host, success, failed, skipped, prompt_tokens, completion_tokens, cost_cny, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.run_id, worker, session, host, summary["success"], summary["failed"], summary["skipped"],
+                 summary["prompt_tokens"], summary["completion_tokens"], summary["cost_cny"], time.time())
+            )
+
+    def progress(self) -> Dict[str, int]:
+        """各状态任务数量 (租约过期的任务计入 pending)"""
+        now = time.time()
+        counts = {STATUS_PENDING: 0, STATUS_LEASED: 0, STATUS_DONE: 0, STATUS_FAILED: 0}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT CASE WHEN status = ? AND lease_until < ? THEN ? ELSE status END AS s, COUNT(*) AS n "
+                "FROM tasks WHERE run_id = ? GROUP BY s",
+                (STATUS_LEASED, now, STATUS_PENDING, self.run_id)
+            ).fetchall()
+        for row in rows:
+            counts[row["s"]] = row["n"]
+        counts["total"] = sum(counts.values())
+        return counts
+
+    def aggregate_stats(self) -> Dict[str, Any]:
+        """汇总所有 Worker 的统计"""
+        with self._connect() as conn:
+            rows = [dict(r) for r in conn.execute(
+                "SELECT worker, MAX(host) AS host, COUNT(*) AS sessions, SUM(success) AS success, SUM(failed) AS failed, "
+                "SUM(skipped) AS skipped, SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens, "
+                "SUM(cost_cny) AS cost_cny, MAX(updated_at) AS updated_at "
+                "FROM worker_stats WHERE run_id = ? GROUP BY worker ORDER BY worker",
+                (self.run_id,)
+            ).fetchall()]
+        total = {"success": 0, "failed": 0, "skipped": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_cny": 0.0}
+        for r in rows:
+            for k in total:
+                total[k] += r[k]
+        total["cost_cny"] = round(total["cost_cny"], 4)
+        return {"workers": rows, "total": total}
+
+    def results(self) -> List[str]:
+        """当前运行中已完成任务的结果文件路径"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT result_path FROM tasks WHERE run_id = ? AND status = ? AND result_path IS NOT NULL ORDER BY chapter",
+                (self.run_id, STATUS_DONE)
+            ).fetchall()
+        return [row["result_path"] for row in rows]
+
+    def is_drained(self) -> bool:
+        """没有待处理或处理中的任务"""
+        counts = self.progress()
+        return counts[STATUS_PENDING] == 0 and counts[STATUS_LEASED] == 0
@@ -7,6 +7,8 @@
 import os
 import json
 import sys
+import argparse
+from weight_integrity import verify_model_dir
 
 # 获取路径信息
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -31,7 +33,7 @@ def print_status(item, status, message=""):
     mark = "✅ [PASS]" if status else "❌ [FAIL]"
     print(f"{mark} {item:<20} | {message}")
 
-def check_environment():
+def check_environment(verify_weights: bool = True, workers: int = None):
     print("=== 开始环境自检 ===\n")
     print(f"部署根目录: {TRAIN_ENV_DIR}\n")
     
@@ -52,6 +54,18 @@ def check_environment():
         if subdirs:
             print_status("基座模型", True, f"发现模型: {', '.join(subdirs)}")
             model_exists = True
+            # 权重完整性：分片齐全、文件头与大小一致、哈希与清单一致 (已校验文件按大小+修改时间缓存)
+            for d in subdirs:
+                model_dir = os.path.join(MODELS_DIR, d)
+                if not any(f.endswith(".safetensors") for f in os.listdir(model_dir)):
+                    continue
+                result = verify_model_dir(model_dir, workers, hash_files=verify_weights)
+                detail = f"{d}: {len(result['files'])} 个分片, 哈希 {result['hashed']}, 缓存 {result['cached']}, 耗时 {result['seconds']:.1f}s"
+                print_status("权重完整性", result["ok"], detail)
+                for problem in result["problems"]:
+                    print(f"    - {problem}")
+                if not result["ok"]:
+                    all_passed = False
         else:
             print_status("基座模型", False, "模型目录为空")
             all_passed = False
@@ -96,4 +110,8 @@ def check_environment():
         sys.exit(1)
 
 if __name__ == "__main__":
-    check_environment()
+    parser = argparse.ArgumentParser(description="LoRA 训练环境自检")
+    parser.add_argument("--no-hash", action="store_true", help="权重只检查分片齐全与文件头，不计算哈希")
+    parser.add_argument("--workers", "-w", type=int, help="并行哈希线程数")
+    args = parser.parse_args()
+    check_environment(verify_weights=not args.no_hash, workers=args.workers)
@@ -11,6 +11,7 @@ import glob
 import shutil
 import sys
 import argparse
+from typing import Dict
 
 # 获取当前脚本所在目录
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -23,6 +24,14 @@ DEFAULT_DATA_DIR = os.path.join(HENTAI_ROOT, "novel_data", "lora_train_dataset")
 WORKSPACE_ROOT = os.path.dirname(HENTAI_ROOT)
 DEFAULT_FRAMEWORK_DIR = os.path.join(WORKSPACE_ROOT, "train_env", "LLaMA-Factory")
 
+# 数据集目录 (data_cleaning/dataset_catalog.py)，由数据生成端维护
+sys.path.insert(0, os.path.join(HENTAI_ROOT, "data_cleaning"))
+from dataset_catalog import DatasetCatalog, file_lock, write_json_atomic
+
+# 预分词数据集 (data_cleaning/pretokenize.py) 的标记文件
+PRETOKENIZED_MARKER = "dataset_dict.json"
+PRETOKENIZED_META = "pretokenized.json"
+
 class DataInterface:
     def __init__(self, framework_dir: str = None):
         """
@@ -40,6 +49,12 @@ class DataInterface:
         """
         if not data_dir:
             data_dir = DEFAULT_DATA_DIR
+
+        # 优先查询数据集目录 (生成时登记)，无需扫描目录
+        entry = DatasetCatalog(data_dir).latest()
+        if entry:
+            print(f"[Info] 找到最新数据集 (目录): {os.path.basename(entry['path'])} | {entry['rows']} 条 | sha1 {entry['sha1'][:12]}")
+            return entry["path"]
             
         if not os.path.exists(data_dir):
             print(f"[Error] 数据目录不存在: {data_dir}")
@@ -56,6 +71,44 @@ class DataInterface:
         print(f"[Info] 找到最新数据集: {os.path.basename(latest_file)}")
         return latest_file
 
+    @staticmethod
+    def find_pretokenized(dataset_path: str) -> str:
+        """
+        查找数据集对应的预分词目录 (data_cleaning/pretokenize.py 导出)
+        :return: 目录路径 (数据集本身、<目录>/tokenized 或 <文件名>.tokenized)，若不存在返回 None
+        """
+        dataset_path = os.path.normpath(dataset_path)
+        candidates = [dataset_path, os.path.join(dataset_path, "tokenized"), os.path.splitext(dataset_path)[0] + ".tokenized"]
+        for path in candidates:
+            if os.path.isfile(os.path.join(path, PRETOKENIZED_MARKER)) and os.path.isfile(os.path.join(path, PRETOKENIZED_META)):
+                return path
+        return None
+
+    def register_pretokenized(self, tokenized_path: str, dataset_name: str) -> bool:
+        """
+        挂载预分词数据集：在框架 data 目录下创建 <名称>_tokenized 链接。
+        预分词数据通过训练参数 tokenized_path 加载，不写入 dataset_info.json。
+        """
+        link_path = os.path.join(self.framework_dir, "data", f"{dataset_name}_tokenized")
+        try:
+            if os.path.islink(link_path) or os.path.isfile(link_path):
+                os.remove(link_path)
+            elif os.path.isdir(link_path):
+                shutil.rmtree(link_path)
+            os.symlink(os.path.abspath(tokenized_path), link_path)
+        except OSError as e:
+            print(f"[Warning] 创建预分词链接失败 ({e})，直接使用原路径")
+            link_path = os.path.abspath(tokenized_path)
+
+        try:
+            with open(os.path.join(tokenized_path, PRETOKENIZED_META), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            print(f"[Info] 预分词数据: {meta.get('rows')} 条 | Tokenizer: {meta.get('tokenizer')} | cutoff_len: {meta.get('cutoff_len')}")
+        except (OSError, json.JSONDecodeError):
+            pass
+        print(f"[Success] 预分词数据集已挂载，训练配置中设置 tokenized_path: {link_path} (并去掉 overwrite_cache)")
+        return True
+
     def register_dataset(self, dataset_path: str, dataset_name: str = "hentai_lora") -> bool:
         """
         将数据集注册到 LLaMA-Factory
@@ -66,27 +119,51 @@ class DataInterface:
         :param dataset_name: 在框架中使用的注册名称
         :return: 是否成功
         """
-        if not os.path.exists(self.framework_dir):
-            print(f"[Error] 训练框架目录不存在: {self.framework_dir}")
-            return False
-            
-        framework_data_dir = os.path.join(self.framework_dir, "data")
-        if not os.path.exists(framework_data_dir):
-            print(f"[Error] 框架 data 目录不存在: {framework_data_dir}")
-            return False
+        return self.register_datasets({dataset_name: dataset_path})
+
+    def _expand(self, dataset_name: str, dataset_path: str):
+        """
+        展开待注册的数据集
+        :return: ([(注册名称, 文件/目录路径)], [(注册名称, 预分词目录)])
+        """
+        tokenized = self.find_pretokenized(dataset_path)
+        # 预分词目录 (data_cleaning/pretokenize.py) 本身
+        if tokenized and os.path.normpath(tokenized) == os.path.normpath(dataset_path):
+            return [], [(dataset_name, tokenized)]
+
+        pretokenized = [(dataset_name, tokenized)] if tokenized else []
+        # 分片输出目录 (convert_to_lora.py --shard-size/--val-ratio/--mix): train/ 与 val/ 分别注册
+        train_dir = os.path.join(dataset_path, "train")
+        if os.path.isdir(train_dir):
+            items = [(dataset_name, train_dir)]
+            val_dir = os.path.join(dataset_path, "val")
+            if os.path.isdir(val_dir):
+                items.append((f"{dataset_name}_val", val_dir))
+                print(f"[Info] 验证集将注册为 '{dataset_name}_val'，可在训练配置中设置 eval_dataset: {dataset_name}_val")
+            return items, pretokenized
+        return [(dataset_name, dataset_path)], pretokenized
 
-        # 1. 创建软链接 (Symlink)
+    def _link(self, dataset_name: str, dataset_path: str) -> str:
+        """
+        在框架 data 目录下创建软链接 (失败时复制)
+        :return: 链接文件名，失败返回 None
+        """
+        framework_data_dir = os.path.join(self.framework_dir, "data")
         # 目标链接文件名 (为了方便管理，统一命名)
-        link_name = f"{dataset_name}.jsonl"
+        # 目录 (分片) 直接以数据集名链接，LLaMA-Factory 会加载目录下全部文件
+        link_name = dataset_name if os.path.isdir(dataset_path) else f"{dataset_name}.jsonl"
         link_path = os.path.join(framework_data_dir, link_name)
         
         # 如果存在旧文件/链接，先删除
         if os.path.exists(link_path) or os.path.islink(link_path):
             try:
-                os.remove(link_path)
+                if os.path.isdir(link_path) and not os.path.islink(link_path):
+                    shutil.rmtree(link_path)
+                else:
+                    os.remove(link_path)
             except Exception as e:
                 print(f"[Error] 无法删除旧链接: {e}")
-                return False
+                return None
         
         try:
             # 创建软链接: dataset_path -> link_path
@@ -96,50 +173,94 @@ class DataInterface:
             # Windows 下可能需要管理员权限或使用 copy
             print(f"[Warning] 创建软链接失败 ({e})，尝试复制文件...")
             try:
-                shutil.copy2(dataset_path, link_path)
+                if os.path.isdir(dataset_path):
+                    shutil.copytree(dataset_path, link_path)
+                else:
+                    shutil.copy2(dataset_path, link_path)
                 print(f"[Info] 已复制文件: {link_path}")
             except Exception as e2:
                 print(f"[Error] 文件复制失败: {e2}")
-                return False
+                return None
+        return link_name
 
-        # 2. 更新 dataset_info.json
-        if not os.path.exists(self.dataset_info_path):
-            print(f"[Error] 配置文件不存在: {self.dataset_info_path}")
-            return False
-            
-        try:
-            with open(self.dataset_info_path, 'r', encoding='utf-8') as f:
-                dataset_info = json.load(f)
-        except json.JSONDecodeError:
-            print(f"[Error] 配置文件 JSON 格式错误")
-            return False
-            
-        # 构造注册信息 (Alpaca 格式)
-        entry = {
-            "file_name": link_name,
-            "columns": {
-                "prompt": "instruction",
-                "query": "input",
-                "response": "output"
-            }
-        }
-        
-        # 更新或新增条目
-        dataset_info[dataset_name] = entry
-        
-        try:
-            with open(self.dataset_info_path, 'w', encoding='utf-8') as f:
-                json.dump(dataset_info, f, indent=2, ensure_ascii=False)
-            print(f"[Success] 数据集 '{dataset_name}' 已成功注册到 LLaMA-Factory。")
-            return True
-        except Exception as e:
-            print(f"[Error] 写入配置文件失败: {e}")
+    def register_datasets(self, datasets: Dict[str, str]) -> bool:
+        """
+        一次性注册多个数据集 {注册名称: 数据集路径}
+        dataset_info.json 的读改写在文件锁内完成并原子替换，多个进程同时注册不会互相覆盖；
+        任一数据集链接失败时不修改配置文件。
+        """
+        if not os.path.exists(self.framework_dir):
+            print(f"[Error] 训练框架目录不存在: {self.framework_dir}")
             return False
 
+        items, pretokenized = [], []
+        for dataset_name, dataset_path in datasets.items():
+            expanded, tokenized = self._expand(dataset_name, dataset_path)
+            items.extend(expanded)
+            pretokenized.extend(tokenized)
+
+        if items:
+            framework_data_dir = os.path.join(self.framework_dir, "data")
+            if not os.path.exists(framework_data_dir):
+                print(f"[Error] 框架 data 目录不存在: {framework_data_dir}")
+                return False
+
+            # 1. 创建软链接 (Symlink)
+            entries = {}
+            for dataset_name, dataset_path in items:
+                link_name = self._link(dataset_name, dataset_path)
+                if link_name is None:
+                    return False
+                # 构造注册信息 (Alpaca 格式)
+                entries[dataset_name] = {
+                    "file_name": link_name,
+                    "columns": {
+                        "prompt": "instruction",
+                        "query": "input",
+                        "response": "output"
+                    }
+                }
+
+            # 2. 更新 dataset_info.json
+            if not os.path.exists(self.dataset_info_path):
+                print(f"[Error] 配置文件不存在: {self.dataset_info_path}")
+                return False
+
+            try:
+                with file_lock(self.dataset_info_path):
+                    try:
+                        with open(self.dataset_info_path, 'r', encoding='utf-8') as f:
+                            dataset_info = json.load(f)
+                    except json.JSONDecodeError:
+                        print(f"[Error] 配置文件 JSON 格式错误")
+                        return False
+                    # 更新或新增条目
+                    dataset_info.update(entries)
+                    write_json_atomic(self.dataset_info_path, dataset_info)
+            except Exception as e:
+                print(f"[Error] 写入配置文件失败: {e}")
+                return False
+            for dataset_name in entries:
+                print(f"[Success] 数据集 '{dataset_name}' 已成功注册到 LLaMA-Factory。")
+
+        for dataset_name, tokenized in pretokenized:
+            self.register_pretokenized(tokenized, dataset_name)
+
+        # 3. 在数据集目录中记录注册名称
+        catalog = DatasetCatalog()
+        for dataset_name, dataset_path in datasets.items():
+            try:
+                catalog.update(dataset_path, registered_as=dataset_name)
+            except OSError:
+                pass
+        return True
+
 def main():
     parser = argparse.ArgumentParser(description="HentAI 数据集接入工具")
     parser.add_argument("--file", "-f", type=str, help="指定要接入的 JSONL 文件名 (需位于 novel_data/lora_train_dataset 中)")
-    parser.add_argument("--path", "-p", type=str, help="指定要接入的 JSONL 文件的绝对路径")
+    parser.add_argument("--path", "-p", type=str, help="指定要接入的 JSONL 文件 (或分片输出目录) 的绝对路径")
+    parser.add_argument("--dataset", "-d", action="append", default=[], metavar="名称=路径",
+                        help="一次注册多个数据集 (可多次指定)，在同一次加锁写入中完成")
     args = parser.parse_args()
     
     print("=== 开始执行数据接入流程 ===")
@@ -147,6 +268,20 @@ def main():
     # 初始化接口
     interface = DataInterface()
     dataset_path = None
+
+    if args.dataset:
+        datasets = {}
+        for spec in args.dataset:
+            name, sep, path = spec.partition("=")
+            if not sep or not os.path.exists(path):
+                print(f"[Error] 参数格式应为 名称=路径 且路径需存在: {spec}")
+                sys.exit(1)
+            datasets[name] = path
+        if not interface.register_datasets(datasets):
+            print("=== 数据接入失败 ===")
+            sys.exit(1)
+        print("=== 数据接入完成 ===")
+        return
     
     if args.path:
         # 直接指定绝对路径
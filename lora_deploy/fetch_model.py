@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+模型下载器 (Model Fetcher)
+功能：从 Hugging Face (或 HF_ENDPOINT 指定的镜像) 并行下载模型仓库，替代 deploy_server.sh 中的 git clone。
+特点：
+1. 通过 tree API 获取文件列表与 LFS sha256，大文件切分为若干区间，多个 Range 请求并发下载；
+2. 直接写入目标目录 (<文件>.incomplete + 进度文件)，中断后重新运行只下载未完成的区间；
+3. 下载完成后校验哈希，并写入 .weights_manifest.json，check_env.py 复查时无需再次哈希；
+4. 每个文件完成时输出耗时与吞吐。
+`mirror` 子命令在本地目录上启动一个支持 Range 的简易镜像 (含 tree API)，用于离线测试。
+
+用法：
+    python fetch_model.py download huihui-ai/Qwen3-14B-abliterated --local-dir /data/models/Qwen3-14B-abliterated
+    python fetch_model.py mirror --root /tmp/hub --port 8765   # /tmp/hub/<org>/<repo>/...
+"""
+
+import os
+import sys
+import json
+import time
+import fnmatch
+import hashlib
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from typing import Dict, List, Optional, Any
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, CURRENT_DIR)
+from weight_integrity import sha256_file, record_verified
+
+DEFAULT_ENDPOINT = "https://huggingface.co"
+PART_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+RETRIES = 5
+TIMEOUT = 60
+INCOMPLETE_SUFFIX = ".incomplete"
+STATE_SUFFIX = ".incomplete.json"
+
+
+class FetchError(Exception):
+    pass
+
+
+def _request(url: str, token: Optional[str] = None, headers: Optional[Dict[str, str]] = None):
+    req = urllib.request.Request(url, headers=headers or {})
+    if token:
+        # 不随重定向转发：resolve 会跳转到带签名的 CDN 地址
+        req.add_unredirected_header("Authorization", f"Bearer {token}")
+    return urllib.request.urlopen(req, timeout=TIMEOUT)
+
+
+def _next_link(link_header: Optional[str]) -> Optional[str]:
+    """解析分页 Link 头中的 rel="next" 地址"""
+    for part in (link_header or "").split(","):
+        if 'rel="next"' in part and "<" in part:
+            return part[part.index("<") + 1:part.index(">")]
+    return None
+
+
+def list_repo_files(endpoint: str, repo: str, revision: str = "main",
+                    token: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    通过 tree API 列出仓库文件，返回 [{"path", "size", "sha256" 或 None, "git_oid"}]。
+    LFS 文件带 sha256；普通小文件只有 git blob 的 SHA1 (oid)。
+    """
+    url = f"{endpoint}/api/models/{repo}/tree/{urllib.parse.quote(revision, safe='')}?recursive=true"
+    files = []
+    while url:
+        with _request(url, token) as resp:
+            items = json.loads(resp.read().decode('utf-8'))
+            url = _next_link(resp.headers.get("Link"))
+        for item in items:
+            if item.get("type") != "file":
+                continue
+            lfs = item.get("lfs") or {}
+            files.append({
+                "path": item["path"],
+                "size": lfs.get("size", item.get("size", 0)),
+                "sha256": lfs.get("oid"),
+                "git_oid": item.get("oid"),
+            })
+    return files
+
+
+def git_blob_sha1(path: str) -> str:
+    """git 对普通文件的对象哈希：sha1("blob <size>\\0" + 内容)"""
+    h = hashlib.sha1(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _pwrite(fd: int, data: bytes, offset: int, lock: threading.Lock):
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:  # Windows：没有 pwrite，串行 seek + write
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+class FileTask:
+    """单个文件的下载状态：区间划分、已完成区间 (持久化到 <文件>.incomplete.json) 与吞吐统计"""
+
+    def __init__(self, info: Dict[str, Any], local_dir: str, part_size: int):
+        self.info = info
+        self.name = info["path"]
+        self.size = info["size"]
+        self.dest = os.path.join(local_dir, *self.name.split("/"))
+        self.tmp = self.dest + INCOMPLETE_SUFFIX
+        self.state_path = self.dest + STATE_SUFFIX
+        self.part_size = part_size
+        self.parts = [(start, min(start + part_size, self.size) - 1)
+                      for start in range(0, self.size, part_size)] or [(0, -1)]
+        self.done = set()
+        self.lock = threading.Lock()
+        self.fd = None
+        self.downloaded = 0
+        self.started = None
+
+    def _state_key(self) -> Dict[str, Any]:
+        return {"size": self.size, "sha256": self.info.get("sha256"),
+                "git_oid": self.info.get("git_oid"), "part_size": self.part_size}
+
+    def open(self):
+        """打开 (或续传) .incomplete 文件；进度文件与远端信息不符时从头下载"""
+        os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get("key") == self._state_key() and os.path.getsize(self.tmp) == self.size:
+                self.done = set(state.get("done", []))
+        except (OSError, json.JSONDecodeError):
+            self.done = set()
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        self.fd = os.open(self.tmp, flags, 0o644)
+        os.ftruncate(self.fd, self.size)
+
+    def pending(self) -> List[int]:
+        return [i for i in range(len(self.parts)) if i not in self.done]
+
+    def mark_done(self, index: int) -> bool:
+        """记录区间完成并写回进度文件；返回整个文件是否已完成"""
+        with self.lock:
+            self.done.add(index)
+            tmp = self.state_path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({"key": self._state_key(), "done": sorted(self.done)}, f)
+            os.replace(tmp, self.state_path)
+            return len(self.done) == len(self.parts)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ModelFetcher:
+    """
+    并行下载器：所有文件的区间共享一个线程池 (connections 个并发连接)，
+    每个线程以 Range 请求下载一个区间并按偏移写入目标文件。
+    """
+
+    def __init__(self, repo: str, local_dir: str, endpoint: Optional[str] = None, revision: str = "main",
+                 token: Optional[str] = None, connections: int = 8, part_size: int = PART_SIZE,
+                 include: Optional[List[str]] = None, exclude: Optional[List[str]] = None,
+                 verify: bool = True):
+        self.repo = repo
+        self.local_dir = local_dir
+        self.endpoint = (endpoint or os.environ.get("HF_ENDPOINT") or DEFAULT_ENDPOINT).rstrip("/")
+        self.revision = revision
+        self.token = token
+        self.connections = connections
+        self.part_size = part_size
+        self.include = include
+        self.exclude = exclude
+        self.verify = verify
+        self._write_lock = threading.Lock()
+
+    def _selected(self, path: str) -> bool:
+        if self.include and not any(fnmatch.fnmatch(path, p) for p in self.include):
+            return False
+        return not (self.exclude and any(fnmatch.fnmatch(path, p) for p in self.exclude))
+
+    def file_url(self, path: str) -> str:
+        return f"{self.endpoint}/{self.repo}/resolve/{urllib.parse.quote(self.revision, safe='')}/{urllib.parse.quote(path)}"
+
+    def _is_complete(self, info: Dict[str, Any]) -> bool:
+        """目标文件已存在且大小一致 (且无未完成的进度文件) 时跳过"""
+        dest = os.path.join(self.local_dir, *info["path"].split("/"))
+        return (os.path.isfile(dest) and os.path.getsize(dest) == info["size"]
+                and not os.path.exists(dest + STATE_SUFFIX))
+
+    def _download_part(self, task: FileTask, index: int):
+        start, end = task.parts[index]
+        with task.lock:
+            if task.started is None:
+                task.started = time.perf_counter()
+        if end < start:  # 空文件
+            return
+        offset = start
+        for attempt in range(RETRIES):
+            try:
+                headers = {"Range": f"bytes={offset}-{end}", "Accept-Encoding": "identity"}
+                with _request(self.file_url(task.name), self.token, headers) as resp:
+                    if resp.status != 206 and not (offset == 0 and end == task.size - 1):
+                        raise FetchError(f"{task.name}: 服务器未返回分段内容 (HTTP {resp.status})，不支持 Range")
+                    while offset <= end:
+                        block = resp.read(min(READ_SIZE, end - offset + 1))
+                        if not block:
+                            break
+                        _pwrite(task.fd, block, offset, self._write_lock)
+                        offset += len(block)
+                        with task.lock:
+                            task.downloaded += len(block)
+                if offset > end:
+                    return
+                raise FetchError(f"{task.name}: 连接提前关闭 ({offset}/{end + 1})")
+            except FetchError as e:
+                if "Range" in str(e) or attempt == RETRIES - 1:
+                    raise
+            except (urllib.error.URLError, OSError) as e:
+                if isinstance(e, urllib.error.HTTPError) and e.code in (401, 403, 404):
+                    raise FetchError(f"{task.name}: HTTP {e.code} {e.reason}")
+                if attempt == RETRIES - 1:
+                    raise FetchError(f"{task.name}: 区间 {start}-{end} 下载失败 ({e})")
+            time.sleep(min(2 ** attempt, 30))  # 从已写入的位置继续
+
+    def _finalize(self, task: FileTask) -> Dict[str, Any]:
+        """校验哈希并将 .incomplete 重命名为目标文件"""
+        task.close()
+        elapsed = time.perf_counter() - (task.started or time.perf_counter())
+        status = "unverified"
+        if self.verify:
+            if task.info.get("sha256"):
+                digest = sha256_file(task.tmp)
+                if digest != task.info["sha256"]:
+                    os.remove(task.tmp)
+                    os.remove(task.state_path)
+                    raise FetchError(f"{task.name}: SHA256 不一致 (期望 {task.info['sha256'][:12]}…, 实际 {digest[:12]}…)，已删除，请重新运行")
+                status = "sha256"
+            elif task.info.get("git_oid"):
+                if git_blob_sha1(task.tmp) != task.info["git_oid"]:
+                    os.remove(task.tmp)
+                    os.remove(task.state_path)
+                    raise FetchError(f"{task.name}: git oid 不一致，已删除，请重新运行")
+                status = "git-sha1"
+        os.replace(task.tmp, task.dest)
+        os.remove(task.state_path)
+        if status == "sha256" and task.name.endswith(".safetensors") and "/" not in task.name:
+            record_verified(self.local_dir, task.name, task.info["sha256"])
+        return {"file": task.name, "bytes": task.downloaded, "seconds": elapsed, "verified": status}
+
+    def fetch(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        files = [f for f in list_repo_files(self.endpoint, self.repo, self.revision, self.token)
+                 if self._selected(f["path"])]
+        skipped = [f for f in files if self._is_complete(f)]
+        tasks = [FileTask(f, self.local_dir, self.part_size) for f in files if f not in skipped]
+        total = sum(t.size for t in tasks)
+        print(f"[Info] {self.repo}@{self.revision}: {len(files)} 个文件，已存在 {len(skipped)}，"
+              f"待下载 {len(tasks)} ({total / 1024 ** 3:.2f} GB)，并发 {self.connections}")
+
+        results: List[Dict[str, Any]] = []
+        failures: List[str] = []
+        failed_tasks = set()
+        with ThreadPoolExecutor(max_workers=self.connections) as pool:
+            futures = {}
+            # 逐个文件提交区间：前面的文件先完成，可尽早校验
+            for task in tasks:
+                task.open()
+                if task.done:
+                    print(f"[Resume] {task.name}: 已完成 {len(task.done)}/{len(task.parts)} 个区间")
+                pending = task.pending()
+                if not pending:
+                    futures[pool.submit(lambda t: None, task)] = (task, None)
+                for index in pending:
+                    futures[pool.submit(self._download_part, task, index)] = (task, index)
+            for future in as_completed(futures):
+                task, index = futures[future]
+                try:
+                    future.result()
+                    # 文件中其他区间失败时仍记录本区间，下次运行无需重新下载
+                    complete = task.mark_done(index) if index is not None else True
+                    if complete and task.name not in failed_tasks:
+                        result = self._finalize(task)
+                        results.append(result)
+                        rate = result["bytes"] / max(result["seconds"], 1e-6) / 1024 ** 2
+                        print(f"[Done] {task.name} | {task.size / 1024 ** 2:.1f} MB | "
+                              f"{result['seconds']:.1f}s | {rate:.1f} MB/s | 校验: {result['verified']}")
+                except Exception as e:
+                    if task.name not in failed_tasks:
+                        failed_tasks.add(task.name)
+                        failures.append(str(e))
+                        print(f"[Error] {e}")
+        for task in tasks:
+            task.close()
+
+        elapsed = time.perf_counter() - started
+        downloaded = sum(r["bytes"] for r in results)
+        return {
+            "files": len(files),
+            "skipped": len(skipped),
+            "downloaded": results,
+            "failures": failures,
+            "bytes": downloaded,
+            "seconds": elapsed,
+        }
+
+
+# ==========================================
+# 本地镜像 (离线测试用)
+# ==========================================
+
+class MirrorHandler(SimpleHTTPRequestHandler):
+    """
+    在 --root 目录上模拟 Hub：
+    - GET /api/models/<org>/<repo>/tree/<rev>  -> 文件列表 (所有文件按 LFS 处理，附 sha256)
+    - GET /<org>/<repo>/resolve/<rev>/<path>   -> 文件内容，支持单区间 Range
+    """
+
+    root = "."
+    hash_cache: Dict[tuple, str] = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data: Any):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _tree(self, repo: str):
+        repo_dir = os.path.join(self.root, repo)
+        if not os.path.isdir(repo_dir):
+            return self.send_error(404)
+        items = []
+        for dirpath, _, filenames in os.walk(repo_dir):
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                key = (path, stat.st_size, stat.st_mtime_ns)
+                if key not in self.hash_cache:
+                    self.hash_cache[key] = sha256_file(path)
+                rel = os.path.relpath(path, repo_dir).replace(os.sep, "/")
+                items.append({"type": "file", "path": rel, "size": stat.st_size,
+                              "lfs": {"oid": self.hash_cache[key], "size": stat.st_size}})
+        self._send_json(items)
+
+    def _resolve(self, repo: str, rel: str):
+        path = os.path.join(self.root, repo, *urllib.parse.unquote(rel).split("/"))
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first) if first else max(size - int(last), 0)
+            end = min(int(last), size - 1) if first and last else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(READ_SIZE, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path.strip("/")
+        parts = path.split("/")
+        try:
+            if len(parts) >= 6 and parts[0] == "api" and parts[1] == "models" and parts[4] == "tree":
+                return self._tree("/".join(parts[2:4]))
+            if len(parts) >= 5 and parts[2] == "resolve":
+                return self._resolve("/".join(parts[:2]), "/".join(parts[4:]))
+            self.send_error(404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve_mirror(root: str, host: str = "127.0.0.1", port: int = 8765):
+    MirrorHandler.root = os.path.abspath(root)
+    server = ThreadingHTTPServer((host, port), MirrorHandler)
+    print(f"[Info] 本地镜像: http://{host}:{server.server_address[1]} (根目录 {MirrorHandler.root})")
+    print(f"       使用: HF_ENDPOINT=http://{host}:{server.server_address[1]} python fetch_model.py download <org>/<repo> --local-dir ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并行、可续传的模型下载器")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_download = sub.add_parser("download", help="下载模型仓库到本地目录")
+    p_download.add_argument("repo", help="仓库名，例如 huihui-ai/Qwen3-14B-abliterated")
+    p_download.add_argument("--local-dir", required=True, help="目标目录 (直接写入，不经过 HF 缓存)")
+    p_download.add_argument("--endpoint", help=f"Hub 地址 (默认读取 HF_ENDPOINT，否则 {DEFAULT_ENDPOINT})")
+    p_download.add_argument("--revision", default="main", help="分支/标签/提交 (默认 main)")
+    p_download.add_argument("--connections", "-c", type=int, default=8, help="并发连接数 (默认 8)")
+    p_download.add_argument("--part-mb", type=int, default=PART_SIZE // 1024 ** 2, help="每个 Range 区间大小 MB (默认 64)")
+    p_download.add_argument("--include", nargs="*", help="只下载匹配的文件 (通配符)")
+    p_download.add_argument("--exclude", nargs="*", help="跳过匹配的文件 (通配符)")
+    p_download.add_argument("--no-verify", action="store_true", help="跳过哈希校验")
+
+    p_mirror = sub.add_parser("mirror", help="在本地目录上启动支持 Range 的简易 Hub 镜像 (离线测试)")
+    p_mirror.add_argument("--root", required=True, help="镜像根目录，仓库位于 <root>/<org>/<repo>")
+    p_mirror.add_argument("--host", default="127.0.0.1")
+    p_mirror.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == "mirror":
+        serve_mirror(args.root, args.host, args.port)
+        return
+
+    fetcher = ModelFetcher(
+        args.repo, args.local_dir,
+        endpoint=args.endpoint,
+        revision=args.revision,
+        token=os.environ.get("HF_TOKEN"),
+        connections=args.connections,
+        part_size=args.part_mb * 1024 ** 2,
+        include=args.include,
+        exclude=args.exclude,
+        verify=not args.no_verify,
+    )
+    try:
+        summary = fetcher.fetch()
+    except (urllib.error.URLError, OSError, FetchError) as e:
+        print(f"[Error] 获取文件列表失败: {e}")
+        sys.exit(1)
+    rate = summary["bytes"] / max(summary["seconds"], 1e-6) / 1024 ** 2
+    print(f"[Summary] 下载 {len(summary['downloaded'])} 个文件，{summary['bytes'] / 1024 ** 3:.2f} GB，"
+          f"{summary['seconds']:.1f}s，平均 {rate:.1f} MB/s，跳过 {summary['skipped']}，失败 {len(summary['failures'])}")
+    if summary["failures"]:
+        print("[Info] 重新运行同一命令即可从断点继续。")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
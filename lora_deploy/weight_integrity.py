@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+模型权重完整性校验 (Weight Integrity)
+功能：检查模型目录下 safetensors 分片是否完整，供 check_env.py 与 fetch_model.py 使用。
+检查项：
+1. index.json 中引用的分片是否齐全；
+2. safetensors 头部声明的数据长度与文件大小是否一致 (无需哈希即可发现截断的下载)；
+3. SHA256 与清单 (.weights_manifest.json) 中的期望值是否一致。
+分片并行哈希，按块内存映射读取；已校验文件以 (大小, 修改时间) 缓存，复查时无需重新哈希。
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any
+
+MANIFEST_NAME = ".weights_manifest.json"
+INDEX_NAME = "model.safetensors.index.json"
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def sha256_file(path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    """按块读取内存映射计算 SHA256 (hashlib 在大块输入上会释放 GIL，可用线程并行)"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for start in range(0, size, chunk_size):
+                    h.update(view[start:start + chunk_size])
+            finally:
+                view.release()
+    return h.hexdigest()
+
+
+def check_safetensors_header(path: str) -> Optional[str]:
+    """
+    解析 safetensors 头部：8 字节小端长度 + JSON 头，张量数据的最大结束偏移应恰好等于文件末尾。
+    返回问题描述，正常时返回 None。
+    """
+    size = os.path.getsize(path)
+    if size < 8:
+        return f"文件过小 ({size} 字节)"
+    with open(path, 'rb') as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        if header_len > size - 8:
+            return f"头部长度 {header_len} 超出文件大小 {size}"
+        try:
+            header = json.loads(f.read(header_len))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return "头部 JSON 损坏"
+    try:
+        data_end = max((t["data_offsets"][1] for k, t in header.items() if k != "__metadata__"), default=0)
+        expected = 8 + header_len + data_end
+    except (AttributeError, KeyError, IndexError, TypeError):
+        # 合法 JSON 但结构不对：头部不是对象、条目不是对象、缺少 data_offsets 或偏移不是整数
+        return "头部 JSON 损坏"
+    if expected != size:
+        return f"文件大小 {size} 与头部声明 {expected} 不符 (下载可能被截断)"
+    return None
+
+
+def load_manifest(model_dir: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(model_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"files": {}}
+
+
+def save_manifest(model_dir: str, manifest: Dict[str, Any]):
+    path = os.path.join(model_dir, MANIFEST_NAME)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def record_expected(model_dir: str, expected: Dict[str, Dict[str, Any]]):
+    """
+    写入期望的大小/哈希 (例如下载时从 Hub 获取的 LFS sha256)，{文件名: {"size": ..., "sha256": ...}}。
+    已有的校验缓存在期望值变化时作废。
+    """
+    manifest = load_manifest(model_dir)
+    for name, info in expected.items():
+        entry = manifest["files"].setdefault(name, {})
+        if entry.get("sha256") != info.get("sha256") or entry.get("size") != info.get("size"):
+            entry.pop("verified", None)
+        entry.update({k: v for k, v in info.items() if v is not None})
+        entry["source"] = "hub"
+    save_manifest(model_dir, manifest)
+
+
+def record_verified(model_dir: str, name: str, sha256: str):
+    """下载端已按 Hub 期望值校验过哈希时直接写入校验缓存，避免 check_env 再次哈希"""
+    manifest = load_manifest(model_dir)
+    stat = os.stat(os.path.join(model_dir, name))
+    manifest["files"][name] = {
+        "size": stat.st_size,
+        "sha256": sha256,
+        "source": "hub",
+        "verified": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+    }
+    save_manifest(model_dir, manifest)
+
+
+def verify_model_dir(model_dir: str, workers: Optional[int] = None, hash_files: bool = True) -> Dict[str, Any]:
+    """
+    校验模型目录，返回 {"ok": bool, "files": {文件名: 状态}, "problems": [...], "hashed": n, "cached": n, "seconds": t}
+    状态: ok (与 Hub 期望值一致) / cached (大小与修改时间未变，沿用上次结论) / recorded (无期望值，仅记录本地哈希) / 错误描述
+    """
+    started = time.perf_counter()
+    problems: List[str] = []
+    statuses: Dict[str, str] = {}
+    shards = sorted(f for f in os.listdir(model_dir) if f.endswith(".safetensors"))
+
+    # 1. index.json 引用的分片是否齐全
+    index_path = os.path.join(model_dir, INDEX_NAME)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                referenced = set(json.load(f).get("weight_map", {}).values())
+            for name in sorted(referenced - set(shards)):
+                problems.append(f"{name}: index.json 引用但文件缺失")
+                statuses[name] = "missing"
+        except (OSError, json.JSONDecodeError) as e:
+            problems.append(f"{INDEX_NAME}: 无法解析 ({e})")
+    if not shards:
+        problems.append("未找到 safetensors 权重文件")
+
+    manifest = load_manifest(model_dir)
+    files = manifest.setdefault("files", {})
+    to_hash = []
+    cached = 0
+    for name in shards:
+        path = os.path.join(model_dir, name)
+        stat = os.stat(path)
+        entry = files.setdefault(name, {})
+
+        # 2. 大小与头部检查 (廉价，始终执行)；只有来自 Hub 的期望值具有权威性
+        if entry.get("source") == "hub" and entry.get("size") is not None and entry["size"] != stat.st_size:
+            problems.append(f"{name}: 大小 {stat.st_size} 与清单 {entry['size']} 不符")
+            statuses[name] = "size mismatch"
+            continue
+        header_problem = check_safetensors_header(path)
+        if header_problem:
+            problems.append(f"{name}: {header_problem}")
+            statuses[name] = "truncated"
+            continue
+
+        verified = entry.get("verified")
+        if verified and verified.get("size") == stat.st_size and verified.get("mtime_ns") == stat.st_mtime_ns:
+            statuses[name] = "cached"
+            cached += 1
+        elif hash_files:
+            to_hash.append(name)
+        else:
+            statuses[name] = "header ok"
+
+    # 3. 并行哈希
+    if to_hash:
+        workers = workers or min(len(to_hash), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = dict(zip(to_hash, pool.map(lambda n: sha256_file(os.path.join(model_dir, n)), to_hash)))
+        for name, digest in digests.items():
+            entry = files[name]
+            stat = os.stat(os.path.join(model_dir, name))
+            expected = entry.get("sha256") if entry.get("source") == "hub" else None
+            if expected and expected != digest:
+                problems.append(f"{name}: SHA256 不一致 (期望 {expected[:12]}…, 实际 {digest[:12]}…)")
+                statuses[name] = "hash mismatch"
+                entry.pop("verified", None)
+                continue
+            statuses[name] = "ok" if expected else "recorded"
+            entry.update({"size": stat.st_size, "sha256": digest})
+            entry["verified"] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    try:
+        save_manifest(model_dir, manifest)
+    except OSError:
+        pass  # 只读目录：仍返回本次结果
+    return {
+        "ok": not problems,
+        "files": statuses,
+        "problems": problems,
+        "hashed": len(to_hash),
+        "cached": cached,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="校验模型目录中 safetensors 权重的完整性")
+    parser.add_argument("model_dirs", nargs="+", help="模型目录")
+    parser.add_argument("--workers", "-w", type=int, help="并行哈希线程数")
+    parser.add_argument("--no-hash", action="store_true", help="只检查分片齐全与文件头 (不计算哈希)")
+    args = parser.parse_args()
+
+    all_ok = True
+    for model_dir in args.model_dirs:
+        result = verify_model_dir(model_dir, args.workers, hash_files=not args.no_hash)
+        mark = "[PASS]" if result["ok"] else "[FAIL]"
+        print(f"{mark} {model_dir} | 分片 {len(result['files'])} | 哈希 {result['hashed']} | 缓存 {result['cached']} | {result['seconds']:.1f}s")
+        for problem in result["problems"]:
+            print(f"  - {problem}")
+        all_ok = all_ok and result["ok"]
+    if not all_ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
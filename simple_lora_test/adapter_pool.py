@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+多 LoRA 适配器服务 (Adapter Pool)
+功能：基座模型只加载一次，在其上按需挂载多个角色的 LoRA 适配器，按请求切换。
+1. 适配器在首次被请求时才加载，超过 max_loaded 时按最近最少使用 (LRU) 卸载；
+2. 记录每个适配器的参数显存占用与加载耗时 (`stats()`，API 服务在 /v1/adapters 暴露)；
+3. 请求按 OpenAI 请求体中的 `model` 字段选择适配器：完全匹配名称，或包含某个角色名 (如 "qwen3-叶灵静")；
+   未匹配时使用默认适配器，`base` 表示不挂载适配器。
+仅支持 LLaMA-Factory 的 huggingface 推理后端 (engine.model 为 transformers 模型)。
+"""
+
+import os
+import time
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Any
+
+BASE_ADAPTER = "base"
+
+# 由 AdapterSelectMiddleware 按请求设置，MultiAdapterChatModel 读取
+current_adapter: ContextVar[Optional[str]] = ContextVar("current_adapter", default=None)
+
+
+def parse_adapters(specs: List[str]) -> Dict[str, str]:
+    """解析 --adapter 参数 ("名称=路径" 或 "路径"，后者以目录名为名称)"""
+    adapters: Dict[str, str] = OrderedDict()
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = os.path.basename(spec.rstrip("/\\")), spec
+        if not os.path.exists(os.path.join(path, "adapter_config.json")):
+            raise ValueError(f"在 {path} 未找到有效的 LoRA 适配器 (缺少 adapter_config.json)")
+        if name == BASE_ADAPTER:
+            raise ValueError(f"适配器名称 '{BASE_ADAPTER}' 已保留 (表示不挂载适配器)")
+        adapters[name] = path
+    return adapters
+
+
+def _cuda_allocated() -> Optional[int]:
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            return torch.cuda.memory_allocated()
+    except ImportError:
+        pass
+    return None
+
+
+class AdapterPool:
+    """
+    在 holder.model 上管理 LoRA 适配器 (holder 通常为 ChatModel.engine)。
+    首个适配器加载时把基座包装为 PeftModel，其后用 load_adapter / delete_adapter 挂载与卸载；
+    peft 内部使用 adapter_0、adapter_1 … 作为模块键，避免中文名称出现在参数名中。
+    """
+
+    def __init__(self, holder: Any, adapters: Dict[str, str], max_loaded: int = 2,
+                 default: Optional[str] = None):
+        self.holder = holder
+        self.adapters = dict(adapters)
+        self.max_loaded = max(1, max_loaded)
+        self.default = default if default is not None else next(iter(self.adapters), BASE_ADAPTER)
+        if self.default != BASE_ADAPTER and self.default not in self.adapters:
+            raise ValueError(f"默认适配器 {self.default} 未注册")
+        self.keys = {name: f"adapter_{i}" for i, name in enumerate(self.adapters)}
+        self.loaded: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.active: Optional[str] = None
+        self.counters = {name: {"requests": 0, "loads": 0, "evictions": 0} for name in self.adapters}
+        self.counters[BASE_ADAPTER] = {"requests": 0, "loads": 0, "evictions": 0}
+        # 切换适配器到生成结束之间独占模型
+        self.lock = threading.Lock()
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.adapters)
+
+    def resolve(self, requested: Optional[str]) -> str:
+        """请求中的 model 字段 -> 适配器名称"""
+        if requested:
+            if requested == BASE_ADAPTER or requested in self.adapters:
+                return requested
+            # 较长的名称优先，避免 "灵静" 抢先匹配 "叶灵静"
+            for name in sorted(self.adapters, key=len, reverse=True):
+                if name in requested:
+                    return name
+        return self.default
+
+    def _peft_model(self):
+        if not self.loaded:  # 尚未挂载任何适配器 (也使桩后端无需安装 peft)
+            return None
+        from peft import PeftModel
+        model = self.holder.model
+        return model if isinstance(model, PeftModel) else None
+
+    def _adapter_bytes(self, key: str) -> int:
+        marker = f".{key}."
+        return sum(p.numel() * p.element_size() for n, p in self.holder.model.named_parameters() if marker in n)
+
+    def _load(self, name: str):
+        from peft import PeftModel
+        # 超出容量时先卸载最久未使用的适配器 (peft 要求至少保留一个，故先加载后卸载)
+        victim = next(iter(self.loaded)) if len(self.loaded) >= self.max_loaded else None
+        key, path = self.keys[name], self.adapters[name]
+        started = time.perf_counter()
+        before = _cuda_allocated()
+        peft_model = self._peft_model()
+        if peft_model is None:
+            self.holder.model = PeftModel.from_pretrained(self.holder.model, path, adapter_name=key, is_trainable=False)
+        else:
+            peft_model.load_adapter(path, adapter_name=key, is_trainable=False)
+        self.holder.model.eval()
+        after = _cuda_allocated()
+        self.loaded[name] = {
+            "key": key,
+            "path": path,
+            "param_bytes": self._adapter_bytes(key),
+            "cuda_delta_bytes": after - before if before is not None and after is not None else None,
+            "load_seconds": round(time.perf_counter() - started, 3),
+            "loaded_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.counters[name]["loads"] += 1
+        print(f"[Adapter] 已加载 {name} ({self.loaded[name]['param_bytes'] / 1024 ** 2:.1f} MB, "
+              f"{self.loaded[name]['load_seconds']}s)", flush=True)
+        if victim is not None:
+            self._evict(victim)
+
+    def _evict(self, name: str):
+        info = self.loaded.pop(name)
+        if self.active == name:
+            self.active = None
+        self._peft_model().delete_adapter(info["key"])
+        self.counters[name]["evictions"] += 1
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+        print(f"[Adapter] 已卸载 {name} (LRU)", flush=True)
+
+    def activate(self, name: str):
+        """在持有 lock 时调用：加载 (如需要) 并切换到指定适配器；base 关闭所有适配器层"""
+        self.counters[name]["requests"] += 1
+        peft_model = self._peft_model()
+        if name == BASE_ADAPTER:
+            if peft_model is not None and self.active != BASE_ADAPTER:
+                peft_model.base_model.disable_adapter_layers()
+            self.active = BASE_ADAPTER
+            return
+        if name not in self.loaded:
+            self._load(name)
+            peft_model = self._peft_model()
+        self.loaded.move_to_end(name)
+        if self.active == BASE_ADAPTER:
+            peft_model.base_model.enable_adapter_layers()
+        if self.active != name:
+            peft_model.set_adapter(self.keys[name])
+        self.active = name
+
+    def stats(self) -> Dict[str, Any]:
+        adapters = {}
+        for name, path in self.adapters.items():
+            info = self.loaded.get(name)
+            adapters[name] = dict(self.counters[name], path=path, loaded=info is not None,
+                                  **({k: v for k, v in info.items() if k not in ("key", "path")} if info else {}))
+        return {
+            "default": self.default,
+            "active": self.active,
+            "max_loaded": self.max_loaded,
+            "loaded": list(self.loaded),
+            "loaded_param_bytes": sum(info["param_bytes"] for info in self.loaded.values()),
+            "base_requests": self.counters[BASE_ADAPTER]["requests"],
+            "adapters": adapters,
+        }
+
+
+class MultiAdapterChatModel:
+    """
+    ChatModel 的代理：接口与 llamafactory.chat.ChatModel 一致，可直接传给 create_app。
+    每次生成前按 adapter 参数 (或请求上下文) 切换适配器，生成期间独占模型。
+    """
+
+    def __init__(self, chat_model: Any, pool: AdapterPool):
+        self.chat_model = chat_model
+        self.pool = pool
+        # 排队等锁的请求各占一个线程：不能用默认线程池，否则会占满 LLaMA-Factory 生成所用的 asyncio.to_thread
+        self._executor = ThreadPoolExecutor(thread_name_prefix="adapter-acquire")
+
+    @property
+    def engine(self):
+        return self.chat_model.engine
+
+    def __getattr__(self, name):
+        return getattr(self.chat_model, name)
+
+    @asynccontextmanager
+    async def session(self, adapter: Optional[str] = None):
+        """获取模型并切换到适配器；退出时释放"""
+        name = self.pool.resolve(adapter if adapter is not None else current_adapter.get())
+        loop = asyncio.get_running_loop()
+        acquired = loop.run_in_executor(self._executor, self._acquire, name)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # 请求在排队时被取消：锁最终仍会被线程拿到，拿到后立即释放 (切换失败时 _acquire 已释放)
+            acquired.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or self.pool.lock.release())
+            raise
+        try:
+            yield name
+        finally:
+            self.pool.lock.release()
+
+    def _acquire(self, name: str):
+        """在同一个线程内拿锁并切换适配器，持锁者无需再向线程池提交任务；切换失败时释放锁"""
+        self.pool.lock.acquire()
+        try:
+            self.pool.activate(name)
+        except BaseException:
+            self.pool.lock.release()
+            raise
+
+    async def achat(self, messages, system=None, tools=None, *args, adapter: Optional[str] = None, **kwargs):
+        async with self.session(adapter):
+            return await self.chat_model.achat(messages, system, tools, *args, **kwargs)
+
+    async def astream_chat(self, messages, system=None, tools=None, *args, adapter: Optional[str] = None, **kwargs):
+        async with self.session(adapter):
+            async for new_token in self.chat_model.astream_chat(messages, system, tools, *args, **kwargs):
+                yield new_token
+
+    async def aget_scores(self, batch_input, **kwargs):
+        async with self.session(BASE_ADAPTER):
+            return await self.chat_model.aget_scores(batch_input, **kwargs)
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs):
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self.chat_model._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        """同步流式接口 (Gradio 使用)，在 ChatModel 的后台事件循环中驱动 astream_chat"""
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self.chat_model._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+
+class AdapterSelectMiddleware:
+    """
+    ASGI 中间件：读取 /v1/chat/completions 请求体中的 model 字段写入 current_adapter，
+    再把缓存的请求体原样交给下游 (LLaMA-Factory 的路由不向 ChatModel 传递 model 字段)。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") != "POST":
+            return await self.app(scope, receive, send)
+        messages = []
+        body = b""
+        while True:
+            message = await receive()
+            messages.append(message)
+            body += message.get("body", b"")
+            if message["type"] != "http.request" or not message.get("more_body"):
+                break
+        try:
+            requested = json.loads(body or b"{}").get("model")
+        except (ValueError, AttributeError):
+            requested = None
+        token = current_adapter.set(requested if isinstance(requested, str) else None)
+
+        async def replay():
+            return messages.pop(0) if messages else await receive()
+
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            current_adapter.reset(token)
+
+
+def install_adapter_routes(app, pool: AdapterPool):
+    """/v1/models 列出全部适配器 (替换 LLaMA-Factory 的单模型列表)，/v1/adapters 返回加载状态与显存占用"""
+    app.router.routes = [r for r in app.router.routes if getattr(r, "path", None) != "/v1/models"]
+
+    @app.get("/v1/models")
+    async def list_models():
+        created = int(time.time())
+        data = [{"id": name, "object": "model", "created": created, "owned_by": "owner"}
+                for name in pool.names + [BASE_ADAPTER]]
+        return {"object": "list", "data": data}
+
+    @app.get("/v1/adapters")
+    async def adapter_stats():
+        return pool.stats()
@@ -1,9 +1,16 @@
 import argparse
 import os
 import yaml
-from llamafactory.chat import ChatModel
 from llamafactory.extras.constants import METHODS
 from llamafactory.api.app import create_app
+from adapter_pool import AdapterPool, MultiAdapterChatModel, AdapterSelectMiddleware, install_adapter_routes, parse_adapters
+from batching import BatchGenerator, BatchScheduler, BatchingChatModel, install_batching_routes
+from session_cache import SessionStore, SessionGenerator, SessionChatModel, SessionMiddleware, install_session_routes
+from history_window import HistoryWindow, WindowedChatModel, install_history_routes, token_counter
+from response_cache import ResponseCache, CachedChatModel, install_cache_routes, load_prewarm
+from output_parser import SegmentedChatModel, OutputOptionsMiddleware, install_segment_routes
+from backends import add_backend_args, create_backend
+from startup import LoadState, LazyChatModel, ReadinessMiddleware, install_probe_routes, install_startup, safetensors_files
 
 def load_config(config_path):
     if os.path.exists(config_path):
@@ -13,30 +20,97 @@ def load_config(config_path):
 
 def main():
     parser = argparse.ArgumentParser(description="HentAI API Backend")
+    parser.add_argument("--model_name_or_path", type=str, default="/root/local-nvme/train_env/models/Qwen3-14B-abliterated",
+                        help="Base model path (a small model such as Qwen/Qwen2.5-0.5B-Instruct with --backend transformers)")
     parser.add_argument("--adapter_name_or_path", type=str, help="LoRA adapter path")
+    parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH",
+                        help="Register a LoRA adapter (repeatable); requests select it via the `model` field")
+    parser.add_argument("--default_adapter", type=str, help="Adapter used when `model` matches none (default: first; 'base' = no adapter)")
+    parser.add_argument("--max_loaded_adapters", type=int, default=2, help="Adapters kept in memory at once (LRU)")
+    parser.add_argument("--batch_size", type=int, default=1, help="Max requests generated together (1 = no batching)")
+    parser.add_argument("--batch_window_ms", type=float, default=20, help="How long the first queued request waits for others")
+    parser.add_argument("--session_cache_mb", type=int, default=2048, help="KV cache kept for X-Session-Id conversations (0 = off)")
+    parser.add_argument("--session_idle_ttl", type=float, default=1800, help="Seconds before an idle session's cache is dropped")
+    parser.add_argument("--history_budget", type=int, default=0, help="Token budget for X-Session-Id conversation history; older turns are summarized (0 = off)")
+    parser.add_argument("--persona", type=str, help="Persona prefix of the first user message, kept in front of the window (e.g. 你现在是叶灵静。; {model} = requested character)")
+    parser.add_argument("--response_cache", type=int, default=1024, help="Cached replies for deterministic / low-temperature requests (0 = off)")
+    parser.add_argument("--response_cache_ttl", type=float, default=3600, help="Seconds a cached reply stays valid")
+    parser.add_argument("--response_cache_max_temp", type=float, default=0.3, help="Highest temperature whose replies are cached")
+    parser.add_argument("--cache_prewarm", type=str, help="Prompt list (text or JSONL) generated into the cache at startup")
+    parser.add_argument("--think_budget", type=int, default=0, help="Max tokens inside <think> before it is closed (0 = unlimited; header X-Think-Budget overrides)")
+    parser.add_argument("--hide_think", action="store_true", help="Strip <think> content from replies by default (header X-Think: show|hide overrides)")
+    parser.add_argument("--warmup_tokens", type=int, default=16, help="Tokens generated through the full stack before /readyz reports ready (0 = skip)")
+    parser.add_argument("--no_prefetch", action="store_true", help="Skip reading *.safetensors into the page cache before loading")
     parser.add_argument("--port", type=int, default=8000, help="API port")
+    add_backend_args(parser)
     args = parser.parse_args()
 
     config = load_config("configs/hentai_webui_config.yaml")
     
-    model_path = "/root/local-nvme/train_env/models/Qwen3-14B-abliterated"
+    model_path = args.model_name_or_path
     adapter_path = args.adapter_name_or_path or config.get("train.output_dir", "")
     template = config.get("top.template", "qwen3")
 
+    adapters = parse_adapters(args.adapter)
+    if not adapters and (args.adapter_name_or_path or os.path.exists(os.path.join(adapter_path, "adapter_config.json"))):
+        adapters = parse_adapters([adapter_path])
+
     print(f"--- Launching API Backend ---")
+    print(f"Backend: {args.backend}")
     print(f"Base Model: {model_path}")
-    print(f"Adapter: {adapter_path}")
-    
-    chat_args = dict(
-        model_name_or_path=model_path,
-        adapter_name_or_path=adapter_path,
-        template=template,
-        finetuning_type="lora",
-        quantization_bit=4,
-    )
+    print(f"Adapters: {', '.join(f'{k}={v}' for k, v in adapters.items()) or '(none)'}")
     
-    chat_model = ChatModel(chat_args)
-    app = create_app(chat_model)
+    # 先绑定端口再在后台加载：/healthz 与 /readyz 报告进度，就绪前其他请求返回 503
+    state = LoadState()
+    lazy = LazyChatModel()
+    app = create_app(lazy)
+    install_probe_routes(app, state)
+    # 基座只加载一次，适配器由 AdapterPool 按请求懒加载
+    backend = create_backend(args, model_path, template=template, finetuning_type="lora", quantization_bit=4)
+
+    def build(chat_model):
+        """模型加载完成后组装服务链并注册依赖它的路由"""
+        pool = AdapterPool(chat_model.engine, adapters, max_loaded=args.max_loaded_adapters, default=args.default_adapter)
+        served = MultiAdapterChatModel(chat_model, pool)
+        # 批处理与会话缓存自行驱动模型解码，桩后端没有模型时跳过
+        has_model = getattr(chat_model.engine, "model", None) is not None
+        if args.batch_size > 1 and has_model:
+            print(f"Batching: up to {args.batch_size} requests / {args.batch_window_ms} ms window")
+            scheduler = BatchScheduler(BatchGenerator(chat_model.engine), max_batch=args.batch_size,
+                                       window_ms=args.batch_window_ms, pool=pool)
+            served = BatchingChatModel(served, scheduler)
+            install_batching_routes(app, scheduler)
+        if args.session_cache_mb > 0 and has_model:
+            store = SessionStore(args.session_cache_mb * 1024 ** 2, idle_ttl=args.session_idle_ttl)
+            served = SessionChatModel(served, SessionGenerator(chat_model.engine, store), pool)
+            install_session_routes(app, store)
+        if args.history_budget > 0:
+            window = HistoryWindow(token_counter(chat_model.engine.tokenizer), budget=args.history_budget)
+            served = WindowedChatModel(served, window, persona=args.persona)
+            install_history_routes(app, window)
+        if args.response_cache > 0:
+            cache = ResponseCache(args.response_cache, ttl=args.response_cache_ttl, max_temperature=args.response_cache_max_temp)
+            served = CachedChatModel(served, cache, namespace=f"{model_path}|{template}", pool=pool)
+            install_cache_routes(app, cache)
+        served = SegmentedChatModel(served, hide_think=args.hide_think, think_budget=args.think_budget)
+        install_segment_routes(app, served)
+        install_adapter_routes(app, pool)
+        return served
+
+    async def prewarm(served):
+        # 回复缓存预热在就绪后进行，不推迟就绪时间
+        if args.response_cache > 0 and args.cache_prewarm:
+            await served.chat_model.prewarm(load_prewarm(args.cache_prewarm), think_budget=args.think_budget)
+
+    install_startup(app, state, lazy, backend.load, build,
+                    weights=[] if args.no_prefetch or args.backend == "stub" else safetensors_files(model_path),
+                    warmup_tokens=args.warmup_tokens, after_ready=prewarm)
+    # 中间件在启动前注册 (Starlette 不允许启动后添加)，只依赖命令行参数
+    if args.session_cache_mb > 0 or args.history_budget > 0:
+        app.add_middleware(SessionMiddleware)
+    app.add_middleware(OutputOptionsMiddleware)
+    app.add_middleware(AdapterSelectMiddleware)
+    app.add_middleware(ReadinessMiddleware, state=state)
     
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=args.port, workers=1)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+API 后端客户端 (Backend Client)
+功能：让 Gradio 界面作为 api_backend.py (OpenAI 兼容接口) 的轻量客户端运行，不在界面进程中加载模型。
+1. 一个共享的 httpx.AsyncClient (连接池 + Keep-Alive) 运行在后台事件循环中，所有浏览器会话复用；
+2. /v1/chat/completions 以 SSE 流式读取，接口与 ChatModel 的 stream_chat 一致，bot_msg 无需区分本地 / 远程；
+3. 角色通过 model 字段选择适配器，浏览器会话通过 X-Session-Id 复用后端的会话 KV Cache 与历史窗口，
+   思考选项通过 X-Think / X-Think-Budget 传递。
+多个界面副本可以共用同一个 GPU 后端，界面与推理层分别扩缩容。
+"""
+
+import json
+import time
+import asyncio
+import threading
+from typing import Dict, List, Optional, Any
+
+from backends import Response
+
+
+class BackendError(RuntimeError):
+    """后端返回错误状态或流中断"""
+
+
+class BackendChatModel:
+    """
+    与 ChatModel 接口一致的远程模型：stream_chat / chat 为同步接口 (Gradio 在工作线程中调用)，
+    astream_chat / achat 在内部事件循环上运行。
+    """
+
+    def __init__(self, base_url: str, api_key: Optional[str] = None, max_connections: int = 32,
+                 timeout: float = 300.0, hide_think: bool = False, think_budget: int = 0):
+        import httpx
+
+        self.base_url = base_url.rstrip("/")
+        self.hide_think = hide_think
+        self.think_budget = think_budget
+        self._headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="backend-client", daemon=True)
+        self._thread.start()
+
+        async def make_client():
+            return httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self._headers,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                # 生成可能持续数分钟：只限制连接与两次读取之间的间隔
+                timeout=httpx.Timeout(timeout, connect=10.0),
+            )
+
+        self.client = asyncio.run_coroutine_threadsafe(make_client(), self._loop).result()
+
+    def _request_headers(self, session_id: Optional[str], hide_think: Optional[bool], think_budget: Optional[int]):
+        headers = {}
+        if session_id:
+            headers["X-Session-Id"] = session_id
+        hide = self.hide_think if hide_think is None else hide_think
+        headers["X-Think"] = "hide" if hide else "show"
+        budget = self.think_budget if think_budget is None else think_budget
+        if budget:
+            headers["X-Think-Budget"] = str(budget)
+        return headers
+
+    @staticmethod
+    def _payload(messages, system, adapter, stream: bool, kwargs) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {
+            "model": adapter or "default",
+            "messages": ([{"role": "system", "content": system}] if system else []) + list(messages),
+            "stream": stream,
+        }
+        for key in ("temperature", "top_p", "stop"):
+            if kwargs.get(key) is not None:
+                payload[key] = kwargs[key]
+        if kwargs.get("max_new_tokens") is not None:
+            payload["max_tokens"] = kwargs["max_new_tokens"]
+        return payload
+
+    async def astream_chat(self, messages: List[Dict[str, str]], system: Optional[str] = None, tools=None,
+                           images=None, videos=None, audios=None, adapter: Optional[str] = None,
+                           session_id: Optional[str] = None, persona: Optional[str] = None,
+                           hide_think: Optional[bool] = None, think_budget: Optional[int] = None, **kwargs):
+        # persona 由后端的 --persona 决定 (可写作 "你现在是{model}。")，这里不需要传递
+        payload = self._payload(messages, system, adapter, True, kwargs)
+        headers = self._request_headers(session_id, hide_think, think_budget)
+        async with self.client.stream("POST", "/v1/chat/completions", json=payload, headers=headers) as response:
+            if response.status_code != 200:
+                detail = (await response.aread()).decode("utf-8", "replace")[:200]
+                raise BackendError(f"后端返回 {response.status_code}: {detail}")
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                chunk = json.loads(data)
+                delta = chunk["choices"][0].get("delta") or {}
+                if delta.get("content"):
+                    yield delta["content"]
+
+    async def achat(self, messages: List[Dict[str, str]], system: Optional[str] = None, tools=None,
+                    images=None, videos=None, audios=None, adapter: Optional[str] = None,
+                    session_id: Optional[str] = None, persona: Optional[str] = None,
+                    hide_think: Optional[bool] = None, think_budget: Optional[int] = None, **kwargs) -> List[Response]:
+        payload = self._payload(messages, system, adapter, False, kwargs)
+        headers = self._request_headers(session_id, hide_think, think_budget)
+        response = await self.client.post("/v1/chat/completions", json=payload, headers=headers)
+        if response.status_code != 200:
+            raise BackendError(f"后端返回 {response.status_code}: {response.text[:200]}")
+        data = response.json()
+        usage = data.get("usage") or {}
+        return [Response(response_text=choice["message"]["content"] or "",
+                         response_length=usage.get("completion_tokens", 0),
+                         prompt_length=usage.get("prompt_tokens", 0),
+                         finish_reason=choice.get("finish_reason") or "stop")
+                for choice in data["choices"]]
+
+    async def await_ready(self, timeout: float = 600.0, interval: float = 5.0) -> bool:
+        """轮询 /readyz 直到后端加载完成；没有 /readyz 的旧版后端 (404) 视为就绪，加载失败或超时返回 False"""
+        import httpx
+
+        deadline = time.monotonic() + timeout
+        last = None
+        while True:
+            try:
+                response = await self.client.get("/readyz")
+                if response.status_code in (200, 404):
+                    return True
+                state = response.json()
+                if state.get("status") == "failed":
+                    print(f"[Warning] 后端加载失败: {state.get('error')}", flush=True)
+                    return False
+                progress = (state.get("status"), state.get("detail"))
+                if progress != last:
+                    print(f"[Info] 等待后端就绪: {progress[0]} {progress[1] or ''}", flush=True)
+                    last = progress
+            except (httpx.TransportError, ValueError):
+                pass  # 后端进程尚未绑定端口
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+
+    def wait_ready(self, timeout: float = 600.0) -> bool:
+        return asyncio.run_coroutine_threadsafe(self.await_ready(timeout), self._loop).result()
+
+    async def alist_models(self) -> List[str]:
+        response = await self.client.get("/v1/models")
+        response.raise_for_status()
+        return [m["id"] for m in response.json().get("data", [])]
+
+    def list_models(self) -> List[str]:
+        return asyncio.run_coroutine_threadsafe(self.alist_models(), self._loop).result()
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs) -> List[Response]:
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        try:
+            while True:
+                try:
+                    task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self._loop)
+                    yield task.result()
+                except StopAsyncIteration:
+                    break
+        finally:
+            # 浏览器中途断开时关闭流，连接归还连接池
+            asyncio.run_coroutine_threadsafe(generator.aclose(), self._loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+推理后端 (Inference Backends)
+功能：把 "加载模型并生成" 抽象为统一接口，服务层 (adapter_pool / batching / session_cache / api_backend / Gradio)
+不再直接依赖 llamafactory.chat.ChatModel 与 4bit 量化的 14B 模型。
+1. InferenceBackend: load / astream_chat (stream_chat) / abatch_chat (batch_chat)，其余与 ChatModel 接口一致
+   (achat、engine、_loop)，可直接交给 MultiAdapterChatModel 与 create_app；
+2. LlamaFactoryBackend: 现有的 LLaMA-Factory ChatModel (GPU，默认 4bit 量化)；
+3. TransformersBackend: transformers 直接加载的小模型，CPU 上以 float32 运行，可选 int8 动态量化，
+   让服务功能、压测与评估在没有 GPU 的 CI / 边缘机器上也能跑通；
+4. StubBackend: 不加载模型，按固定速度回放回复，供压测 (load_test.py) 使用。
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class Response:
+    """与 llamafactory.chat.base_engine.Response 字段一致 (API 层按属性读取)，CPU 环境无需安装 LLaMA-Factory"""
+
+    response_text: str
+    response_length: int
+    prompt_length: int
+    finish_reason: str
+
+
+DEFAULT_BACKEND = "llamafactory"
+
+
+class InferenceBackend:
+    """
+    推理后端基类。子类实现 load 与 astream_chat；achat / abatch_chat 有基于 astream_chat 与 BatchGenerator 的默认实现。
+    同步接口 (chat / stream_chat / batch_chat) 在后端自己的事件循环 _loop 上驱动异步接口。
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.engine: Any = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-generate")
+
+    @property
+    def loaded(self) -> bool:
+        return self.engine is not None
+
+    def _start_loop(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name=f"{self.name}-loop", daemon=True).start()
+
+    def load(self) -> "InferenceBackend":
+        raise NotImplementedError
+
+    async def astream_chat(self, messages: List[Dict[str, str]], system: Optional[str] = None, tools: Optional[str] = None,
+                           images=None, videos=None, audios=None, **kwargs):
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+    async def achat(self, messages: List[Dict[str, str]], system: Optional[str] = None, tools: Optional[str] = None,
+                    images=None, videos=None, audios=None, **kwargs) -> List[Response]:
+        chunks = [c async for c in self.astream_chat(messages, system, tools, images, videos, audios, **kwargs)]
+        return [Response(response_text="".join(chunks), response_length=len(chunks), prompt_length=0, finish_reason="stop")]
+
+    async def abatch_chat(self, batch: List[List[Dict[str, str]]], system: Optional[str] = None,
+                          tools: Optional[str] = None, **kwargs) -> List[Response]:
+        """
+        一批对话一起生成 (离线评估 / 压测用，不经过适配器池的锁，不要与在线服务同时使用)。
+        使用 batching.BatchGenerator 的左填充批量解码，两种后端行为一致。
+        """
+        from batching import BatchGenerator, GenerationRequest, resolve_params
+
+        generator = BatchGenerator(self.engine)
+        params = resolve_params(generator.defaults, kwargs)
+        requests = [GenerationRequest(generator.encode(messages, system, tools), params) for messages in batch]
+        future = asyncio.get_running_loop().run_in_executor(self._executor, generator.generate, requests)
+
+        async def collect(req):
+            return "".join([text async for text in req.results()])
+
+        texts = await asyncio.gather(*[collect(req) for req in requests])
+        await future
+        return [Response(response_text=text, response_length=req.tokens, prompt_length=len(req.prompt_ids),
+                         finish_reason=req.finish_reason) for text, req in zip(texts, requests)]
+
+    async def aget_scores(self, batch_input: List[str], **kwargs) -> List[float]:
+        raise NotImplementedError(f"{self.name} 后端不支持打分")
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs) -> List[Response]:
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+    def batch_chat(self, batch, system=None, tools=None, **kwargs) -> List[Response]:
+        task = asyncio.run_coroutine_threadsafe(self.abatch_chat(batch, system, tools, **kwargs), self._loop)
+        return task.result()
+
+
+class LlamaFactoryBackend(InferenceBackend):
+    """LLaMA-Factory ChatModel (huggingface 引擎)；think_budget 通过 output_parser.think_limit 注入 logits processor"""
+
+    name = "llamafactory"
+
+    def __init__(self, model_name_or_path: str, template: str = "qwen3", finetuning_type: str = "lora",
+                 quantization_bit: Optional[int] = 4, adapter_name_or_path: Optional[str] = None, **extra):
+        super().__init__()
+        self.args = dict(model_name_or_path=model_name_or_path, template=template, finetuning_type=finetuning_type,
+                         quantization_bit=quantization_bit or None, adapter_name_or_path=adapter_name_or_path, **extra)
+        self.args = {k: v for k, v in self.args.items() if v is not None}
+        self.chat_model = None
+
+    def load(self) -> "LlamaFactoryBackend":
+        from llamafactory.chat import ChatModel
+        self.chat_model = ChatModel(self.args)
+        self.engine = self.chat_model.engine
+        self._loop = self.chat_model._loop
+        return self
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                           think_budget: Optional[int] = None, **kwargs):
+        from output_parser import think_limit
+        with think_limit(self.engine.tokenizer, think_budget):
+            async for new_text in self.chat_model.astream_chat(messages, system, tools, images, videos, audios, **kwargs):
+                yield new_text
+
+    async def achat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                    think_budget: Optional[int] = None, **kwargs):
+        from output_parser import think_limit
+        with think_limit(self.engine.tokenizer, think_budget):
+            return await self.chat_model.achat(messages, system, tools, images, videos, audios, **kwargs)
+
+    async def aget_scores(self, batch_input, **kwargs):
+        return await self.chat_model.aget_scores(batch_input, **kwargs)
+
+
+class TransformersEngine:
+    """与 LLaMA-Factory engine 相同的属性集合 (model / tokenizer / template / generating_args / can_generate)"""
+
+    can_generate = True
+    template = None  # 使用 tokenizer 自带的 chat_template
+
+    def __init__(self, model: Any, tokenizer: Any, generating_args: Dict[str, Any]):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.generating_args = generating_args
+
+
+class TransformersBackend(InferenceBackend):
+    """
+    transformers 直接加载的模型，生成使用 batching.BatchGenerator 的解码循环 (与批处理 / 会话缓存路径一致)。
+    adapter_name_or_path 在加载时合并进基座；quantization_bit=8 时在 CPU 上做 int8 动态量化 (nn.Linear)，
+    量化后的模型不能再由适配器池挂载 LoRA。
+    """
+
+    name = "transformers"
+
+    def __init__(self, model_name_or_path: str, device: str = "cpu", dtype: str = "float32",
+                 quantization_bit: Optional[int] = None, threads: Optional[int] = None,
+                 adapter_name_or_path: Optional[str] = None):
+        super().__init__()
+        self.model_name_or_path = model_name_or_path
+        self.adapter_name_or_path = adapter_name_or_path
+        self.device = device
+        self.dtype = dtype
+        self.quantization_bit = quantization_bit
+        self.threads = threads
+        self.generator = None
+        self._start_loop()
+
+    def load(self) -> "TransformersBackend":
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        from batching import BatchGenerator, GENERATION_DEFAULTS
+
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name_or_path)
+        model = AutoModelForCausalLM.from_pretrained(self.model_name_or_path, torch_dtype=getattr(torch, self.dtype),
+                                                     low_cpu_mem_usage=True).to(self.device).eval()
+        if self.adapter_name_or_path:
+            from peft import PeftModel
+            model = PeftModel.from_pretrained(model, self.adapter_name_or_path).merge_and_unload().eval()
+        if self.quantization_bit == 8:
+            if self.device != "cpu":
+                raise ValueError("int8 动态量化只支持 CPU")
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif self.quantization_bit:
+            raise ValueError(f"transformers 后端不支持 {self.quantization_bit}bit 量化 (可用 8 或不量化)")
+
+        config = model.generation_config
+        generating_args = dict(GENERATION_DEFAULTS)
+        generating_args.update({k: getattr(config, k) for k in ("temperature", "top_p", "top_k", "repetition_penalty")
+                                if getattr(config, k, None) is not None})
+        self.engine = TransformersEngine(model, tokenizer, generating_args)
+        self.generator = BatchGenerator(self.engine)
+        return self
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None, **kwargs):
+        from batching import GenerationRequest, resolve_params
+
+        if images or videos or audios:
+            raise ValueError("transformers 后端只支持纯文本对话")
+        params = resolve_params(self.generator.defaults, kwargs)
+        req = GenerationRequest(self.generator.encode(messages, system, tools), params)
+        future = req.loop.run_in_executor(self._executor, self.generator.generate, [req])
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        async for new_text in req.results():
+            yield new_text
+
+    async def achat(self, messages, system=None, tools=None, images=None, videos=None, audios=None, **kwargs):
+        if (kwargs.get("num_return_sequences") or 1) > 1:
+            n = kwargs.pop("num_return_sequences")
+            return await self.abatch_chat([messages] * n, system, tools, **kwargs)
+        return await self.abatch_chat([messages], system, tools, **kwargs)
+
+
+STUB_REPLY = "<think>先观察一下对方的反应，再决定怎么回应。</think> *微微歪头，认真地看着你* 嗯……我在听，你继续说吧。 <mood:neutral>"
+
+
+class StubEngine:
+    """桩后端的 engine：没有模型与 tokenizer，批处理与会话缓存不可用"""
+
+    can_generate = True
+    template = None
+    model = None
+    tokenizer = None
+
+    def __init__(self, generating_args: Dict[str, Any]):
+        self.generating_args = generating_args
+
+
+class StubBackend(InferenceBackend):
+    """
+    不加载模型的桩后端：按设定的预填充与解码速度回放固定格式的回复 (每个字符视为一个 Token)，
+    slots 个请求可同时生成，其余排队。用于在 CPU 上压测服务层与 load_test.py 本身。
+    reply_tokens 默认为一条完整回复的长度 (含结尾的情绪标签)，更长时重复整条回复，更短时截断。
+    """
+
+    name = "stub"
+
+    def __init__(self, tokens_per_second: float = 30.0, prefill_tokens_per_second: float = 2000.0,
+                 reply_tokens: Optional[int] = None, slots: int = 1, reply: str = STUB_REPLY):
+        super().__init__()
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.reply_tokens = reply_tokens or len(reply)
+        self.slots = slots
+        self.reply = reply
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._start_loop()
+
+    def load(self) -> "StubBackend":
+        from batching import GENERATION_DEFAULTS
+        self.engine = StubEngine(dict(GENERATION_DEFAULTS))
+        return self
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                           max_new_tokens: Optional[int] = None, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.slots)
+        prompt_tokens = len(system or "") + sum(len(m.get("content") or "") for m in messages)
+        length = min(self.reply_tokens, max_new_tokens or self.reply_tokens)
+        text = (self.reply * (length // max(len(self.reply), 1) + 1))[:length]
+        async with self._semaphore:
+            await asyncio.sleep(prompt_tokens / self.prefill_tokens_per_second)
+            for char in text:
+                await asyncio.sleep(1 / self.tokens_per_second)
+                yield char
+
+
+BACKENDS = {
+    LlamaFactoryBackend.name: LlamaFactoryBackend,
+    TransformersBackend.name: TransformersBackend,
+    StubBackend.name: StubBackend,
+}
+
+
+def add_backend_args(parser):
+    """各脚本共用的后端参数 (模型路径与模板由脚本自己定义)"""
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=DEFAULT_BACKEND,
+                        help="Inference backend: llamafactory (GPU ChatModel), transformers (small / CPU model) or stub (no model, for load tests)")
+    parser.add_argument("--quantization_bit", type=int,
+                        help="llamafactory: 4 / 8 bit (default 4, 0 = off); transformers: 8 = int8 dynamic quantization on CPU")
+    parser.add_argument("--device", type=str, default="cpu", help="transformers backend device (cpu / cuda)")
+    parser.add_argument("--dtype", type=str, default="float32", help="transformers backend dtype")
+    parser.add_argument("--threads", type=int, help="torch CPU threads (transformers backend)")
+    parser.add_argument("--stub_tokens_per_second", type=float, default=30.0, help="Decode speed of the stub backend")
+    parser.add_argument("--stub_slots", type=int, default=1, help="Concurrent generations of the stub backend")
+
+
+def create_backend(args, model_name_or_path: str, template: str = "qwen3", finetuning_type: str = "lora",
+                   quantization_bit: Optional[int] = 4, adapter_name_or_path: Optional[str] = None) -> InferenceBackend:
+    """按命令行参数构造 (尚未加载的) 后端；quantization_bit 为 llamafactory 后端在命令行未指定时的默认值"""
+    if args.backend == StubBackend.name:
+        return StubBackend(tokens_per_second=args.stub_tokens_per_second, slots=args.stub_slots)
+    if args.backend == TransformersBackend.name:
+        return TransformersBackend(model_name_or_path, device=args.device, dtype=args.dtype,
+                                   quantization_bit=args.quantization_bit, threads=args.threads,
+                                   adapter_name_or_path=adapter_name_or_path)
+    bits = args.quantization_bit if args.quantization_bit is not None else quantization_bit
+    return LlamaFactoryBackend(model_name_or_path, template=template, finetuning_type=finetuning_type,
+                               quantization_bit=bits, adapter_name_or_path=adapter_name_or_path)
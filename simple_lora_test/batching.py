@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+动态批处理 (Dynamic Batching)
+功能：在 ChatModel 前增加批处理调度器，把并发请求合并为一个批次生成，并把各自的新 Token 流式返回给调用方。
+1. 收集窗口：队首请求到达后最多等待 window_ms，或凑满 max_batch 个请求即开始生成；
+2. 同一批次只包含同一个 LoRA 适配器的请求 (与 adapter_pool 配合)，不同适配器按到达顺序分批；
+3. 生成循环自行管理 KV Cache：左填充对齐提示词，逐步解码，每行独立采样 (温度 / top_p / top_k / 重复惩罚)，
+   某行结束 (EOS、达到 max_new_tokens 或调用方断开) 后立即从批次与 KV Cache 中移除；
+4. 请求带 think_budget 时，思考段超出预算即强制输出 </think> (output_parser.ThinkBudget)。
+`BatchingChatModel` 与 ChatModel 接口一致，可直接传给 LLaMA-Factory 的 create_app；
+含图片/视频/音频的请求回退到原 ChatModel 逐条生成。
+"""
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any
+
+from adapter_pool import current_adapter
+from output_parser import ThinkBudget, think_token_ids
+
+DEFAULT_MAX_BATCH = 8
+DEFAULT_WINDOW_MS = 20
+
+GENERATION_DEFAULTS = {
+    "do_sample": True,
+    "temperature": 0.95,
+    "top_p": 0.7,
+    "top_k": 50,
+    "max_new_tokens": 1024,
+    "repetition_penalty": 1.0,
+    "think_budget": 0,  # 思考段最多的 Token 数，0 表示不限制
+}
+
+_DONE = object()
+
+
+def resolve_params(defaults: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """合并采样参数：内置默认值 < 模型的 generating_args < 请求参数；温度为 0 时改为贪心解码"""
+    params = dict(GENERATION_DEFAULTS)
+    for source in (defaults or {}, overrides):
+        params.update({k: source[k] for k in GENERATION_DEFAULTS if source.get(k) is not None})
+    if params["temperature"] <= 0:
+        params["do_sample"] = False
+    return params
+
+
+class GenerationRequest:
+    """批次中的一行：提示词、采样参数与回传队列 (生成线程通过 call_soon_threadsafe 写入)"""
+
+    def __init__(self, prompt_ids: List[int], params: Dict[str, Any], adapter: Optional[str] = None):
+        self.prompt_ids = prompt_ids
+        self.params = params
+        self.adapter = adapter
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.submitted = self.loop.time()
+        self.cancelled = False
+        self.tokens = 0
+        self.finish_reason = "stop"
+        self.first_token_at: Optional[float] = None
+        self.think: Optional[ThinkBudget] = None
+
+    def emit(self, text: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, error if error is not None else _DONE)
+
+    async def results(self):
+        """逐段返回生成的文本；调用方提前退出时标记为取消，生成线程在下一步移除该行"""
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.cancelled = True
+
+
+class BatchGenerator:
+    """
+    在 holder (LLaMA-Factory 的 engine，或任何带 model / tokenizer 属性的对象) 上执行批量生成。
+    holder 有 template 时按 LLaMA-Factory 模板编码，否则使用 tokenizer 自带的 chat_template。
+    """
+
+    def __init__(self, holder: Any):
+        self.holder = holder
+
+    @property
+    def defaults(self) -> Dict[str, Any]:
+        return getattr(self.holder, "generating_args", None) or {}
+
+    def encode(self, messages: List[Dict[str, str]], system: Optional[str] = None,
+               tools: Optional[str] = None) -> List[int]:
+        tokenizer = self.holder.tokenizer
+        template = getattr(self.holder, "template", None)
+        if template is not None:
+            paired = messages + [{"role": "assistant", "content": ""}]
+            prompt_ids, _ = template.encode_oneturn(tokenizer, paired, system or self.defaults.get("default_system"), tools)
+            return prompt_ids
+        chat = ([{"role": "system", "content": system}] if system else []) + messages
+        return list(tokenizer.apply_chat_template(chat, add_generation_prompt=True, tokenize=True))
+
+    def think_budget(self, req: GenerationRequest) -> Optional[ThinkBudget]:
+        """请求设置了思考预算且 <think> / </think> 为单个 Token 时返回计数器"""
+        budget = req.params.get("think_budget") or 0
+        ids = think_token_ids(self.holder.tokenizer) if budget > 0 else None
+        req.think = ThinkBudget(ids[0], ids[1], budget, req.prompt_ids) if ids else None
+        return req.think
+
+    def stop_ids(self) -> List[int]:
+        tokenizer = self.holder.tokenizer
+        template = getattr(self.holder, "template", None)
+        if template is not None and hasattr(template, "get_stop_token_ids"):
+            return list(template.get_stop_token_ids(tokenizer))
+        return [tokenizer.eos_token_id] if tokenizer.eos_token_id is not None else []
+
+    @staticmethod
+    def _select_rows(past, keep):
+        """从 KV Cache 中保留指定的行"""
+        if hasattr(past, "batch_select_indices"):  # transformers Cache 对象
+            past.batch_select_indices(keep)
+            return past
+        return tuple(tuple(t[keep] for t in layer) for layer in past)
+
+    @staticmethod
+    def _sample(logits, rows: List[GenerationRequest], histories: List[List[int]]):
+        import torch
+        for i, req in enumerate(rows):
+            penalty = req.params["repetition_penalty"]
+            if penalty and penalty != 1.0:
+                seen = torch.tensor(sorted(set(histories[i])), device=logits.device)
+                scores = logits[i, seen]
+                logits[i, seen] = torch.where(scores < 0, scores * penalty, scores / penalty)
+
+        greedy = logits.argmax(dim=-1)
+        sampling = [req.params["do_sample"] for req in rows]
+        if not any(sampling):
+            return greedy
+        device = logits.device
+        temps = torch.tensor([max(req.params["temperature"], 1e-5) for req in rows], device=device)
+        top_p = torch.tensor([req.params["top_p"] or 1.0 for req in rows], device=device)
+        top_k = torch.tensor([req.params["top_k"] or logits.shape[-1] for req in rows], device=device)
+        probs = torch.softmax(logits / temps[:, None], dim=-1)
+        sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+        cumulative = sorted_probs.cumsum(dim=-1)
+        ranks = torch.arange(logits.shape[-1], device=device)[None, :]
+        mask = ((cumulative - sorted_probs) > top_p[:, None]) | (ranks >= top_k[:, None])
+        sorted_probs = sorted_probs.masked_fill(mask, 0.0)
+        choice = torch.multinomial(sorted_probs, 1)
+        sampled = sorted_idx.gather(-1, choice).squeeze(-1)
+        return torch.where(torch.tensor(sampling, device=device), sampled, greedy)
+
+    def generate(self, batch: List[GenerationRequest]):
+        """在生成线程中运行；每行结束时调用 finish()"""
+        import torch
+        model, tokenizer = self.holder.model, self.holder.tokenizer
+        stop_ids = set(self.stop_ids())
+        pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else next(iter(stop_ids), 0)
+        device = next(model.parameters()).device
+
+        rows = [req for req in batch if not req.cancelled]
+        for req in batch:
+            if req.cancelled:
+                req.finish()
+        if not rows:
+            return
+        width = max(len(req.prompt_ids) for req in rows)
+        input_ids = torch.full((len(rows), width), pad_id, dtype=torch.long)
+        attention = torch.zeros((len(rows), width), dtype=torch.long)
+        for i, req in enumerate(rows):
+            input_ids[i, width - len(req.prompt_ids):] = torch.tensor(req.prompt_ids)
+            attention[i, width - len(req.prompt_ids):] = 1
+        input_ids, attention = input_ids.to(device), attention.to(device)
+        positions = (attention.cumsum(-1) - 1).clamp(min=0)
+        histories = [list(req.prompt_ids) for req in rows]
+        for req in rows:
+            self.think_budget(req)
+        generated: List[List[int]] = [[] for _ in rows]
+        emitted = ["" for _ in rows]
+        past = None
+
+        try:
+            with torch.inference_mode():
+                while rows:
+                    out = model(input_ids=input_ids, attention_mask=attention, position_ids=positions,
+                                past_key_values=past, use_cache=True)
+                    past = out.past_key_values
+                    next_tokens = self._sample(out.logits[:, -1, :].float(), rows, histories)
+
+                    keep = []
+                    for i, req in enumerate(rows):
+                        token = int(next_tokens[i])
+                        if req.think is not None:
+                            # 思考预算用尽时改为 </think>，后续输入使用改写后的 Token
+                            token = req.think.steer(token)
+                            next_tokens[i] = token
+                        if req.cancelled:
+                            req.finish()
+                            continue
+                        if token in stop_ids:
+                            req.finish()
+                            continue
+                        generated[i].append(token)
+                        histories[i].append(token)
+                        req.tokens += 1
+                        text = tokenizer.decode(generated[i], skip_special_tokens=True)
+                        # 多字节字符未解码完整时暂不输出
+                        if not text.endswith("�") and len(text) > len(emitted[i]):
+                            req.emit(text[len(emitted[i]):])
+                            emitted[i] = text
+                        if req.tokens >= req.params["max_new_tokens"]:
+                            req.finish_reason = "length"
+                            req.finish()
+                            continue
+                        keep.append(i)
+
+                    if len(keep) < len(rows):
+                        if not keep:
+                            break
+                        index = torch.tensor(keep, device=device)
+                        past = self._select_rows(past, index)
+                        attention, positions, next_tokens = attention[index], positions[index], next_tokens[index]
+                        rows = [rows[i] for i in keep]
+                        histories = [histories[i] for i in keep]
+                        generated = [generated[i] for i in keep]
+                        emitted = [emitted[i] for i in keep]
+                    input_ids = next_tokens[:, None]
+                    attention = torch.cat([attention, attention.new_ones((len(rows), 1))], dim=-1)
+                    positions = positions[:, -1:] + 1
+        except BaseException as e:
+            for req in rows:
+                req.finish(e)
+            raise
+
+
+class BatchScheduler:
+    """
+    调度器：请求进入等待队列，后台任务按收集窗口组批，在单独的生成线程中执行。
+    pool 不为空时，每个批次在持有 pool.lock 的情况下切换到批次的适配器。
+    """
+
+    def __init__(self, generator: BatchGenerator, max_batch: int = DEFAULT_MAX_BATCH,
+                 window_ms: float = DEFAULT_WINDOW_MS, pool: Any = None):
+        self.generator = generator
+        self.max_batch = max(1, max_batch)
+        self.window = window_ms / 1000.0
+        self.pool = pool
+        self.pending: List[GenerationRequest] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-generate")
+        self.counters = {"requests": 0, "batches": 0, "rows": 0, "largest_batch": 0}
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _take_batch(self) -> List[GenerationRequest]:
+        """取队首请求所属适配器的前 max_batch 个请求 (先到先服务)"""
+        self.pending = [req for req in self.pending if not req.cancelled]
+        if not self.pending:
+            return []
+        adapter = self.pending[0].adapter
+        batch = [req for req in self.pending if req.adapter == adapter][:self.max_batch]
+        taken = set(map(id, batch))
+        self.pending = [req for req in self.pending if id(req) not in taken]
+        return batch
+
+    def _ready_count(self) -> int:
+        adapter = self.pending[0].adapter
+        return sum(1 for req in self.pending if req.adapter == adapter and not req.cancelled)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # 收集窗口从队首请求到达时算起：已经排队等过上一批的请求不再额外等待
+            deadline = self.pending[0].submitted + self.window
+            while self.pending and self._ready_count() < self.max_batch and loop.time() < deadline:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            batch = self._take_batch()
+            if not batch:
+                continue
+            self.counters["batches"] += 1
+            self.counters["rows"] += len(batch)
+            self.counters["largest_batch"] = max(self.counters["largest_batch"], len(batch))
+            try:
+                await loop.run_in_executor(self._executor, self._execute, batch)
+            except Exception as e:
+                print(f"[Batching] 批次生成失败: {e}", flush=True)
+
+    def _execute(self, batch: List[GenerationRequest]):
+        if self.pool is None:
+            return self.generator.generate(batch)
+        with self.pool.lock:
+            self.pool.activate(batch[0].adapter)
+            self.generator.generate(batch)
+
+    async def stream(self, prompt_ids: List[int], params: Dict[str, Any], adapter: Optional[str] = None,
+                     request: Optional[GenerationRequest] = None):
+        """提交请求并逐段返回生成的文本；调用方提前退出时该行在下一步被移出批次"""
+        self._ensure_started()
+        req = request or GenerationRequest(prompt_ids, params, adapter)
+        self.pending.append(req)
+        self.counters["requests"] += 1
+        self._wakeup.set()
+        async for text in req.results():
+            yield text
+
+    def stats(self) -> Dict[str, Any]:
+        batches = self.counters["batches"]
+        return dict(self.counters, max_batch=self.max_batch, window_ms=self.window * 1000,
+                    queued=len(self.pending), mean_batch=round(self.counters["rows"] / batches, 2) if batches else 0.0)
+
+
+class BatchingChatModel:
+    """
+    ChatModel 的代理：文本请求交给 BatchScheduler，其余 (多模态、打分) 交给被包装的 chat_model。
+    chat_model 可以是 MultiAdapterChatModel，两条路径通过 pool.lock 互斥。
+    """
+
+    def __init__(self, chat_model: Any, scheduler: BatchScheduler):
+        self.chat_model = chat_model
+        self.scheduler = scheduler
+
+    @property
+    def engine(self):
+        return self.chat_model.engine
+
+    def __getattr__(self, name):
+        return getattr(self.chat_model, name)
+
+    def _prepare(self, messages, system, tools, adapter, kwargs) -> GenerationRequest:
+        pool = self.scheduler.pool
+        name = pool.resolve(adapter if adapter is not None else current_adapter.get()) if pool else None
+        generator = self.scheduler.generator
+        params = resolve_params(generator.defaults, kwargs)
+        return GenerationRequest(generator.encode(messages, system, tools), params, name)
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                           adapter: Optional[str] = None, **kwargs):
+        if images or videos or audios:
+            extra = {"adapter": adapter} if adapter is not None else {}
+            async for new_token in self.chat_model.astream_chat(messages, system, tools, images, videos, audios, **extra, **kwargs):
+                yield new_token
+            return
+        req = self._prepare(messages, system, tools, adapter, kwargs)
+        async for new_token in self.scheduler.stream(req.prompt_ids, req.params, req.adapter, request=req):
+            yield new_token
+
+    async def achat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                    adapter: Optional[str] = None, **kwargs):
+        if images or videos or audios:
+            extra = {"adapter": adapter} if adapter is not None else {}
+            return await self.chat_model.achat(messages, system, tools, images, videos, audios, **extra, **kwargs)
+        from backends import Response
+
+        async def one():
+            req = self._prepare(messages, system, tools, adapter, kwargs)
+            text = "".join([t async for t in self.scheduler.stream(req.prompt_ids, req.params, req.adapter, request=req)])
+            return Response(response_text=text, response_length=req.tokens,
+                            prompt_length=len(req.prompt_ids), finish_reason=req.finish_reason)
+
+        # num_return_sequences 个独立请求进入同一个收集窗口
+        return list(await asyncio.gather(*[one() for _ in range(kwargs.pop("num_return_sequences", None) or 1)]))
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs):
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self.chat_model._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self.chat_model._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+
+def install_batching_routes(app, scheduler: BatchScheduler):
+    """/v1/batching 返回批次数、平均批大小与排队长度"""
+
+    @app.get("/v1/batching")
+    async def batching_stats():
+        return scheduler.stats()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+动态批处理基准测试
+用 CPU 可运行的小模型对比逐条生成 (max_batch=1) 与动态批处理的吞吐与延迟分位数。
+两种模式使用同一个生成循环与相同的贪心解码参数，差别只在批大小。
+
+用法：
+    python bench_batching.py --model Qwen/Qwen2.5-0.5B-Instruct --requests 32 --concurrency 16 --max-batch 8
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from types import SimpleNamespace
+from typing import Dict, List
+
+from batching import BatchGenerator, BatchScheduler, GenerationRequest, resolve_params
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DATA = os.path.join(CURRENT_DIR, "data", "sample_data.jsonl")
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def load_prompts(path: str, limit: int, seed: int = 0) -> List[List[Dict[str, str]]]:
+    """从 Alpaca 格式样本构造单轮对话 (instruction + input)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    random.Random(seed).shuffle(rows)
+    prompts = []
+    for row in rows[:limit]:
+        content = row["instruction"] + ("\n\n" + row["input"] if row.get("input") else "")
+        prompts.append([{"role": "user", "content": content}])
+    return prompts
+
+
+async def run_mode(generator: BatchGenerator, prompts, params, concurrency: int, max_batch: int, window_ms: float):
+    scheduler = BatchScheduler(generator, max_batch=max_batch, window_ms=window_ms)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, ttfts, tokens = [], [], []
+
+    async def one(messages):
+        async with semaphore:
+            started = time.perf_counter()
+            first = None
+            req = GenerationRequest(generator.encode(messages), params)
+            async for _ in scheduler.stream(req.prompt_ids, req.params, request=req):
+                first = first or time.perf_counter()
+            end = time.perf_counter()
+            latencies.append(end - started)
+            ttfts.append((first or end) - started)
+            tokens.append(req.tokens)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(m) for m in prompts])
+    wall = time.perf_counter() - started
+    stats = scheduler.stats()
+    return {
+        "max_batch": max_batch,
+        "wall_seconds": round(wall, 2),
+        "requests_per_second": round(len(prompts) / wall, 3),
+        "tokens_per_second": round(sum(tokens) / wall, 1),
+        "latency_p50": round(percentile(latencies, 50), 2),
+        "latency_p99": round(percentile(latencies, 99), 2),
+        "ttft_p50": round(percentile(ttfts, 50), 2),
+        "ttft_p99": round(percentile(ttfts, 99), 2),
+        "mean_batch": stats["mean_batch"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="动态批处理吞吐 / 延迟基准")
+    parser.add_argument("--model", default="Qwen/Qwen2.5-0.5B-Instruct", help="CPU 可运行的小模型 (本地路径或仓库名)")
+    parser.add_argument("--data", default=DEFAULT_DATA, help="Alpaca 格式样本 JSONL")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=16, help="同时在途的请求数")
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--window-ms", type=float, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, help="torch CPU 线程数")
+    args = parser.parse_args()
+
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).eval()
+    generator = BatchGenerator(SimpleNamespace(model=model, tokenizer=tokenizer))
+
+    prompts = load_prompts(args.data, args.requests)
+    # 贪心解码，两种模式生成相同的内容
+    params = resolve_params({}, {"temperature": 0, "max_new_tokens": args.max_new_tokens})
+    print(f"[Info] 模型 {args.model} | 请求 {len(prompts)} | 并发 {args.concurrency} | max_new_tokens {args.max_new_tokens}")
+
+    results = []
+    for max_batch in (1, args.max_batch):
+        result = asyncio.run(run_mode(generator, prompts, params, args.concurrency, max_batch, args.window_ms))
+        results.append(result)
+        print(f"[{'逐条' if max_batch == 1 else '批处理'}] " + " | ".join(f"{k}={v}" for k, v in result.items()))
+
+    base, batched = results
+    print(f"[Summary] 吞吐提升 {batched['requests_per_second'] / max(base['requests_per_second'], 1e-9):.2f}x，"
+          f"p99 延迟 {base['latency_p99']}s -> {batched['latency_p99']}s")
+
+if __name__ == "__main__":
+    main()
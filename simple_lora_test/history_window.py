@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+对话历史窗口 (History Window)
+功能：按 Token 预算裁剪多轮对话，使每轮的提示词开销基本恒定。
+1. 人设前缀 (如 "你现在是叶灵静。") 与最近几轮对话原样保留；
+2. 超出预算时窗口一次性前移到预算的 low_water 比例以下 (而不是每轮挪一轮)，两次前移之间提示词前缀保持不变，
+   会话 KV Cache (session_cache) 可以持续命中；
+3. 移出窗口的旧对话由基座模型在后台滚动概括为一段摘要 (不阻塞当前回复)，下一轮起以 "前情提要" 的形式接在人设之后。
+只对带会话 ID 的请求生效 (API 请求头 X-Session-Id / Gradio 浏览器会话)，会话历史被清空或改写时自动重置。
+"""
+
+import re
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Any, Tuple
+
+from adapter_pool import BASE_ADAPTER, current_adapter
+from session_cache import current_session
+
+MESSAGE_OVERHEAD = 4  # 每条消息的模板开销 (角色标记、换行等) 估计
+SUMMARY_HEADER = "【前情提要】"
+THINK_PATTERN = re.compile(r"<think>.*?</think>", re.S)
+
+SUMMARY_PROMPT = (
+    "下面是一段角色扮演对话的片段。请用简洁的中文 (不超过 {limit} 字) 概括其中的关键情节、人物关系与情绪变化，"
+    "只输出概括内容，供后续对话参考。\n\n{previous}对话：\n{dialogue}"
+)
+
+
+def token_counter(tokenizer: Any = None) -> Callable[[str], int]:
+    """有 tokenizer 时按真实 Token 计数，否则按字符数估计 (中文约 1 字 1 Token)"""
+    if tokenizer is None:
+        return len
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def _digest(turns: List[Tuple[str, str]]) -> str:
+    h = hashlib.sha1()
+    for user, assistant in turns:
+        h.update(user.encode('utf-8') + b"\x00" + assistant.encode('utf-8') + b"\x01")
+    return h.hexdigest()
+
+
+def split_turns(messages: List[Dict[str, str]]) -> Optional[Tuple[List[Tuple[str, str]], str]]:
+    """user/assistant 交替的消息 -> ([(用户, 回复)], 最后一条用户消息)；格式不符时返回 None"""
+    if not messages or len(messages) % 2 == 0:
+        return None
+    roles = [m.get("role") for m in messages]
+    if any(role != ("user" if i % 2 == 0 else "assistant") for i, role in enumerate(roles)):
+        return None
+    turns = [(messages[i]["content"], messages[i + 1]["content"]) for i in range(0, len(messages) - 1, 2)]
+    return turns, messages[-1]["content"]
+
+
+class HistoryWindow:
+    """
+    每个会话记录窗口起点 (轮次下标) 与已生成的摘要：
+    {"start": 窗口起点, "digest": 窗口之前各轮的哈希, "summary": 摘要, "covered": 摘要覆盖的轮数, "pending": 是否正在概括}
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], budget: int = 2048, low_water: float = 0.6,
+                 summary_tokens: int = 256, max_sessions: int = 1024):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.low_water = low_water
+        self.summary_tokens = summary_tokens
+        self.max_sessions = max_sessions
+        self.states: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict()
+        self.counters = {"requests": 0, "slides": 0, "summaries": 0, "summary_failures": 0}
+
+    def _cost(self, text: str) -> int:
+        return self.count_tokens(text) + MESSAGE_OVERHEAD
+
+    def _state(self, key, turns) -> Dict[str, Any]:
+        state = self.states.get(key)
+        # 窗口之前的历史被改写 (清空、换了对话) 时重置
+        if state is None or state["start"] > len(turns) or state["digest"] != _digest(turns[:state["start"]]):
+            state = {"start": 0, "digest": _digest([]), "summary": "", "covered": 0, "pending": False, "folded": []}
+            self.states[key] = state
+        self.states.move_to_end(key)
+        while len(self.states) > self.max_sessions:
+            self.states.popitem(last=False)
+        return state
+
+    def apply(self, key, messages: List[Dict[str, str]], persona: Optional[str] = None) -> List[Dict[str, str]]:
+        """返回裁剪后的消息列表；persona 为第一条用户消息开头的人设前缀，裁剪后接到窗口内第一条用户消息之前"""
+        parsed = split_turns(messages)
+        if parsed is None:
+            return messages
+        turns, last_user = parsed
+        if persona:
+            first = turns[0][0] if turns else last_user
+            if not first.startswith(persona):
+                persona = None
+            elif turns:
+                turns[0] = (first[len(persona):].lstrip("\n"), turns[0][1])
+            else:
+                last_user = last_user[len(persona):].lstrip("\n")
+        self.counters["requests"] += 1
+        state = self._state(key, turns)
+
+        fixed = self._cost(last_user) + (self.count_tokens(persona) if persona else 0) + self.count_tokens(state["summary"])
+        costs = [self._cost(u) + self._cost(a) for u, a in turns]
+        if fixed + sum(costs[state["start"]:]) > self.budget:
+            # 一次前移到低水位，之后几轮前缀保持不变
+            start, total = state["start"], fixed + sum(costs[state["start"]:])
+            while start < len(turns) and total > self.budget * self.low_water:
+                total -= costs[start]
+                start += 1
+            state["start"], state["digest"] = start, _digest(turns[:start])
+            self.counters["slides"] += 1
+        state["folded"] = turns[state["covered"]:state["start"]]
+
+        window = turns[state["start"]:]
+        head = [persona] if persona else []
+        if state["summary"]:
+            head.append(SUMMARY_HEADER + state["summary"])
+        result = []
+        for user, assistant in window:
+            result.append({"role": "user", "content": user})
+            result.append({"role": "assistant", "content": assistant})
+        result.append({"role": "user", "content": last_user})
+        if head:
+            result[0] = {"role": "user", "content": "\n\n".join(head + [result[0]["content"]])}
+        return result
+
+    def needs_summary(self, key) -> bool:
+        state = self.states.get(key)
+        return bool(state and state["folded"] and not state["pending"])
+
+    def summary_prompt(self, key) -> Tuple[List[Dict[str, str]], int]:
+        """构造概括请求 (已有摘要 + 新移出窗口的对话)，返回 (消息, 本次覆盖到的轮次)"""
+        state = self.states[key]
+        dialogue = "\n".join(f"用户：{u}\n角色：{THINK_PATTERN.sub('', a).strip()}" for u, a in state["folded"])
+        previous = f"已有摘要：{state['summary']}\n\n" if state["summary"] else ""
+        prompt = SUMMARY_PROMPT.format(limit=self.summary_tokens, previous=previous, dialogue=dialogue)
+        return [{"role": "user", "content": prompt}], state["start"]
+
+    def set_summary(self, key, summary: str, covered: int):
+        state = self.states.get(key)
+        if state is None or covered < state["covered"]:
+            return
+        summary = THINK_PATTERN.sub("", summary).strip()
+        # 摘要本身也受预算约束
+        while summary and self.count_tokens(summary) > self.summary_tokens:
+            summary = summary[:int(len(summary) * 0.9)]
+        state["summary"], state["covered"] = summary, covered
+        state["folded"] = []
+        self.counters["summaries"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.counters, sessions=len(self.states), budget=self.budget)
+
+
+class WindowedChatModel:
+    """
+    ChatModel 的代理：带会话 ID 的请求先经过 HistoryWindow 裁剪，回复结束后在后台概括移出窗口的对话。
+    概括使用不挂载适配器的基座 (pool 存在时)，不写入会话缓存。
+    """
+
+    def __init__(self, chat_model: Any, window: HistoryWindow, persona: Optional[str] = None,
+                 forward_session: bool = False, use_base: bool = True):
+        self.chat_model = chat_model
+        self.window = window
+        self.persona = persona
+        self.forward_session = forward_session
+        self.use_base = use_base
+        self._tasks = set()
+
+    @property
+    def engine(self):
+        return self.chat_model.engine
+
+    def __getattr__(self, name):
+        return getattr(self.chat_model, name)
+
+    def _prepare(self, messages, session_id, persona, kwargs):
+        session = session_id or current_session.get()
+        forward = dict(kwargs, session_id=session_id) if self.forward_session and session_id else kwargs
+        if not session:
+            return messages, None, forward
+        key = (session, kwargs.get("adapter"))
+        persona = persona or self.persona
+        if persona and "{model}" in persona:
+            # 多角色共用一个后端时人设随角色变化，如 "你现在是{model}。"
+            persona = persona.replace("{model}", kwargs.get("adapter") or current_adapter.get() or "")
+        return self.window.apply(key, messages, persona), key, forward
+
+    def _schedule_summary(self, key):
+        if key is None or not self.window.needs_summary(key):
+            return
+        self.window.states[key]["pending"] = True
+        task = asyncio.get_running_loop().create_task(self._summarize(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, key):
+        # 概括请求不属于任何会话，不占用会话 KV Cache
+        current_session.set(None)
+        messages, covered = self.window.summary_prompt(key)
+        extra = {"adapter": BASE_ADAPTER} if self.use_base else {}
+        try:
+            responses = await self.chat_model.achat(messages, temperature=0.3, top_p=0.9,
+                                                    max_new_tokens=self.window.summary_tokens * 2, **extra)
+            self.window.set_summary(key, responses[0].response_text, covered)
+        except Exception as e:
+            self.window.counters["summary_failures"] += 1
+            print(f"[History] 概括失败: {e}", flush=True)
+        finally:
+            state = self.window.states.get(key)
+            if state is not None:
+                state["pending"] = False
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                           session_id: Optional[str] = None, persona: Optional[str] = None, **kwargs):
+        messages, key, forward = self._prepare(messages, session_id, persona, kwargs)
+        async for new_token in self.chat_model.astream_chat(messages, system, tools, images, videos, audios, **forward):
+            yield new_token
+        self._schedule_summary(key)
+
+    async def achat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                    session_id: Optional[str] = None, persona: Optional[str] = None, **kwargs):
+        messages, key, forward = self._prepare(messages, session_id, persona, kwargs)
+        responses = await self.chat_model.achat(messages, system, tools, images, videos, audios, **forward)
+        self._schedule_summary(key)
+        return responses
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs):
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self.chat_model._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self.chat_model._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+
+def install_history_routes(app, window: HistoryWindow):
+    """/v1/history 返回窗口前移与摘要次数"""
+
+    @app.get("/v1/history")
+    async def history_stats():
+        return window.stats()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+多轮角色扮演压测 (Load Test)
+按泊松过程以设定的到达率发起 "用户"，每个用户带自己的 X-Session-Id，在 OpenAI 兼容接口上逐轮回放一段多轮对话
+(上一轮的真实回复进入下一轮的历史，与 Gradio 的行为一致)，统计：
+- 首 Token 时间 (TTFT)、Token 间延迟 (ITL)、端到端延迟、单请求解码速度的 p50 / p95 / p99；
+- 总吞吐 (tokens/s、requests/s)、峰值并发、按类型统计的错误率。
+流式接口每个 SSE 分段按一个 Token 计。
+
+对话来源 (JSONL)：
+- Alpaca 格式 (data/sample_data.jsonl)：id 相邻且人设 ("你现在是X。") 相同的样本连成一段对话，
+  第一轮发送 instruction + input，之后各轮只发送 input；
+- 对话格式：每行 {"messages": [...]} (OpenAI) 或 {"conversations": [{"from": "human", "value": ...}]} (ShareGPT)，
+  逐条回放其中的用户消息。
+
+用法：
+    # 不依赖模型的桩服务 (只用标准库，CPU 即可)，或 api_backend.py --backend stub
+    python load_test.py stub --port 8001 --tokens-per-second 30 --slots 2
+    python load_test.py run --url http://127.0.0.1:8001 --rate 0.5 --duration 60
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from bench_batching import DEFAULT_DATA, percentile
+
+PERSONA_PATTERN = re.compile(r"^你现在是(.+?)。")
+QUANTILES = (50, 95, 99)
+
+
+def load_conversations(path: str, max_turns: int = 8) -> List[Dict[str, Any]]:
+    """读取对话：[{"model": 角色名, "turns": [用户消息], "references": [数据集中的回复]}]"""
+    with open(path, 'r', encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    conversations = []
+    if rows and "instruction" in rows[0]:
+        rows.sort(key=lambda r: r.get("id", 0))
+        current, last_id, last_persona = None, None, None
+        for row in rows:
+            persona = row["instruction"].split("\n", 1)[0]
+            if (current is None or persona != last_persona or row.get("id") is None or row["id"] != last_id + 1
+                    or len(current["turns"]) >= max_turns):
+                match = PERSONA_PATTERN.match(persona)
+                current = {"model": match.group(1) if match else None, "turns": [], "references": []}
+                conversations.append(current)
+                content = row["instruction"] + ("\n\n" + row["input"] if row.get("input") else "")
+            else:
+                content = row.get("input") or row["instruction"]
+            current["turns"].append(content)
+            current["references"].append(row.get("output", ""))
+            last_id, last_persona = row.get("id"), persona
+        return conversations
+
+    for row in rows:
+        if "conversations" in row:
+            messages = [{"role": "user" if m["from"] in ("human", "user") else "assistant", "content": m["value"]}
+                        for m in row["conversations"]]
+        else:
+            messages = row["messages"]
+        turns = [m["content"] for m in messages if m["role"] == "user"][:max_turns]
+        references = [m["content"] for m in messages if m["role"] == "assistant"][:max_turns]
+        match = PERSONA_PATTERN.match(turns[0]) if turns else None
+        conversations.append({"model": row.get("model") or (match.group(1) if match else None),
+                              "turns": turns, "references": references + [""] * (len(turns) - len(references))})
+    return [c for c in conversations if c["turns"]]
+
+
+class LoadStats:
+    """逐请求记录 (成功与失败)，结束后汇总分位数"""
+
+    def __init__(self):
+        self.requests: List[Dict[str, Any]] = []
+        self.active_users = 0
+        self.active_requests = 0
+        self.peak_users = 0
+        self.peak_requests = 0
+        self.users = 0
+
+    def user_started(self):
+        self.users += 1
+        self.active_users += 1
+        self.peak_users = max(self.peak_users, self.active_users)
+
+    def report(self, wall: float) -> Dict[str, Any]:
+        ok = [r for r in self.requests if r["error"] is None]
+        errors: Dict[str, int] = {}
+        for r in self.requests:
+            if r["error"] is not None:
+                errors[r["error"]] = errors.get(r["error"], 0) + 1
+        gaps = [gap for r in ok for gap in r["gaps"]]
+        rates = [(r["tokens"] - 1) / (r["end"] - r["first"]) for r in ok if r["tokens"] > 1 and r["end"] > r["first"]]
+
+        def quantiles(values, scale=1.0):
+            return {f"p{q}": round(percentile(values, q) * scale, 2) for q in QUANTILES}
+
+        total = len(self.requests)
+        return {
+            "wall_seconds": round(wall, 2),
+            "users": self.users,
+            "requests": total,
+            "completed": len(ok),
+            "error_rate": round((total - len(ok)) / total, 4) if total else 0.0,
+            "errors": errors,
+            "peak_users": self.peak_users,
+            "peak_requests": self.peak_requests,
+            "requests_per_second": round(len(ok) / wall, 3) if wall else 0.0,
+            "tokens_per_second": round(sum(r["tokens"] for r in ok) / wall, 1) if wall else 0.0,
+            "ttft_ms": quantiles([r["first"] - r["start"] for r in ok], 1000),
+            "itl_ms": quantiles(gaps, 1000),
+            "latency_s": quantiles([r["end"] - r["start"] for r in ok]),
+            "decode_tokens_per_second": quantiles(rates),
+        }
+
+
+async def one_request(client, args, model: Optional[str], messages, session: str, stats: LoadStats) -> Dict[str, Any]:
+    """发送一次流式请求并记录时间点；失败时 error 为错误类型"""
+    import httpx
+
+    payload = {"model": model or args.model, "messages": messages, "stream": True,
+               "max_tokens": args.max_tokens, "temperature": args.temperature}
+    record = {"start": time.perf_counter(), "first": None, "end": None, "tokens": 0, "gaps": [], "error": None, "text": ""}
+    stats.active_requests += 1
+    stats.peak_requests = max(stats.peak_requests, stats.active_requests)
+    last = None
+    try:
+        async with client.stream("POST", "/v1/chat/completions", json=payload,
+                                 headers={"X-Session-Id": session}) as response:
+            if response.status_code != 200:
+                await response.aread()
+                record["error"] = f"http_{response.status_code}"
+                return record
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0].get("delta") or {}
+                if not delta.get("content"):
+                    continue
+                now = time.perf_counter()
+                if record["first"] is None:
+                    record["first"] = now
+                else:
+                    record["gaps"].append(now - last)
+                last = now
+                record["tokens"] += 1
+                record["text"] += delta["content"]
+        if record["first"] is None:
+            record["error"] = "empty"
+    except httpx.TimeoutException:
+        record["error"] = "timeout"
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        record["error"] = type(e).__name__
+    finally:
+        record["end"] = time.perf_counter()
+        stats.active_requests -= 1
+        stats.requests.append(record)
+    return record
+
+
+async def run_user(client, args, conversation: Dict[str, Any], stats: LoadStats, rng: random.Random):
+    """一个用户：逐轮发送，轮与轮之间停顿 (思考 / 打字时间)；出错后该用户离开"""
+    session = uuid.uuid4().hex
+    messages: List[Dict[str, str]] = []
+    stats.user_started()
+    try:
+        for i, turn in enumerate(conversation["turns"]):
+            messages.append({"role": "user", "content": turn})
+            record = await one_request(client, args, conversation["model"], messages, session, stats)
+            if record["error"] is not None:
+                break
+            reply = record["text"] if args.history == "model" else conversation["references"][i]
+            messages.append({"role": "assistant", "content": reply})
+            if args.think_time > 0 and i < len(conversation["turns"]) - 1:
+                await asyncio.sleep(rng.expovariate(1 / args.think_time))
+    finally:
+        stats.active_users -= 1
+
+
+async def run_load(args, conversations: List[Dict[str, Any]]) -> Dict[str, Any]:
+    import httpx
+
+    rng = random.Random(args.seed)
+    stats = LoadStats()
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    async with httpx.AsyncClient(base_url=args.url.rstrip("/"), limits=limits, headers=headers,
+                                 timeout=httpx.Timeout(args.timeout, connect=10.0)) as client:
+        started = time.perf_counter()
+        tasks = []
+        # 泊松到达：到达间隔服从指数分布
+        while time.perf_counter() - started < args.duration and (not args.users or len(tasks) < args.users):
+            conversation = conversations[len(tasks) % len(conversations)] if args.ordered else rng.choice(conversations)
+            tasks.append(asyncio.create_task(run_user(client, args, conversation, stats, rng)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+        return stats.report(time.perf_counter() - started)
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"[Load] 用户 {report['users']} | 请求 {report['requests']} | 完成 {report['completed']} | "
+          f"错误率 {report['error_rate']:.2%} {report['errors'] or ''}")
+    print(f"[Load] 峰值并发 用户 {report['peak_users']} / 请求 {report['peak_requests']} | "
+          f"{report['requests_per_second']} req/s | {report['tokens_per_second']} tok/s | 用时 {report['wall_seconds']}s")
+    for key, label in (("ttft_ms", "TTFT (ms)"), ("itl_ms", "ITL (ms)"), ("latency_s", "延迟 (s)"),
+                       ("decode_tokens_per_second", "解码 tok/s")):
+        print(f"    {label:<12}" + "  ".join(f"{q}={v}" for q, v in report[key].items()))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """最小的 OpenAI 兼容接口 (/v1/models、/v1/chat/completions)，回复由 StubBackend 生成"""
+
+    backend = None
+    model_name = "stub"
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data: Any, status: int = 200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            return self.send_error(404)
+        self._send_json({"object": "list", "data": [{"id": self.model_name, "object": "model", "owned_by": "owner"}]})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            return self.send_error(404)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if random.random() < self.error_rate:
+            return self._send_json({"detail": "injected error"}, status=503)
+        messages = body.get("messages", [])
+        chunks = self.backend.stream_chat(messages, max_new_tokens=body.get("max_tokens"))
+        created, model = int(time.time()), body.get("model") or self.model_name
+        if not body.get("stream"):
+            text = "".join(chunks)
+            return self._send_json({"id": uuid.uuid4().hex, "object": "chat.completion", "created": created, "model": model,
+                                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                                 "finish_reason": "stop"}]})
+        # HTTP/1.0 下以关闭连接结束响应，不需要分块编码
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def event(delta, finish_reason=None):
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for text in chunks:
+                event({"content": text})
+            event({}, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            chunks.close()
+
+
+def serve_stub(args):
+    from backends import StubBackend
+
+    StubHandler.backend = StubBackend(tokens_per_second=args.tokens_per_second, prefill_tokens_per_second=args.prefill_tps,
+                                      reply_tokens=args.reply_tokens, slots=args.slots).load()
+    StubHandler.error_rate = args.error_rate
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"[Stub] http://{args.host}:{args.port} | {args.tokens_per_second} tok/s | 并发生成 {args.slots} | "
+          f"注入错误率 {args.error_rate}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多轮角色扮演压测")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="对 OpenAI 兼容接口回放多轮对话")
+    p_run.add_argument("--url", default="http://127.0.0.1:8000", help="API 地址")
+    p_run.add_argument("--api-key", help="后端设置了 API_KEY 时使用")
+    p_run.add_argument("--data", default=DEFAULT_DATA, help="对话 JSONL (Alpaca / OpenAI messages / ShareGPT)")
+    p_run.add_argument("--rate", type=float, default=0.5, help="用户到达率 (人/秒，泊松过程)")
+    p_run.add_argument("--duration", type=float, default=60, help="持续发起新用户的时间 (秒)，之后等待在途用户结束")
+    p_run.add_argument("--users", type=int, help="最多发起的用户数")
+    p_run.add_argument("--max-turns", type=int, default=8, help="每段对话最多的轮数")
+    p_run.add_argument("--think-time", type=float, default=2.0, help="两轮之间的平均停顿 (秒，指数分布，0 = 不停顿)")
+    p_run.add_argument("--history", choices=["model", "dataset"], default="model",
+                       help="下一轮历史中的回复：model = 本次真实回复，dataset = 数据集中的参考回复")
+    p_run.add_argument("--model", default="default", help="对话没有角色名时使用的 model 字段")
+    p_run.add_argument("--max-tokens", type=int, default=256)
+    p_run.add_argument("--temperature", type=float, default=0.95)
+    p_run.add_argument("--timeout", type=float, default=300, help="两次读取之间的超时 (秒)")
+    p_run.add_argument("--max-connections", type=int, default=256)
+    p_run.add_argument("--ordered", action="store_true", help="按顺序而不是随机选择对话")
+    p_run.add_argument("--seed", type=int, default=0)
+    p_run.add_argument("--output", help="把报告写入 JSON 文件")
+
+    p_stub = sub.add_parser("stub", help="启动不加载模型的 OpenAI 兼容桩服务 (CPU)")
+    p_stub.add_argument("--host", default="127.0.0.1")
+    p_stub.add_argument("--port", type=int, default=8001)
+    p_stub.add_argument("--tokens-per-second", type=float, default=30.0, help="每个请求的解码速度")
+    p_stub.add_argument("--prefill-tps", type=float, default=2000.0, help="预填充速度 (字符/秒)")
+    p_stub.add_argument("--reply-tokens", type=int, help="每条回复的 Token 数 (默认为一条完整回复的长度)")
+    p_stub.add_argument("--slots", type=int, default=1, help="可同时生成的请求数，其余排队")
+    p_stub.add_argument("--error-rate", type=float, default=0.0, help="随机返回 503 的比例 (验证错误统计)")
+    args = parser.parse_args()
+
+    if args.command == "stub":
+        serve_stub(args)
+        return
+
+    conversations = load_conversations(args.data, args.max_turns)
+    turns = sum(len(c["turns"]) for c in conversations)
+    print(f"[Info] {args.url} | 对话 {len(conversations)} 段 (平均 {turns / max(len(conversations), 1):.1f} 轮) | "
+          f"到达率 {args.rate}/s | 持续 {args.duration}s", flush=True)
+    report = asyncio.run(run_load(args, conversations))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[Info] 报告已写入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+流式输出解析 (Output Parser)
+功能：按训练数据的输出格式 (convert_to_lora.construct_output)
+    <think>内心独白</think> *动作* 台词 <mood:情绪>
+在 Token 到达时把回复切分为 think / action / speech / mood 四类片段。
+1. OutputParser: 增量解析，标签被 Token 切开时暂存不完整的部分；raw=True 时片段保留原始标记，拼接后与原文一致；
+2. ThinkBudget: 思考段的 Token 预算，超出后强制下一个 Token 为 </think>，让台词尽早出现；
+   自有解码循环 (batching / session_cache) 逐 Token 调用，LLaMA-Factory 的 generate 通过 logits processor 生效；
+3. SegmentedChatModel: ChatModel 代理，可隐藏思考内容，或以结构化片段返回 (API 的 /v1/chat/segments)。
+"""
+
+import json
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+MOOD_OPEN, MOOD_CLOSE = "<mood:", ">"
+ACTION_MARK = "*"
+SEGMENT_TYPES = ("think", "action", "speech", "mood")
+
+THINK_HEADER = b"x-think"  # hide / show
+THINK_BUDGET_HEADER = b"x-think-budget"
+THINK_PLACEHOLDER = "（思考中……）"
+
+# 当前请求的输出选项 (OutputOptionsMiddleware 写入)：{"hide_think": bool, "think_budget": int}
+current_output = ContextVar("current_output", default=None)
+
+
+def _holdback(text: str, tags: Tuple[str, ...]) -> int:
+    """text 末尾可能是某个标签开头的最长长度 (这部分等下一个分段再判断)"""
+    longest = 0
+    for tag in tags:
+        for size in range(min(len(tag) - 1, len(text)), longest, -1):
+            if text.endswith(tag[:size]):
+                longest = size
+                break
+    return longest
+
+
+class OutputParser:
+    """
+    增量解析器：feed() 返回新增的片段事件 [{"type": 类型, "index": 片段序号, "delta": 文本}]，close() 输出暂存的剩余部分。
+    结构化模式 (raw=False) 去掉标记与片段首尾的空白；segments 保存合并后的完整片段。
+    """
+
+    def __init__(self, raw: bool = False):
+        self.raw = raw
+        self.state = "start"
+        self.buffer = ""
+        self.segments: List[Dict[str, str]] = []
+        self._open = False   # 当前片段是否已经输出过内容
+        self._spaces = ""    # 结构化模式下暂存的片段尾部空白
+
+    def _switch(self, state: str):
+        self.state = state
+        self._open = False
+        self._spaces = ""
+
+    def _out(self, events: List[Dict[str, str]], kind: str, text: str):
+        if not text:
+            return
+        if not self.raw:
+            if not self._open:
+                text = text.lstrip()
+            core = text.rstrip()
+            text, self._spaces = (self._spaces + core, text[len(core):]) if core else ("", self._spaces + text)
+            if not text:
+                return
+        if not self._open:
+            self.segments.append({"type": kind, "text": ""})
+            self._open = True
+        self.segments[-1]["text"] += text
+        index = len(self.segments) - 1
+        if events and events[-1]["index"] == index:
+            events[-1]["delta"] += text
+        else:
+            events.append({"type": kind, "index": index, "delta": text})
+
+    def _until(self, events, kind: str, tag: str, next_state: str, hold: bool = True) -> bool:
+        """输出到 tag 为止并切换状态；没有遇到 tag 时输出可确定的部分，返回 False 等待更多文本"""
+        index = self.buffer.find(tag)
+        if index < 0:
+            keep = _holdback(self.buffer, (tag,)) if hold else 0
+            self._out(events, kind, self.buffer[:len(self.buffer) - keep])
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            return False
+        self._out(events, kind, self.buffer[:index] + (tag if self.raw else ""))
+        self.buffer = self.buffer[index + len(tag):]
+        self._switch(next_state)
+        return True
+
+    def _step(self, events) -> bool:
+        if self.state == "start":
+            stripped = self.buffer.lstrip()
+            if stripped.startswith(THINK_OPEN):
+                self._switch("think")
+                self._out(events, "think", self.buffer[:len(self.buffer) - len(stripped) + len(THINK_OPEN)] if self.raw else "")
+                self.buffer = stripped[len(THINK_OPEN):]
+                return True
+            if THINK_OPEN.startswith(stripped):
+                return False
+            self._switch("speech")
+            return True
+        if self.state == "think":
+            return self._until(events, "think", THINK_CLOSE, "speech")
+        if self.state == "action":
+            return self._until(events, "action", ACTION_MARK, "speech", hold=False)
+        if self.state == "mood":
+            # 情绪标签完整后一次性输出
+            index = self.buffer.find(MOOD_CLOSE)
+            if index < 0:
+                return False
+            self._out(events, "mood", (MOOD_OPEN if self.raw else "") + self.buffer[:index] + (MOOD_CLOSE if self.raw else ""))
+            self.buffer = self.buffer[index + len(MOOD_CLOSE):]
+            self._switch("speech")
+            return True
+
+        action, mood = self.buffer.find(ACTION_MARK), self.buffer.find(MOOD_OPEN)
+        if action < 0 and mood < 0:
+            keep = _holdback(self.buffer, (MOOD_OPEN,))
+            self._out(events, "speech", self.buffer[:len(self.buffer) - keep])
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            return False
+        if action >= 0 and (mood < 0 or action < mood):
+            self._out(events, "speech", self.buffer[:action])
+            self.buffer = self.buffer[action + 1:]
+            self._switch("action")
+            self._out(events, "action", ACTION_MARK if self.raw else "")
+        else:
+            self._out(events, "speech", self.buffer[:mood])
+            self.buffer = self.buffer[mood + len(MOOD_OPEN):]
+            self._switch("mood")
+        return True
+
+    def feed(self, chunk: str) -> List[Dict[str, str]]:
+        events: List[Dict[str, str]] = []
+        self.buffer += chunk
+        while self.buffer and self._step(events):
+            pass
+        return events
+
+    def close(self) -> List[Dict[str, str]]:
+        """生成结束：暂存的文本按当前状态输出 (未闭合的情绪标签按原文作为台词)"""
+        events: List[Dict[str, str]] = []
+        if self.buffer:
+            if self.state == "mood":
+                kind, text = "speech", MOOD_OPEN + self.buffer
+            else:
+                kind, text = ("speech" if self.state == "start" else self.state), self.buffer
+            self._out(events, kind, text)
+            self.buffer = ""
+        return events
+
+    def summary(self) -> Dict[str, Any]:
+        """按类型汇总：think / action / speech 为拼接后的文本，mood 为最后一个情绪标签"""
+        joined = {kind: " ".join(s["text"] for s in self.segments if s["type"] == kind) for kind in SEGMENT_TYPES}
+        joined["mood"] = next((s["text"] for s in reversed(self.segments) if s["type"] == "mood"), None)
+        return dict(joined, segments=self.segments)
+
+
+def parse_output(text: str) -> Dict[str, Any]:
+    """一次性解析完整回复"""
+    parser = OutputParser()
+    parser.feed(text)
+    parser.close()
+    return parser.summary()
+
+
+def think_token_ids(tokenizer: Any) -> Optional[Tuple[int, int]]:
+    """<think> / </think> 均为单个 Token 时返回其 id (Qwen3 等)，否则无法按 Token 强制闭合"""
+    ids = []
+    for tag in (THINK_OPEN, THINK_CLOSE):
+        token_id = tokenizer.convert_tokens_to_ids(tag)
+        if token_id is None or token_id == tokenizer.unk_token_id:
+            return None
+        ids.append(token_id)
+    return ids[0], ids[1]
+
+
+class ThinkBudget:
+    """单行的思考段计数：位于 <think> 之后、</think> 之前的 Token 数达到预算后 steer() 返回 </think>"""
+
+    def __init__(self, open_id: int, close_id: int, budget: int, prompt_ids=()):
+        self.open_id, self.close_id, self.budget = open_id, close_id, budget
+        self.count: Optional[int] = None  # None 表示不在思考段内
+        self.forced = False
+        # 提示词末尾可能已经预填了 <think>
+        for token in reversed(list(prompt_ids)):
+            if token == close_id:
+                break
+            if token == open_id:
+                self.count = 0
+                break
+
+    @property
+    def exhausted(self) -> bool:
+        return self.count is not None and self.count >= self.budget
+
+    def update(self, token: int):
+        if token == self.open_id:
+            self.count = 0
+        elif token == self.close_id:
+            self.count = None
+        elif self.count is not None:
+            self.count += 1
+
+    def steer(self, token: int) -> int:
+        if self.exhausted:
+            token, self.forced = self.close_id, True
+        self.update(token)
+        return token
+
+
+class ThinkBudgetProcessor:
+    """transformers LogitsProcessor：预算用尽的行只保留 </think>"""
+
+    def __init__(self, open_id: int, close_id: int, budget: int):
+        self.open_id, self.close_id, self.budget = open_id, close_id, budget
+        self.rows: Optional[List[ThinkBudget]] = None
+
+    def __call__(self, input_ids, scores):
+        if self.rows is None:
+            self.rows = [ThinkBudget(self.open_id, self.close_id, self.budget, row.tolist()) for row in input_ids]
+        else:
+            for tracker, token in zip(self.rows, input_ids[:, -1].tolist()):
+                tracker.update(token)
+        for i, tracker in enumerate(self.rows):
+            if tracker.exhausted:
+                scores[i, :] = float("-inf")
+                scores[i, self.close_id] = 0.0
+        return scores
+
+
+# LLaMA-Factory 的 generate 路径：预算按请求放在上下文变量中，补丁后的 get_logits_processor 在
+# _process_args (调用方任务的上下文，或 asyncio.to_thread 复制的上下文) 中读取，并发生成互不影响
+_active_budget: ContextVar[Optional[Tuple[int, int, int]]] = ContextVar("think_budget", default=None)
+_patch_lock = threading.Lock()
+_patched: Optional[bool] = None
+
+
+def _patch_hf_engine() -> bool:
+    global _patched
+    with _patch_lock:
+        if _patched is None:
+            try:
+                from llamafactory.chat import hf_engine
+                original = hf_engine.get_logits_processor
+            except (ImportError, AttributeError) as e:
+                print(f"[Think] 当前 LLaMA-Factory 版本不支持注入 logits processor，思考预算仅在批处理 / 会话路径生效: {e}", flush=True)
+                _patched = False
+                return _patched
+
+            def get_logits_processor():
+                processors = original()
+                budget = _active_budget.get()
+                if budget is not None:
+                    processors.append(ThinkBudgetProcessor(*budget))
+                return processors
+
+            hf_engine.get_logits_processor = get_logits_processor
+            _patched = True
+    return _patched
+
+
+@contextmanager
+def think_limit(tokenizer: Any, budget: Optional[int]):
+    """在当前请求的生成期间启用思考预算 (budget 为 0 / None 时不做任何事)"""
+    ids = think_token_ids(tokenizer) if budget and budget > 0 else None
+    if ids is None or not _patch_hf_engine():
+        yield
+        return
+    token = _active_budget.set((ids[0], ids[1], budget))
+    try:
+        yield
+    finally:
+        try:
+            _active_budget.reset(token)
+        except ValueError:
+            # 流式生成器在其他上下文中被关闭 (例如垃圾回收时 aclose)
+            _active_budget.set(None)
+
+
+class SegmentedChatModel:
+    """
+    ChatModel 的代理 (最外层)：按请求选项 (current_output 或关键字参数) 设置思考预算、隐藏思考内容；
+    astream_segments / asegments 返回结构化片段。缓存等内层保存的仍是原始回复。
+    """
+
+    def __init__(self, chat_model: Any, hide_think: bool = False, think_budget: int = 0):
+        self.chat_model = chat_model
+        self.hide_think = hide_think
+        self.think_budget = think_budget
+
+    @property
+    def engine(self):
+        return self.chat_model.engine
+
+    def __getattr__(self, name):
+        return getattr(self.chat_model, name)
+
+    def _options(self, hide_think: Optional[bool], think_budget: Optional[int]) -> Tuple[bool, int]:
+        options = current_output.get() or {}
+        if hide_think is None:
+            hide_think = options.get("hide_think", self.hide_think)
+        if think_budget is None:
+            think_budget = options.get("think_budget", self.think_budget)
+        return bool(hide_think), int(think_budget or 0)
+
+    async def astream_segments(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                               think_budget: Optional[int] = None, **kwargs):
+        """逐个产出片段事件 {"type", "index", "delta"}"""
+        _, budget = self._options(None, think_budget)
+        parser = OutputParser()
+        async for new_text in self.chat_model.astream_chat(messages, system, tools, images, videos, audios,
+                                                           think_budget=budget, **kwargs):
+            for event in parser.feed(new_text):
+                yield event
+        for event in parser.close():
+            yield event
+
+    async def asegments(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                        think_budget: Optional[int] = None, **kwargs) -> Dict[str, Any]:
+        parser = OutputParser()
+        _, budget = self._options(None, think_budget)
+        async for new_text in self.chat_model.astream_chat(messages, system, tools, images, videos, audios,
+                                                           think_budget=budget, **kwargs):
+            parser.feed(new_text)
+        parser.close()
+        return parser.summary()
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                           hide_think: Optional[bool] = None, think_budget: Optional[int] = None, **kwargs):
+        hide, budget = self._options(hide_think, think_budget)
+        stream = self.chat_model.astream_chat(messages, system, tools, images, videos, audios,
+                                              think_budget=budget, **kwargs)
+        if not hide:
+            async for new_text in stream:
+                yield new_text
+            return
+        parser, started = OutputParser(raw=True), False
+        async for new_text in stream:
+            visible = "".join(e["delta"] for e in parser.feed(new_text) if e["type"] != "think")
+            if not started:
+                visible = visible.lstrip()
+                started = bool(visible)
+            if visible:
+                yield visible
+        tail = "".join(e["delta"] for e in parser.close() if e["type"] != "think")
+        if not started:
+            tail = tail.lstrip()
+        if tail:
+            yield tail
+
+    async def achat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                    hide_think: Optional[bool] = None, think_budget: Optional[int] = None, **kwargs):
+        hide, budget = self._options(hide_think, think_budget)
+        responses = await self.chat_model.achat(messages, system, tools, images, videos, audios,
+                                                think_budget=budget, **kwargs)
+        if hide:
+            for response in responses:
+                parser = OutputParser(raw=True)
+                events = parser.feed(response.response_text) + parser.close()
+                response.response_text = "".join(e["delta"] for e in events if e["type"] != "think").lstrip()
+        return responses
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs):
+        import asyncio
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self.chat_model._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        import asyncio
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self.chat_model._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+    def stream_segments(self, messages, system=None, tools=None, *args, **kwargs):
+        """同步版 astream_segments (Gradio 使用)"""
+        import asyncio
+        generator = self.astream_segments(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self.chat_model._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+
+class OutputOptionsMiddleware:
+    """ASGI 中间件：请求头 X-Think (hide / show) 与 X-Think-Budget 写入 current_output"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        options = {}
+        if THINK_HEADER in headers:
+            options["hide_think"] = headers[THINK_HEADER].decode("latin-1").strip().lower() == "hide"
+        if THINK_BUDGET_HEADER in headers:
+            try:
+                options["think_budget"] = int(headers[THINK_BUDGET_HEADER])
+            except ValueError:
+                pass
+        token = current_output.set(options or None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_output.reset(token)
+
+
+def install_segment_routes(app, chat_model: SegmentedChatModel):
+    """
+    POST /v1/chat/segments：请求体与 /v1/chat/completions 相同 (另可带 think_budget / hide_think)，
+    返回 {"think", "action", "speech", "mood", "segments"}；stream=true 时以 SSE 逐个发送片段事件。
+    """
+    from fastapi import Request
+    from fastapi.responses import StreamingResponse
+
+    @app.post("/v1/chat/segments")
+    async def chat_segments(request: Request):
+        body = await request.json()
+        messages = [{"role": m["role"], "content": m["content"]} for m in body.get("messages", [])]
+        system = None
+        if messages and messages[0]["role"] == "system":
+            system = messages.pop(0)["content"]
+        kwargs = {k: body[k] for k in ("temperature", "top_p", "stop") if body.get(k) is not None}
+        if body.get("max_tokens") is not None:
+            kwargs["max_new_tokens"] = body["max_tokens"]
+        if body.get("think_budget") is not None:
+            kwargs["think_budget"] = body["think_budget"]
+        hide, _ = chat_model._options(body.get("hide_think"), None)
+
+        if not body.get("stream"):
+            result = await chat_model.asegments(messages, system, **kwargs)
+            if hide:
+                result["think"] = ""
+                result["segments"] = [s for s in result["segments"] if s["type"] != "think"]
+            return dict(result, model=body.get("model"))
+
+        async def events():
+            async for event in chat_model.astream_segments(messages, system, **kwargs):
+                if hide and event["type"] == "think":
+                    continue
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
@@ -3,7 +3,15 @@ import os
 import yaml
 import gradio as gr
 import html
-from llamafactory.chat import ChatModel
+import asyncio
+from output_parser import THINK_PLACEHOLDER
+from backends import add_backend_args
+
+DEFAULT_CHARACTER = "叶灵静"
+PRESET_PROMPTS = ["请自我介绍一下", "到我被窝里来，我们做涩涩的事"]
+
+def system_prompt(character):
+    return f"你现在是{character}。"
 
 def load_config(config_path):
     if os.path.exists(config_path):
@@ -11,19 +19,15 @@ def load_config(config_path):
             return yaml.safe_load(f)
     return {}
 
-def main():
-    parser = argparse.ArgumentParser(description="HentAI Public Share Chat Service")
-    parser.add_argument("--model_name_or_path", type=str, help="Base model path")
-    parser.add_argument("--adapter_name_or_path", type=str, help="LoRA adapter path")
-    parser.add_argument("--template", type=str, default="qwen3", help="Chat template")
-    parser.add_argument("--username", type=str, default="admin", help="Gradio auth username")
-    parser.add_argument("--password", type=str, default="hentai123", help="Gradio auth password")
-    parser.add_argument("--port", type=int, default=7860, help="Gradio port")
-    
-    args = parser.parse_args()
+def load_local_model(args, config):
+    """在界面进程中加载模型，返回 (chat_model, 角色列表)"""
+    from backends import create_backend
+    from adapter_pool import AdapterPool, MultiAdapterChatModel, parse_adapters
+    from session_cache import SessionStore, SessionGenerator, SessionChatModel
+    from history_window import HistoryWindow, WindowedChatModel, token_counter
+    from response_cache import ResponseCache, CachedChatModel, load_prewarm
+    from output_parser import SegmentedChatModel
 
-    config = load_config("configs/hentai_webui_config.yaml")
-    
     model_path = args.model_name_or_path or "/root/local-nvme/train_env/models/Qwen3-14B-abliterated"
     adapter_path = args.adapter_name_or_path
     if not adapter_path:
@@ -31,20 +35,97 @@ def main():
         if adapter_path and not os.path.exists(os.path.join(adapter_path, "adapter_config.json")):
             adapter_path = None
 
-    print(f"--- Loading Model ---")
+    adapters = parse_adapters(args.adapter)
+    if not adapters and adapter_path:
+        adapters = {DEFAULT_CHARACTER: adapter_path}
+
+    print(f"--- Loading Model ({args.backend}) ---")
     print(f"Base Model: {model_path}")
-    print(f"Adapter: {adapter_path}")
+    print(f"Adapters: {', '.join(f'{k}={v}' for k, v in adapters.items()) or '(none)'}")
 
-    chat_model = ChatModel(dict(
-        model_name_or_path=model_path,
-        adapter_name_or_path=adapter_path,
+    # 基座只加载一次，角色适配器按需挂载
+    base_model = create_backend(
+        args, model_path,
         template=args.template or config.get("top.template", "qwen3"),
         finetuning_type=config.get("top.finetuning_type", "lora"),
         quantization_bit=int(config.get("top.quantization_bit", 4)),
-    ))
+    ).load()
+    pool = AdapterPool(base_model.engine, adapters, max_loaded=args.max_loaded_adapters)
+    chat_model = MultiAdapterChatModel(base_model, pool)
+    if args.session_cache_mb > 0 and getattr(base_model.engine, "model", None) is not None:
+        # 每个浏览器会话保留上一轮的 KV Cache，新一轮只编码新消息
+        chat_model = SessionChatModel(chat_model, SessionGenerator(base_model.engine, SessionStore(args.session_cache_mb * 1024 ** 2)), pool)
+    if args.history_budget > 0:
+        # 超出预算的旧对话在后台概括为前情提要，提示词长度不再随轮数增长
+        window = HistoryWindow(token_counter(base_model.engine.tokenizer), budget=args.history_budget)
+        chat_model = WindowedChatModel(chat_model, window, forward_session=args.session_cache_mb > 0)
+    characters = pool.names or [DEFAULT_CHARACTER]
+    if args.response_cache > 0:
+        # 预设按钮与常见开场白直接回放缓存；预热在模型的事件循环上后台进行，不阻塞界面启动
+        template = args.template or config.get("top.template", "qwen3")
+        chat_model = CachedChatModel(chat_model, ResponseCache(args.response_cache), namespace=f"{model_path}|{template}", pool=pool)
+        # 预设按钮使用默认采样参数 (高温度)，预热后在 TTL 内所有用户都会拿到同一条回复，因此需显式开启
+        prewarm = [{"messages": [{"role": "user", "content": f"{system_prompt(c)}\n\n{p}"}], "adapter": c}
+                   for c in characters for p in PRESET_PROMPTS] if args.prewarm_presets else []
+        if args.cache_prewarm:
+            prewarm += load_prewarm(args.cache_prewarm)
+        if prewarm:
+            asyncio.run_coroutine_threadsafe(chat_model.prewarm(prewarm, think_budget=args.think_budget), base_model._loop)
+    return SegmentedChatModel(chat_model, hide_think=args.hide_think, think_budget=args.think_budget), characters
+
+def connect_backend(args):
+    """作为 api_backend 的客户端运行，返回 (chat_model, 角色列表)"""
+    from adapter_pool import BASE_ADAPTER
+    from backend_client import BackendChatModel
 
-    def bot_msg(history):
-        SYSTEM_PROMPT = "你现在是叶灵静。"
+    print(f"--- Connecting to Backend ---")
+    print(f"Backend: {args.backend_url}")
+    chat_model = BackendChatModel(args.backend_url, api_key=args.backend_api_key, max_connections=args.backend_connections,
+                                  hide_think=args.hide_think, think_budget=args.think_budget)
+    if args.backend_wait > 0 and not chat_model.wait_ready(args.backend_wait):
+        print(f"[Warning] 后端在 {args.backend_wait}s 内未就绪，继续启动界面 (请求会返回 503 直到后端就绪)")
+    try:
+        characters = [name for name in chat_model.list_models() if name != BASE_ADAPTER]
+    except Exception as e:
+        print(f"[Warning] 无法获取后端的角色列表: {e}")
+        characters = []
+    return chat_model, characters or [DEFAULT_CHARACTER]
+
+def main():
+    parser = argparse.ArgumentParser(description="HentAI Public Share Chat Service")
+    parser.add_argument("--model_name_or_path", type=str, help="Base model path")
+    parser.add_argument("--adapter_name_or_path", type=str, help="LoRA adapter path")
+    parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH",
+                        help="Register a character LoRA adapter (repeatable), e.g. 叶灵静=/path/to/lora")
+    parser.add_argument("--max_loaded_adapters", type=int, default=2, help="Adapters kept in memory at once (LRU)")
+    parser.add_argument("--session_cache_mb", type=int, default=2048, help="KV cache kept per browser session (0 = off)")
+    parser.add_argument("--history_budget", type=int, default=3072, help="Token budget for persona + history; older turns are summarized (0 = send full history)")
+    parser.add_argument("--response_cache", type=int, default=1024, help="Cached replies for deterministic / low-temperature requests (0 = off)")
+    parser.add_argument("--prewarm_presets", action="store_true",
+                        help="Pre-warm the preset buttons per character (every user then gets the same reply until the entry expires)")
+    parser.add_argument("--cache_prewarm", type=str, help="Extra prompt list (text or JSONL) generated into the cache at startup")
+    parser.add_argument("--think_budget", type=int, default=0, help="Max tokens inside <think> before it is closed so speech starts sooner (0 = unlimited)")
+    parser.add_argument("--hide_think", action="store_true", help="Hide the inner monologue; a placeholder is shown while the model thinks")
+    parser.add_argument("--backend_url", type=str, help="Use a running api_backend (e.g. http://gpu-host:8000) instead of loading the model here")
+    parser.add_argument("--backend_api_key", type=str, default=os.getenv("API_KEY"), help="API key of the backend (default: $API_KEY)")
+    parser.add_argument("--backend_connections", type=int, default=32, help="Pooled HTTP connections to the backend")
+    parser.add_argument("--backend_wait", type=float, default=600, help="Seconds to wait for the backend's /readyz before starting the UI (0 = do not wait)")
+    parser.add_argument("--template", type=str, default="qwen3", help="Chat template")
+    add_backend_args(parser)
+    parser.add_argument("--username", type=str, default="admin", help="Gradio auth username")
+    parser.add_argument("--password", type=str, default="hentai123", help="Gradio auth password")
+    parser.add_argument("--port", type=int, default=7860, help="Gradio port")
+    
+    args = parser.parse_args()
+
+    config = load_config("configs/hentai_webui_config.yaml")
+    if args.backend_url:
+        chat_model, characters = connect_backend(args)
+    else:
+        chat_model, characters = load_local_model(args, config)
+
+    def bot_msg(history, character, request: gr.Request):
+        SYSTEM_PROMPT = system_prompt(character)
         
         messages = []
         is_first = True
@@ -55,7 +136,8 @@ def main():
                 is_first = False
             messages.append({"role": "user", "content": content})
             if ai:
-                messages.append({"role": "assistant", "content": ai})
+                # 界面中的回复经过 HTML 转义，还原后再交给模型
+                messages.append({"role": "assistant", "content": html.unescape(ai)})
         
         last_user_msg = history[-1][0]
         if is_first:
@@ -67,7 +149,19 @@ def main():
 
         history[-1][1] = ""
         try:
-            for new_text in chat_model.stream_chat(messages):
+            session = {}
+            if args.session_cache_mb > 0 or args.history_budget > 0:
+                session["session_id"] = request.session_hash
+            if args.history_budget > 0:
+                session["persona"] = SYSTEM_PROMPT
+            thinking = args.hide_think
+            if thinking:
+                # 隐藏内心独白时，台词出现之前先显示占位提示
+                history[-1][1] = THINK_PLACEHOLDER
+                yield history
+            for new_text in chat_model.stream_chat(messages, adapter=character, **session):
+                if thinking:
+                    history[-1][1], thinking = "", False
                 # 关键修复：强制对 HTML 敏感字符进行转义，防止标签导致的前端显示消失
                 escaped_text = html.escape(new_text)
                 history[-1][1] += escaped_text
@@ -84,7 +178,8 @@ def main():
         return history + [[text, None]], ""
 
     with gr.Blocks(title="HentAI Chat (Fixed)") as demo:
-        gr.Markdown("# HentAI 体验对话框 - 叶灵静")
+        gr.Markdown("# HentAI 体验对话框")
+        character = gr.Dropdown(choices=characters, value=characters[0], label="角色")
         chatbot = gr.Chatbot(label="对话窗口 (支持特殊标签显示)", height=500)
         
         with gr.Row():
@@ -92,16 +187,16 @@ def main():
             submit_btn = gr.Button("发送", scale=1)
 
         with gr.Row():
-            btn1 = gr.Button("请自我介绍一下")
-            btn2 = gr.Button("到我被窝里来，我们做涩涩的事")
+            buttons = [gr.Button(p) for p in PRESET_PROMPTS]
             clear = gr.Button("清空记录")
 
-        msg.submit(add_text, [chatbot, msg], [chatbot, msg]).then(bot_msg, chatbot, chatbot)
-        submit_btn.click(add_text, [chatbot, msg], [chatbot, msg]).then(bot_msg, chatbot, chatbot)
+        msg.submit(add_text, [chatbot, msg], [chatbot, msg]).then(bot_msg, [chatbot, character], chatbot)
+        submit_btn.click(add_text, [chatbot, msg], [chatbot, msg]).then(bot_msg, [chatbot, character], chatbot)
         
-        btn1.click(lambda h: h + [["请自我介绍一下", None]], chatbot, chatbot).then(bot_msg, chatbot, chatbot)
-        btn2.click(lambda h: h + [["到我被窝里来，我们做涩涩的事", None]], chatbot, chatbot).then(bot_msg, chatbot, chatbot)
+        for button, preset in zip(buttons, PRESET_PROMPTS):
+            button.click(lambda h, p=preset: (h or []) + [[p, None]], chatbot, chatbot).then(bot_msg, [chatbot, character], chatbot)
         clear.click(lambda: None, None, chatbot)
+        character.change(lambda: None, None, chatbot)
 
     print(f"--- Launching Service (v2) ---")
     demo.queue().launch(
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+回复缓存 (Response Cache)
+功能：相同请求直接回放已生成的回复，避免重复的 14B 生成 (预设按钮、大量用户相同的开场白)。
+1. 缓存键 = 命名空间 (基座模型 + 模板) + 适配器 + 采样参数 + 规范化后的消息列表 (Unicode NFKC、统一换行、压缩空白)；
+2. 只有确定性或低温度 (temperature <= max_temperature) 的请求写入缓存；预热的提示词不受此限制 (视为固定回复)；
+3. LRU + TTL 淘汰，预热条目不参与 LRU 淘汰，但同样按 TTL 过期；命中时按原来的分段流式回放；
+4. 相同请求并发到达时只生成一次，其余请求跟随同一生成流 (coalesced)；
+5. 统计命中率、写入、淘汰等，API 服务在 /v1/cache 暴露；支持启动时从提示词列表预热。
+"""
+
+import re
+import json
+import time
+import asyncio
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any
+
+from adapter_pool import current_adapter
+from backends import Response
+from batching import BatchGenerator, resolve_params
+
+_SPACES = re.compile(r"[ \t　]+")
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(_SPACES.sub(" ", line).strip() for line in text.strip().split("\n"))
+
+
+def normalize_messages(messages: List[Dict[str, str]]) -> List[List[str]]:
+    return [[m.get("role", ""), normalize_text(m.get("content", ""))] for m in messages]
+
+
+def load_prewarm(path: str) -> List[Dict[str, Any]]:
+    """
+    预热列表：每行一条。纯文本行视为单条用户消息；JSON 行可写 {"messages": [...], "adapter": "...", "system": "..."}
+    或 {"prompt": "..."}。
+    """
+    items = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                if "prompt" in item:
+                    item["messages"] = [{"role": "user", "content": item.pop("prompt")}]
+                items.append(item)
+            else:
+                items.append({"messages": [{"role": "user", "content": line}]})
+    return items
+
+
+class _Flight:
+    """正在生成的缓存未命中请求：其他相同请求跟随读取 chunks，结束后 response 为完整回复 (含结束原因与 Token 数)"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.response: Optional[Response] = None
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+
+    def push(self, chunk: str):
+        self.chunks.append(chunk)
+        self.changed.set()
+
+    def close(self, error: Optional[BaseException] = None):
+        self.done, self.error = True, error
+        self.changed.set()
+
+    async def follow(self):
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            self.changed.clear()
+            if index < len(self.chunks) or self.done:
+                continue
+            await self.changed.wait()
+
+
+class ResponseCache:
+    """LRU + TTL 的回复缓存；条目为 {"chunks", "tokens", "prompt_length", "finish_reason", "expires", "pinned"}"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, max_temperature: float = 0.3):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.flights: Dict[str, _Flight] = {}
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "bypassed": 0, "stores": 0,
+                         "evictions": 0, "expirations": 0, "prewarmed": 0}
+
+    @staticmethod
+    def make_key(namespace: str, adapter: Optional[str], params: Dict[str, Any], messages, system=None, tools=None,
+                 stop=None) -> str:
+        payload = [namespace, adapter, sorted(params.items()), normalize_text(system or ""), tools or "",
+                   stop or [], normalize_messages(messages)]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+    def cacheable(self, params: Dict[str, Any]) -> bool:
+        return not params.get("do_sample", True) or params.get("temperature", 1.0) <= self.max_temperature
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] is not None and entry["expires"] < time.time():
+            del self.entries[key]
+            self.counters["expirations"] += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, chunks: List[str], tokens: int = 0, prompt_length: int = 0,
+            finish_reason: str = "stop", pinned: bool = False):
+        if finish_reason != "stop":
+            return  # 被截断的回复不缓存
+        self.entries[key] = {
+            "chunks": list(chunks),
+            "tokens": tokens,
+            "prompt_length": prompt_length,
+            "finish_reason": finish_reason,
+            "expires": time.time() + self.ttl,
+            "pinned": pinned,
+        }
+        self.entries.move_to_end(key)
+        self.counters["stores"] += 1
+        while len(self.entries) > self.max_entries:
+            victim = next((k for k, e in self.entries.items() if not e["pinned"]), None)
+            if victim is None:
+                break
+            del self.entries[victim]
+            self.counters["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"] + self.counters["coalesced"]
+        return dict(
+            self.counters,
+            entries=len(self.entries),
+            pinned=sum(1 for e in self.entries.values() if e["pinned"]),
+            in_flight=len(self.flights),
+            hit_rate=round((self.counters["hits"] + self.counters["coalesced"]) / lookups, 4) if lookups else 0.0,
+        )
+
+
+class CachedChatModel:
+    """
+    ChatModel 的代理：先查回复缓存，未命中时交给被包装的 chat_model 生成并写入缓存。
+    命名空间应包含基座模型与模板，保证换模型后不会命中旧回复。
+    """
+
+    def __init__(self, chat_model: Any, cache: ResponseCache, namespace: str, pool: Any = None):
+        self.chat_model = chat_model
+        self.cache = cache
+        self.namespace = namespace
+        self.pool = pool
+
+    @property
+    def engine(self):
+        return self.chat_model.engine
+
+    def __getattr__(self, name):
+        return getattr(self.chat_model, name)
+
+    def _key(self, messages, system, tools, adapter, kwargs):
+        name = self.pool.resolve(adapter if adapter is not None else current_adapter.get()) if self.pool else adapter
+        defaults = getattr(self.engine, "generating_args", None) or {}
+        params = resolve_params(defaults, kwargs)
+        key = self.cache.make_key(self.namespace, name, params, messages, system, tools, kwargs.get("stop"))
+        return key, params
+
+    def _measure(self, messages, system, tools, chunks: List[str], params: Dict[str, Any]) -> Response:
+        """
+        流式生成拿不到结束原因与 Token 数：用模型的 tokenizer 重新计数 (没有 tokenizer 的后端按分段数)，
+        回复达到 max_new_tokens 视为被截断。
+        """
+        text = "".join(chunks)
+        tokenizer = getattr(self.engine, "tokenizer", None)
+        if tokenizer is not None:
+            prompt_length = len(BatchGenerator(self.engine).encode(messages, system, tools))
+            tokens = len(tokenizer.encode(text, add_special_tokens=False))
+        else:
+            prompt_length, tokens = 0, len(chunks)
+        finish_reason = "length" if tokens >= params["max_new_tokens"] else "stop"
+        return Response(response_text=text, response_length=tokens, prompt_length=prompt_length,
+                        finish_reason=finish_reason)
+
+    async def _generate(self, key, flight: _Flight, messages, system, tools, params: Dict[str, Any],
+                        pinned: bool, kwargs, stream: bool = True):
+        """
+        驱动被包装模型生成，把分段推给 flight；stream=False 时走被包装模型的 achat (非流式请求)，
+        结束原因与 Token 数随条目写入缓存，被截断的回复不缓存。
+        """
+        try:
+            if stream:
+                async for chunk in self.chat_model.astream_chat(messages, system, tools, **kwargs):
+                    flight.push(chunk)
+                flight.response = self._measure(messages, system, tools, flight.chunks, params)
+            else:
+                flight.response = (await self.chat_model.achat(messages, system, tools, **kwargs))[0]
+                flight.push(flight.response.response_text)
+        except BaseException as e:
+            flight.close(e)
+            raise
+        finally:
+            self.cache.flights.pop(key, None)
+        response = flight.response
+        self.cache.put(key, flight.chunks, tokens=response.response_length, prompt_length=response.prompt_length,
+                       finish_reason=response.finish_reason, pinned=pinned)
+        flight.close()
+
+    def _start(self, key, messages, system, tools, params, adapter, kwargs, stream: bool) -> _Flight:
+        """登记 flight 并在独立任务中生成：发起者断开时跟随者仍能拿到完整回复"""
+        flight = self.cache.flights[key] = _Flight()
+        task = asyncio.get_running_loop().create_task(
+            self._generate(key, flight, messages, system, tools, params, False, self._forward(adapter, kwargs), stream))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return flight
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                           adapter: Optional[str] = None, **kwargs):
+        if images or videos or audios:
+            self.cache.counters["bypassed"] += 1
+            async for chunk in self.chat_model.astream_chat(messages, system, tools, images, videos, audios,
+                                                            **self._forward(adapter, kwargs)):
+                yield chunk
+            return
+        key, params = self._key(messages, system, tools, adapter, kwargs)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.counters["hits"] += 1
+            for chunk in entry["chunks"]:
+                yield chunk
+            return
+        flight = self.cache.flights.get(key)
+        if flight is not None:
+            self.cache.counters["coalesced"] += 1
+            async for chunk in flight.follow():
+                yield chunk
+            return
+
+        cacheable = self.cache.cacheable(params)
+        self.cache.counters["misses" if cacheable else "bypassed"] += 1
+        if not cacheable:
+            async for chunk in self.chat_model.astream_chat(messages, system, tools, images, videos, audios,
+                                                            **self._forward(adapter, kwargs)):
+                yield chunk
+            return
+        flight = self._start(key, messages, system, tools, params, adapter, kwargs, stream=True)
+        async for chunk in flight.follow():
+            yield chunk
+
+    def _forward(self, adapter, kwargs):
+        return dict(kwargs, adapter=adapter) if adapter is not None else kwargs
+
+    async def achat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                    adapter: Optional[str] = None, **kwargs):
+        if images or videos or audios or (kwargs.get("num_return_sequences") or 1) > 1:
+            self.cache.counters["bypassed"] += 1
+            return await self.chat_model.achat(messages, system, tools, images, videos, audios, **self._forward(adapter, kwargs))
+        key, params = self._key(messages, system, tools, adapter, kwargs)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.counters["hits"] += 1
+            return [Response(response_text="".join(entry["chunks"]), response_length=entry["tokens"],
+                             prompt_length=entry["prompt_length"], finish_reason=entry["finish_reason"])]
+        flight = self.cache.flights.get(key)
+        if flight is not None:
+            self.cache.counters["coalesced"] += 1
+        else:
+            cacheable = self.cache.cacheable(params)
+            self.cache.counters["misses" if cacheable else "bypassed"] += 1
+            if not cacheable:
+                return await self.chat_model.achat(messages, system, tools, **self._forward(adapter, kwargs))
+            flight = self._start(key, messages, system, tools, params, adapter, kwargs, stream=False)
+        async for _ in flight.follow():
+            pass
+        return [flight.response]
+
+    async def prewarm(self, items: List[Dict[str, Any]], **kwargs) -> int:
+        """按列表逐条生成并写入缓存 (使用默认采样参数，与 Gradio 预设按钮的请求一致)；条目不被 LRU 淘汰，TTL 到期后失效"""
+        warmed = 0
+        for item in items:
+            adapter = item.get("adapter")
+            key, params = self._key(item["messages"], item.get("system"), None, adapter, kwargs)
+            if self.cache.get(key) is not None:
+                continue
+            flight = self.cache.flights[key] = _Flight()
+            try:
+                await self._generate(key, flight, item["messages"], item.get("system"), None, params, True,
+                                     self._forward(adapter, kwargs))
+                warmed += 1
+                self.cache.counters["prewarmed"] += 1
+            except Exception as e:
+                print(f"[Cache] 预热失败: {e}", flush=True)
+        print(f"[Cache] 预热完成: {warmed}/{len(items)} 条", flush=True)
+        return warmed
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs):
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self.chat_model._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self.chat_model._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+
+def install_cache_routes(app, cache: ResponseCache):
+    """/v1/cache 返回命中率与条目统计"""
+
+    @app.get("/v1/cache")
+    async def cache_stats():
+        return cache.stats()
+
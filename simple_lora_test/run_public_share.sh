@@ -8,6 +8,9 @@
 #
 # 示例:
 #   ./run_public_share.sh /root/local-nvme/train_output/checkpoint-1156 admin password
+#
+# 作为 api_backend 的轻量客户端运行 (界面进程不加载模型):
+#   BACKEND_URL=http://127.0.0.1:8000 ./run_public_share.sh "" admin password
 # ==============================================================================
 
 VENV_DIR="/root/local-nvme/train_env/venv"
@@ -30,6 +33,9 @@ if [ -n "$LORA_PATH" ]; then
     fi
     LORA_ARG="--adapter_name_or_path ${LORA_PATH}"
 fi
+if [ -n "$BACKEND_URL" ]; then
+    LORA_ARG="--backend_url ${BACKEND_URL}"
+fi
 
 # 4. 启动服务
 echo "--- 正在启动公网分享服务 ---"
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+会话 KV Cache 复用 (Session Cache)
+功能：服务端按会话保留上一轮对话的 KV Cache，新一轮只需编码与缓存不同的部分 (通常只是新的用户消息)。
+1. 复用按 Token 的最长公共前缀判定：模板改写历史 (如 qwen3 去掉历史回复中的 <think>) 时自动退回到分歧点，结果始终与完整编码一致；
+2. 缓存按 (会话, 适配器) 区分；空闲超过 idle_ttl 的会话先淘汰，总占用超过 max_bytes 或 GPU 剩余显存不足时按最近最少使用淘汰；
+3. 每轮记录提示词长度、复用/新编码的 Token 数与首 Token 时间 (TTFT)，按轮次汇总，观察对话变长时 TTFT 的变化。
+API 通过请求头 `X-Session-Id` 指定会话；Gradio 使用页面会话 (session_hash)。未指定会话的请求走原来的路径。
+"""
+
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Any, Tuple
+
+from adapter_pool import current_adapter
+from batching import BatchGenerator, GenerationRequest, resolve_params
+
+SESSION_HEADER = b"x-session-id"
+MAX_TURN_HISTORY = 50
+
+# 由 SessionMiddleware 按请求设置
+current_session: ContextVar[Optional[str]] = ContextVar("current_session", default=None)
+
+
+def common_prefix(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def _cache_tensors(past):
+    """遍历 KV Cache 中的张量 (兼容 transformers 各版本的 Cache 对象与旧式元组)"""
+    if hasattr(past, "layers"):
+        for layer in past.layers:
+            yield from (t for t in (getattr(layer, "keys", None), getattr(layer, "values", None)) if t is not None)
+    elif hasattr(past, "key_cache"):
+        yield from past.key_cache
+        yield from past.value_cache
+    else:
+        for layer in past:
+            yield from layer
+
+
+def cache_bytes(past) -> int:
+    return sum(t.numel() * t.element_size() for t in _cache_tensors(past))
+
+
+def crop_cache(past, length: int):
+    """把 KV Cache 截断到前 length 个 Token"""
+    if hasattr(past, "crop"):
+        past.crop(length)
+        return past
+    return tuple(tuple(t[..., :length, :] for t in layer) for layer in past)
+
+
+def _cuda_free_bytes() -> Optional[int]:
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return torch.cuda.mem_get_info()[0]
+    except ImportError:
+        pass
+    return None
+
+
+class SessionStore:
+    """会话缓存：{(会话, 适配器): {"ids", "past", "bytes", "last_used", "turns"}}，按最近使用排序"""
+
+    def __init__(self, max_bytes: int, idle_ttl: float = 1800, min_free_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.min_free_bytes = min_free_bytes
+        self.entries: "OrderedDict[Tuple[str, Optional[str]], Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = {"idle": 0, "memory": 0}
+        # 按轮次汇总：{轮次: {"count", "ttft_sum", "encoded_sum", "reused_sum"}}
+        self.by_turn: Dict[int, Dict[str, float]] = {}
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def take(self, key) -> Optional[Dict[str, Any]]:
+        """取出会话 (生成期间不在缓存中，不会被淘汰)"""
+        with self.lock:
+            return self.entries.pop(key, None)
+
+    def put(self, key, entry: Dict[str, Any]):
+        entry["bytes"] = cache_bytes(entry["past"]) if entry.get("past") is not None else 0
+        entry["last_used"] = time.time()
+        with self.lock:
+            self.entries[key] = entry
+            self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        now = time.time()
+        for key in [k for k, e in self.entries.items() if k != keep and now - e["last_used"] > self.idle_ttl]:
+            self._drop(key, "idle")
+        while True:
+            free = _cuda_free_bytes()
+            low_memory = free is not None and free < self.min_free_bytes
+            if not (self.total_bytes > self.max_bytes or low_memory):
+                break
+            victim = next((k for k in self.entries if k != keep), None)
+            if victim is None:
+                break
+            self._drop(victim, "memory")
+        # 单个会话本身超出预算时不保留
+        if keep in self.entries and self.entries[keep]["bytes"] > self.max_bytes:
+            self._drop(keep, "memory")
+
+    def _drop(self, key, reason: str):
+        self.entries.pop(key, None)
+        self.evictions[reason] += 1
+
+    def sweep(self):
+        """清理空闲会话 (每轮开始前与查询统计时调用)"""
+        with self.lock:
+            self._evict()
+
+    def record_turn(self, turn: int, stat: Dict[str, Any]):
+        with self.lock:
+            agg = self.by_turn.setdefault(turn, {"count": 0, "ttft_sum": 0.0, "encoded_sum": 0, "reused_sum": 0})
+            agg["count"] += 1
+            agg["ttft_sum"] += stat["ttft_ms"]
+            agg["encoded_sum"] += stat["encoded_tokens"]
+            agg["reused_sum"] += stat["reused_tokens"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            sessions = {
+                f"{sid}@{adapter}" if adapter else sid: {
+                    "cached_tokens": len(e["ids"]),
+                    "cache_mb": round(e["bytes"] / 1024 ** 2, 2),
+                    "idle_seconds": round(time.time() - e["last_used"], 1),
+                    "turns": e["turns"][-5:],
+                }
+                for (sid, adapter), e in self.entries.items()
+            }
+            by_turn = {
+                turn: {
+                    "count": agg["count"],
+                    "ttft_ms_mean": round(agg["ttft_sum"] / agg["count"], 1),
+                    "encoded_tokens_mean": round(agg["encoded_sum"] / agg["count"], 1),
+                    "reused_tokens_mean": round(agg["reused_sum"] / agg["count"], 1),
+                }
+                for turn, agg in sorted(self.by_turn.items())
+            }
+            return {
+                "sessions": len(self.entries),
+                "cache_mb": round(self.total_bytes / 1024 ** 2, 2),
+                "max_cache_mb": round(self.max_bytes / 1024 ** 2, 2),
+                "evictions": dict(self.evictions),
+                "ttft_by_turn": by_turn,
+                "detail": sessions,
+            }
+
+
+class SessionGenerator(BatchGenerator):
+    """单会话生成：从缓存的 KV 出发，只前向与缓存不同的后缀"""
+
+    def __init__(self, holder: Any, store: SessionStore):
+        super().__init__(holder)
+        self.store = store
+
+    def run(self, req: GenerationRequest, key: Tuple[str, Optional[str]]):
+        """在生成线程中运行；结束时把新的 KV Cache 放回会话"""
+        import torch
+        started = time.perf_counter()
+        model, tokenizer = self.holder.model, self.holder.tokenizer
+        stop_ids = set(self.stop_ids())
+        device = next(model.parameters()).device
+        prompt = req.prompt_ids
+
+        entry = self.store.take(key) or {"ids": [], "past": None, "turns": []}
+        reused = min(common_prefix(entry["ids"], prompt), len(prompt) - 1)
+        past = crop_cache(entry["past"], reused) if reused > 0 and entry["past"] is not None else None
+        if past is None:
+            reused = 0
+        cache_ids = list(prompt)
+        feed = torch.tensor([prompt[reused:]], device=device)
+        positions = torch.arange(reused, len(prompt), device=device)[None, :]
+        generated: List[int] = []
+        emitted = ""
+        ttft_ms = None
+        think = self.think_budget(req)
+
+        try:
+            with torch.inference_mode():
+                while True:
+                    attention = torch.ones((1, positions[0, -1].item() + 1), dtype=torch.long, device=device)
+                    out = model(input_ids=feed, attention_mask=attention, position_ids=positions,
+                                past_key_values=past, use_cache=True)
+                    past = out.past_key_values
+                    token = int(self._sample(out.logits[:, -1, :].float(), [req], [cache_ids])[0])
+                    if think is not None:
+                        token = think.steer(token)
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - started) * 1000
+                    if req.cancelled or token in stop_ids:
+                        break
+                    generated.append(token)
+                    req.tokens += 1
+                    text = tokenizer.decode(generated, skip_special_tokens=True)
+                    if not text.endswith("�") and len(text) > len(emitted):
+                        req.emit(text[len(emitted):])
+                        emitted = text
+                    if req.tokens >= req.params["max_new_tokens"]:
+                        req.finish_reason = "length"
+                        break
+                    cache_ids.append(token)
+                    feed = torch.tensor([[token]], device=device)
+                    positions = positions[:, -1:] + 1
+        except BaseException as e:
+            req.finish(e)
+            raise  # 出错的会话不放回缓存
+        req.finish()
+
+        stat = {
+            "turn": len(entry["turns"]) + 1,
+            "prompt_tokens": len(prompt),
+            "reused_tokens": reused,
+            "encoded_tokens": len(prompt) - reused,
+            "ttft_ms": round(ttft_ms or 0.0, 1),
+        }
+        entry["turns"] = (entry["turns"] + [stat])[-MAX_TURN_HISTORY:]
+        entry["ids"], entry["past"] = cache_ids, past
+        self.store.record_turn(stat["turn"], stat)
+        self.store.put(key, entry)
+        print(f"[Session] {key[0]} 第 {stat['turn']} 轮 | 提示词 {stat['prompt_tokens']} | 复用 {reused} | "
+              f"新编码 {stat['encoded_tokens']} | TTFT {stat['ttft_ms']}ms", flush=True)
+
+
+class SessionChatModel:
+    """
+    ChatModel 的代理：带会话 ID 的纯文本请求走 SessionGenerator，其余交给被包装的 chat_model
+    (MultiAdapterChatModel 或 BatchingChatModel)，两条路径通过 pool.lock 互斥。
+    """
+
+    def __init__(self, chat_model: Any, generator: SessionGenerator, pool: Any = None):
+        self.chat_model = chat_model
+        self.generator = generator
+        self.pool = pool
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-generate")
+        self._lock = pool.lock if pool is not None else threading.Lock()
+
+    @property
+    def engine(self):
+        return self.chat_model.engine
+
+    def __getattr__(self, name):
+        return getattr(self.chat_model, name)
+
+    def _execute(self, req: GenerationRequest, key):
+        with self._lock:
+            if self.pool is not None:
+                self.pool.activate(req.adapter)
+            self.generator.run(req, key)
+
+    def _start(self, session: str, messages, system, tools, adapter, kwargs) -> GenerationRequest:
+        name = self.pool.resolve(adapter if adapter is not None else current_adapter.get()) if self.pool else None
+        params = resolve_params(self.generator.defaults, kwargs)
+        req = GenerationRequest(self.generator.encode(messages, system, tools), params, name)
+        # 每轮开始前清理空闲会话
+        self.generator.store.sweep()
+        future = req.loop.run_in_executor(self._executor, self._execute, req, (session, name))
+        future.add_done_callback(self._report_error)
+        return req
+
+    @staticmethod
+    def _report_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[Session] 生成失败: {future.exception()}", flush=True)
+
+    def _delegated(self, adapter, kwargs):
+        return dict(kwargs, adapter=adapter) if adapter is not None else kwargs
+
+    async def astream_chat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                           adapter: Optional[str] = None, session_id: Optional[str] = None, **kwargs):
+        session = session_id or current_session.get()
+        if not session or images or videos or audios:
+            async for new_token in self.chat_model.astream_chat(messages, system, tools, images, videos, audios,
+                                                                **self._delegated(adapter, kwargs)):
+                yield new_token
+            return
+        req = self._start(session, messages, system, tools, adapter, kwargs)
+        async for new_token in req.results():
+            yield new_token
+
+    async def achat(self, messages, system=None, tools=None, images=None, videos=None, audios=None,
+                    adapter: Optional[str] = None, session_id: Optional[str] = None, **kwargs):
+        session = session_id or current_session.get()
+        # 多个候选回复无法共享同一会话的后续缓存，交给原路径
+        if not session or images or videos or audios or (kwargs.get("num_return_sequences") or 1) > 1:
+            return await self.chat_model.achat(messages, system, tools, images, videos, audios,
+                                               **self._delegated(adapter, kwargs))
+        from backends import Response
+        req = self._start(session, messages, system, tools, adapter, kwargs)
+        text = "".join([t async for t in req.results()])
+        return [Response(response_text=text, response_length=req.tokens,
+                         prompt_length=len(req.prompt_ids), finish_reason=req.finish_reason)]
+
+    def chat(self, messages, system=None, tools=None, *args, **kwargs):
+        task = asyncio.run_coroutine_threadsafe(self.achat(messages, system, tools, *args, **kwargs), self.chat_model._loop)
+        return task.result()
+
+    def stream_chat(self, messages, system=None, tools=None, *args, **kwargs):
+        generator = self.astream_chat(messages, system, tools, *args, **kwargs)
+        while True:
+            try:
+                task = asyncio.run_coroutine_threadsafe(generator.__anext__(), self.chat_model._loop)
+                yield task.result()
+            except StopAsyncIteration:
+                break
+
+
+class SessionMiddleware:
+    """ASGI 中间件：把请求头 X-Session-Id 写入 current_session"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        session = dict(scope.get("headers") or []).get(SESSION_HEADER)
+        token = current_session.set(session.decode("latin-1") if session else None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_session.reset(token)
+
+
+def install_session_routes(app, store: SessionStore):
+    """/v1/sessions 返回会话数、缓存占用、淘汰次数与按轮次的 TTFT"""
+
+    @app.get("/v1/sessions")
+    async def session_stats():
+        store.sweep()
+        return store.stats()
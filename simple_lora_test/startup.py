@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+快速启动 (Startup)
+功能：API 服务先绑定端口，再在后台加载模型，编排系统 (k8s / systemd / 负载均衡) 能立即看到进程存活并等待就绪。
+1. 启动顺序：预读权重 (mmap 逐段读取 *.safetensors，进度按字节计) → 后端 load() → 组装服务层 → 预热生成 → 就绪；
+   LLaMA-Factory / transformers 本身也以 mmap 方式读取 safetensors，预读后加载直接命中页缓存；
+2. /healthz 为存活探针 (加载失败时返回 503，便于重启)，/readyz 为就绪探针 (就绪前返回 503)，两者都返回当前阶段与进度；
+3. 就绪前其他请求直接返回 503 + Retry-After，不会卡在未加载的模型上；
+4. create_app 需要在启动时拿到 ChatModel，先传入 LazyChatModel 占位，组装完成后再指向真正的服务链；
+   LLaMA-Factory 的 lifespan 因此读到占位引擎，huggingface 引擎的定期显存回收 (sweeper) 在组装完成后补上。
+"""
+
+import os
+import glob
+import mmap
+import time
+import json
+import asyncio
+import threading
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+PROBE_PATHS = ("/healthz", "/readyz")
+PREFETCH_CHUNK = 64 * 1024 ** 2
+WARMUP_MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+class LoadState:
+    """启动进度：阶段、阶段内进度 (0~1，未知时为 None)、各阶段耗时与错误信息"""
+
+    def __init__(self):
+        self.phase = "starting"
+        self.progress: Optional[float] = None
+        self.detail = ""
+        self.error: Optional[str] = None
+        self.started = time.time()
+        self.timings: Dict[str, float] = {}
+        self._phase_started = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
+
+    @property
+    def failed(self) -> bool:
+        return self.phase == "failed"
+
+    def set_phase(self, phase: str, detail: str = "", progress: Optional[float] = None):
+        with self._lock:
+            now = time.time()
+            if self.phase not in ("starting", "ready", "failed"):
+                self.timings[self.phase] = round(now - self._phase_started, 2)
+            self.phase, self.detail, self.progress = phase, detail, progress
+            self._phase_started = now
+        print(f"[Startup] {phase}{': ' + detail if detail else ''} ({now - self.started:.1f}s)", flush=True)
+
+    def set_progress(self, progress: float, detail: Optional[str] = None):
+        with self._lock:
+            self.progress = round(progress, 4)
+            if detail is not None:
+                self.detail = detail
+
+    def fail(self, error: BaseException):
+        self.error = f"{type(error).__name__}: {error}"
+        self.set_phase("failed", self.error)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "status": self.phase,
+                "progress": self.progress,
+                "detail": self.detail,
+                "elapsed": round(time.time() - self.started, 2),
+                "timings": dict(self.timings),
+                "error": self.error,
+            }
+
+
+def safetensors_files(path: str) -> List[str]:
+    """本地模型目录中的 safetensors 分片 (Hub 上的模型名返回空列表)"""
+    if not path or not os.path.isdir(path):
+        return []
+    return sorted(glob.glob(os.path.join(path, "*.safetensors")))
+
+
+def prefetch_weights(paths: List[str], progress: Optional[Callable[[int, int], None]] = None,
+                     chunk_size: int = PREFETCH_CHUNK) -> int:
+    """
+    以 mmap 顺序读取权重文件，把分片读入页缓存；progress(已读字节, 总字节)。
+    不保留任何数据，随后框架 mmap 同一文件时无需再等磁盘。
+    """
+    total = sum(os.path.getsize(p) for p in paths)
+    done = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if size == 0:
+            continue
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, size, chunk_size):
+                mm[offset:offset + chunk_size]
+                done += min(chunk_size, size - offset)
+                if progress is not None:
+                    progress(done, total)
+    return total
+
+
+class LazyChatModel:
+    """
+    服务链就绪前的占位 ChatModel：create_app 只在路由中调用它 (就绪前已被 ReadinessMiddleware 拦截)。
+    LLaMA-Factory 的 lifespan 启动时会读取 engine.name，加载前返回占位引擎。
+    """
+
+    def __init__(self):
+        self.target: Any = None
+
+    @property
+    def engine(self):
+        if self.target is None:
+            return SimpleNamespace(name=None)
+        return self.target.engine
+
+    def __getattr__(self, name):
+        if self.target is None:
+            raise RuntimeError("模型尚未加载完成")
+        return getattr(self.target, name)
+
+
+class ReadinessMiddleware:
+    """ASGI 中间件：就绪前除探针外的 HTTP 请求返回 503 与当前进度"""
+
+    def __init__(self, app, state: LoadState, retry_after: int = 5):
+        self.app = app
+        self.state = state
+        self.retry_after = retry_after
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.state.ready or scope.get("path") in PROBE_PATHS:
+            return await self.app(scope, receive, send)
+        message = "模型加载失败" if self.state.failed else "模型加载中，请稍后重试"
+        body = json.dumps(dict(self.state.snapshot(), message=message), ensure_ascii=False).encode('utf-8')
+        await send({"type": "http.response.start", "status": 503, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(self.retry_after).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def install_probe_routes(app, state: LoadState):
+    """/healthz：进程存活 (加载失败时 503)；/readyz：可以接收请求 (就绪前 503)"""
+    from fastapi.responses import JSONResponse
+
+    @app.get("/healthz")
+    async def healthz():
+        return JSONResponse(state.snapshot(), status_code=503 if state.failed else 200)
+
+    @app.get("/readyz")
+    async def readyz():
+        return JSONResponse(state.snapshot(), status_code=200 if state.ready else 503)
+
+
+def start_sweeper(engine: Any) -> Optional[asyncio.Task]:
+    """huggingface 引擎：在当前事件循环上启动 LLaMA-Factory 的 sweeper (定期 torch_gc)；其他引擎返回 None"""
+    try:
+        from llamafactory.api.app import sweeper
+        from llamafactory.extras.constants import EngineName
+    except ImportError:
+        return None
+    if getattr(engine, "name", None) != EngineName.HF:
+        return None
+    return asyncio.get_running_loop().create_task(sweeper())
+
+
+async def start_service(state: LoadState, lazy: LazyChatModel, load: Callable[[], Any], build: Callable[[Any], Any],
+                        weights: Optional[List[str]] = None, warmup_tokens: int = 16,
+                        after_ready: Optional[Callable[[Any], Any]] = None):
+    """
+    后台启动流程。load 在线程池中执行 (阻塞的模型加载)，build(backend) 在事件循环上组装服务链并注册路由，
+    预热生成走完整的服务链 (适配器、批处理、CUDA kernel 都在就绪前初始化)；after_ready(served) 为就绪后的后台任务。
+    组装完成后启动的 sweeper 随本任务一起在关闭时取消。
+    """
+    loop = asyncio.get_running_loop()
+    sweeper = None
+    try:
+        try:
+            if weights:
+                state.set_phase("prefetching", f"{len(weights)} 个 safetensors 分片", 0.0)
+
+                def report(done, total):
+                    state.set_progress(done / total if total else 1.0, f"{done / 1024 ** 3:.1f} / {total / 1024 ** 3:.1f} GB")
+
+                await loop.run_in_executor(None, prefetch_weights, weights, report)
+            state.set_phase("loading", "加载模型权重")
+            backend = await loop.run_in_executor(None, load)
+            state.set_phase("building", "组装服务层")
+            served = build(backend)
+            lazy.target = served
+            sweeper = start_sweeper(served.engine)
+            if warmup_tokens > 0:
+                state.set_phase("warming_up", f"预热生成 {warmup_tokens} tokens")
+                await served.achat(WARMUP_MESSAGES, max_new_tokens=warmup_tokens)
+            state.set_phase("ready", f"启动用时 {time.time() - state.started:.1f}s", 1.0)
+        except Exception as e:
+            state.fail(e)
+            return
+        if after_ready is not None:
+            await after_ready(served)
+        if sweeper is not None:
+            await sweeper
+    finally:
+        if sweeper is not None:
+            sweeper.cancel()
+
+def install_startup(app, state: LoadState, lazy: LazyChatModel, load: Callable[[], Any], build: Callable[[Any], Any],
+                    **kwargs):
+    """
+    在 lifespan 中启动后台加载，uvicorn 不等待加载完成即可绑定端口。
+    LLaMA-Factory 的 create_app 使用 lifespan，startup 事件不会触发，因此包装原有的 lifespan_context；
+    加载后的生成 (预热、缓存预热) 都跑在 uvicorn 的事件循环上，与批处理调度器等共享同一个循环。
+    """
+    from contextlib import asynccontextmanager
+    inner = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app_):
+        async with inner(app_) as state_:
+            task = asyncio.get_running_loop().create_task(start_service(state, lazy, load, build, **kwargs))
+            try:
+                yield state_
+            finally:
+                task.cancel()
+
+    app.router.lifespan_context = lifespan
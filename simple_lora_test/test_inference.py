@@ -1,18 +1,20 @@
-from llamafactory.chat import ChatModel
-import os
+import argparse
+from backends import add_backend_args, create_backend
 
 def test():
-    model_path = "/root/local-nvme/train_env/models/Qwen3-14B-abliterated"
-    adapter_path = "/root/local-nvme/train_output/hentai_lora_results_lora_dataset_叶灵静_merged_v1.2_2026-01-25-21-42-36"
+    parser = argparse.ArgumentParser(description="LoRA inference smoke test")
+    parser.add_argument("--model_name_or_path", type=str, default="/root/local-nvme/train_env/models/Qwen3-14B-abliterated")
+    parser.add_argument("--adapter_name_or_path", type=str,
+                        default="/root/local-nvme/train_output/hentai_lora_results_lora_dataset_叶灵静_merged_v1.2_2026-01-25-21-42-36")
+    parser.add_argument("--template", type=str, default="qwen3")
+    add_backend_args(parser)
+    args = parser.parse_args()
+    model_path = args.model_name_or_path
+    adapter_path = args.adapter_name_or_path or None
     
-    print(f"Initializing model with adapter: {adapter_path}")
-    chat_model = ChatModel(dict(
-        model_name_or_path=model_path,
-        adapter_name_or_path=adapter_path,
-        template="qwen3",
-        finetuning_type="lora",
-        quantization_bit=4,
-    ))
+    print(f"Initializing model ({args.backend}) with adapter: {adapter_path}")
+    chat_model = create_backend(args, model_path, template=args.template, finetuning_type="lora",
+                                quantization_bit=4, adapter_name_or_path=adapter_path).load()
 
     messages = [{"role": "user", "content": "你好，请问你是谁？"}]
     print("\nUser: 你好，请问你是谁？")